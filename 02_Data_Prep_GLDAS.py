@@ -29,6 +29,8 @@ data_root = './Datasets/'
 shape_location = './Aquifer Shapes/CA_Central_valley.shp'
 # gldas_root is the location of folder containing the tabulated GLDAS
 gldas_root = r'C:\Users\saulg\Desktop\data\gldas_tabular'
+# Only the cells of the aquifer are read from the <variable>.nc stores written
+# by utils_00_gldas.py, variables without a store are read from the pickles.
 # variables_list_loc the text file containing the GLDAS variable names
 variables_list_loc = './Satellite Data Prep/variables_list.txt'
 
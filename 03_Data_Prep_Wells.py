@@ -25,18 +25,30 @@ data_root = './Datasets/'
 aquifer_root = './Aquifers Data'
 figures_root = './Figures Aquifer'
 
+# Long format measurements (Date, Well ID, Measurement) with a location table
+# (Well ID, Longitude, Latitude) are streamed in chunks instead of reading the
+# pickle, e.g. data_root + 'EscalanteBerylTimeseries.csv' and
+# data_root + 'EscalanteBerylLocation.csv'. None reads the pickle.
+timeseries_csv = None
+location_csv = None
+chunksize = 500000
+
 # Location must be added
 Wells=wf.wellfunc(data_root, aquifer_root, figures_root)
 
-# read the well data from a pickle file
-raw_wells_dict = Wells.read_well_pickle('CA_JPL_pre2000')
-
 # extractwelldata extracts waterlevel measurements and creates a pandas data 
 # Bcap and Fcap are bottom and final cap, this control guarrenties that wells
 # will contain data before and after the caps
 # MinEx is the minimum number examples required within dataset
 # extract the data into a panda data frame
-wells_dict = Wells.extractwelldata(raw_wells_dict, Left=1948, Right=2021, Min_Obs_Months=35)          
+if timeseries_csv is None:
+    # read the well data from a pickle file
+    raw_wells_dict = Wells.read_well_pickle('CA_JPL_pre2000')
+    wells_dict = Wells.extractwelldata(raw_wells_dict, Left=1948, Right=2021, Min_Obs_Months=35)
+else:
+    # monthly means of the retained wells, read chunksize rows at a time
+    wells_dict = Wells.stream_long_csv(timeseries_csv, location_csv, Left=1948, Right=2021,
+                                       Min_Obs_Months=35, chunksize=chunksize)
 
 # now need to resample well data to begining of month ('1MS') or chosen period
 # next most used will be 'QS' Quarter Start Frequency
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:40:00 2026
+
+@author: saulg
+"""
+import time
+import pandas as pd
+import numpy as np
+import utils_04_machine_learning
+import utils_04_parallel
+import utils_04_models
+import utils_05_iteration
+import warnings
+
+warnings.simplefilter(action='ignore')
+
+# Compares the model backends of utils_04_models on the bundled
+# Beryl-Enterprise wells. Every well gets the features of the iterative
+# imputation (05_Imputation_Iteration.py) and is trained by kfold_train once
+# per backend. Reports the time to build the first model (imports included),
+# the training time per well and the average metrics of every backend.
+
+#Data Settings
+data_root =    './Datasets/'
+figures_root = './Figures Benchmark'
+val_split = 0.30
+weight_cor = 0.70
+weight_dist = 1 - weight_cor
+min_features = 5
+feature_thresh = 0.6
+
+# Benchmark Settings
+# n_wells limits the benchmark to the first wells, None trains every well
+backends = ['numpy', 'keras']
+n_wells = 10
+seed = 42
+
+columns = ['Train ME',     'Train RMSE',      'Train MAE',      'Train Points',      'Train r2',
+           'Validation ME','Validation RMSE', 'Validation MAE', 'Validation Points', 'Validation r2',
+           'Test ME',      'Test RMSE',       'Test MAE',       'Test Points',       'Test r2',
+           'Comp R2']
+
+if __name__ == '__main__':
+    imp = utils_04_machine_learning.imputation(data_root, figures_root)
+    Well_Data = imp.read_data('Well_Data', data_root)
+    Well_Data_Pretrained = imp.read_data('Well_Data_Imputed', data_root)
+    Well_Data_Pretrained['Data'] = imp.hampel_filter(Well_Data_Pretrained['Data'], Well_Data['Data'], max_sd = 3, window = 36)
+
+    # Features of every well, built once and trained by every backend
+    shared = {'Pretrained': Well_Data_Pretrained['Data'],
+              'Data':       Well_Data['Data']}
+    pool = utils_04_parallel.well_pool(1, shared = shared, tensorflow = False)
+    well_index = utils_04_machine_learning.spatial_index(Well_Data['Location'])
+    selection = utils_05_iteration.feature_selection(Well_Data_Pretrained['Data'], Well_Data['Data'],
+                    Well_Data['Location'], well_index, weight_cor, weight_dist,
+                    min_features = min_features, feature_thresh = feature_thresh)
+    wells = Well_Data['Data'].columns[:n_wells]
+    tasks = []
+    for well in wells:
+        try:
+            tasks.append(utils_05_iteration.iteration_task({
+                'well':         well,
+                'windows':      [24],
+                'selection':    selection.get(well),
+                'columns':      columns,
+                'folds':        5,
+                'val_split':    val_split,
+                'l2':           0.01,
+                'seed':         seed,
+                'plot_kfolds':  False,
+                'data_root':    data_root,
+                'figures_root': figures_root}))
+        except Exception as e:
+            print(f'Skipping well {well}: {e}')
+    pool.close()
+
+    summary = pd.DataFrame()
+    metrics = dict()
+    for backend in backends:
+        start = time.perf_counter()
+        utils_04_models.build_model(tasks[0]['X'].shape[1], backend = backend)
+        startup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = [utils_04_parallel.kfold_train(dict(task, backend = backend)) for task in tasks]
+        elapsed = time.perf_counter() - start
+
+        metrics[backend] = pd.concat([result['Metrics'] for result in results])
+        summary[backend] = metrics[backend][['Train RMSE', 'Validation RMSE', 'Test RMSE', 'Test r2', 'Comp R2']].mean()
+        summary.loc['Epochs', backend] = np.mean([result['epochs'] for result in results])
+        summary.loc['Startup (s)', backend] = startup
+        summary.loc['Seconds per Well', backend] = elapsed / len(tasks)
+        print(f'{backend}: {len(tasks)} wells in {elapsed:.1f} s')
+
+    print(summary)
+    summary.to_csv(data_root + '/' + '04_Benchmark_Backends.csv')
+    pd.concat(metrics, axis = 1).to_csv(data_root + '/' + '04_Benchmark_Backends_Wells.csv')
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:59:00 2026
+
+@author: saulg
+"""
+import time
+import numpy as np
+import pandas as pd
+import utils_04_machine_learning
+
+# Compares imputation.hampel_filter and imputation.smooth, which use the
+# rolling median of utils_04_rolling, with pandas rolling medians on a
+# synthetic matrix of random walk wells with outliers and sparse observed
+# readings. Reports the time of both and the largest difference.
+
+#Data Settings
+data_root =    './Datasets/'
+figures_root = './Figures Benchmark'
+
+# Benchmark Settings
+n_wells = 1000
+n_months = 900
+observed = 0.10
+outliers = 0.01
+seed = 42
+
+
+def pandas_hampel(df_imp, df_obs, max_sd = 3, window = 36):
+    roll = df_imp.rolling(window=window, min_periods = 1, center=True).median()
+    difference = np.abs(roll - df_imp)
+    mad = difference.rolling(window, min_periods = 1).median()
+    data = df_imp.copy()
+    data[difference > max_sd * 1.4826 * mad] = roll
+    return df_obs.reindex(index = df_imp.index, columns = df_imp.columns).fillna(data)
+
+
+def pandas_smooth(df_imp, df_obs, window = 36):
+    roll = df_imp.rolling(window=window, min_periods = 1, center=True).median()
+    return df_obs.reindex(index = df_imp.index, columns = df_imp.columns).fillna(roll)
+
+
+if __name__ == '__main__':
+    imp = utils_04_machine_learning.imputation(data_root, figures_root)
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('1948-01-01', periods = n_months, freq = 'MS')
+    columns = [f'Well {i}' for i in range(n_wells)]
+    values = rng.normal(size = (n_months, n_wells)).cumsum(axis=0)
+    values += np.where(rng.random(values.shape) < outliers, rng.normal(0, 50, values.shape), 0)
+    df_imp = pd.DataFrame(values, index = index, columns = columns)
+    df_obs = df_imp.where(rng.random(values.shape) < observed)
+
+    summary = pd.DataFrame(columns = ['pandas (s)', 'utils_04_rolling (s)', 'Speedup', 'Max Difference'])
+    for name, reference, method, kwargs in [('hampel_filter', pandas_hampel, imp.hampel_filter, {'window': 36}),
+                                            ('smooth',        pandas_smooth, imp.smooth,        {'window': 18})]:
+        start = time.perf_counter()
+        expected = reference(df_imp, df_obs, **kwargs)
+        pandas_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = method(df_imp, df_obs, **kwargs)
+        kernel_time = time.perf_counter() - start
+        difference = np.nanmax(np.abs(result.values - expected.values))
+        summary.loc[name] = [pandas_time, kernel_time, pandas_time / kernel_time, difference]
+
+    print(f'{n_wells} wells x {n_months} months')
+    print(summary)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:10:00 2026
+
+@author: saulg
+"""
+import time
+import numpy as np
+import pandas as pd
+import utils_04_machine_learning
+import utils_04_trends
+import warnings
+
+warnings.simplefilter(action='ignore')
+
+# Checks the extrapolation of utils_04_trends.linear_extrap_batch against the
+# per well linear_extrap it replaced (baseline_extrap below) on the bundled
+# wells. For every option case the filled prior, the Slope, Int and Mean
+# tables and the Lines of every side and percentage of imputation.linear_extrap
+# are compared with the baseline, so are the priors of well_trends_batch for
+# the cases it supports. Reports the largest relative difference of each and
+# the time of every implementation, well_trends and well_trends_batch include
+# the interpolation and rolling windows of the priors.
+
+#Data Settings
+data_root =    './Datasets/'
+figures_root = './Figures Benchmark'
+
+# Benchmark Settings
+# n_wells limits the check to the first wells, None uses every well
+n_wells = None
+windows = [18, 24, 36, 60]
+reg_perc = [1.0, 0.5, 0.25, 0.10]
+tolerance = 1e-9
+cases = {'default':          {},
+         'max_sd 6':         {'max_sd': 6},
+         'force negative':   {'max_sd': 6, 'force_left': 'negative', 'force_right': 'negative'},
+         'force positive':   {'force_left': 'positive', 'force_right': 'positive'},
+         'force mixed':      {'force_left': 'negative', 'force_right': 'positive'},
+         'cSlope':           {'cSlope_left': 0.05, 'cSlope_right': -0.05},
+         'force and cSlope': {'force_left': 'positive', 'cSlope_left': 0.05, 'cSlope_right': -0.05}}
+
+
+def baseline_extrap(imp, f_index, y, shift, reg_perc = [1.0, 0.5, 0.25, 0.10], max_sd = 3, outlier = 3,
+                    force_left = False, force_right = False, cSlope_left = False, cSlope_right = False):
+    # imputation.linear_extrap before utils_04_trends.linear_extrap_batch
+    left = pd.DataFrame(index = f_index.index, columns = reg_perc)
+    right = pd.DataFrame(index = f_index.index, columns = reg_perc)
+    d_side = {"left":left, "right":right}
+    d_slope = {}
+    s_min = min(reg_perc)
+    for i, side in enumerate(d_side):
+        slope_df = pd.DataFrame(index = reg_perc, columns = ['Slope', 'Int', 'Mean'])
+        for j, perc in enumerate(reg_perc):
+            points = int(len(y.dropna()) * perc)
+            if side == "left":
+                data = y[:points]
+                index = f_index[f_index.index <= data.index[-1]]
+                index = pd.DataFrame(np.arange(points - len(index), points, 1), index = index.index, columns = ['x'])
+                if perc == s_min: index_l = index
+            elif side == "right":
+                data = y[-points:]
+                index = f_index[f_index.index >= data.index[0]]
+                index = pd.DataFrame(np.arange(len(index) - len(index), len(index), 1), index = index.index, columns = ['x'])
+                if perc == s_min: index_r = index
+            mean = data['pchip'].mean()
+            sd = data['pchip'].std()
+            data = data[(data['pchip'] <= mean + outlier * sd)]
+            slope, intercept, _ = imp.linear_regression(index, data)
+            mean = data['pchip'].mean()
+            slope_df.loc[perc] = np.array([slope, intercept, mean])
+            d_side[side][perc] = index * slope + intercept
+        d_slope[side] = slope_df
+        if side == 'left': slope_l = slope_df['Slope'].mean()
+        elif side == 'right': slope_r = slope_df['Slope'].mean()
+
+    pop_mean = y['pchip'].mean()
+    pop_std = y['pchip'].std()
+    max_value = pop_mean + max_sd * pop_std
+    min_value = pop_mean - max_sd * pop_std
+    if force_left == 'positive': slope_l = abs(slope_l)
+    elif force_left == 'negative': slope_l = -1 * abs(slope_l)
+    elif cSlope_left != False: slope_l = cSlope_left
+    if force_right == 'positive': slope_r = abs(slope_r)
+    elif force_right == 'negative': slope_r = -1 * abs(slope_r)
+    elif cSlope_right != False: slope_r = cSlope_right
+
+    extrap_l = index_l * slope_l + d_slope['left']['Mean'].loc[s_min]
+    extrap_r = index_r * slope_r + d_slope['right']['Mean'].loc[s_min]
+    extrap_l['x'] = np.where(extrap_l['x'] <= max_value, extrap_l['x'], max_value)
+    extrap_l['x'] = np.where(extrap_l['x'] >= min_value, extrap_l['x'], min_value)
+    extrap_r['x'] = np.where(extrap_r['x'] <= max_value, extrap_r['x'], max_value)
+    extrap_r['x'] = np.where(extrap_r['x'] >= min_value, extrap_r['x'], min_value)
+    extrap_df = imp.Data_Join(f_index, y).drop(['x'], axis=1)
+    filled = extrap_df['pchip'].fillna(extrap_l['x'])
+    filled = filled.fillna(extrap_r['x'])
+    return filled, d_side, d_slope
+
+
+def difference(result, expected):
+    # Largest relative difference, inf when the NaN of both do not match
+    result = np.asarray(result, dtype = float)
+    expected = np.asarray(expected, dtype = float)
+    if result.shape != expected.shape or (np.isnan(result) != np.isnan(expected)).any(): return np.inf
+    if np.isnan(expected).all(): return 0.0
+    return np.nanmax(np.abs(result - expected) / np.maximum(1, np.abs(expected)))
+
+
+def compare(result, expected):
+    # Differences of the filled prior, slope metadata and lines of two
+    # linear_extrap results on the same dates
+    filled, d_side, d_slope = result
+    filled_b, d_side_b, d_slope_b = expected
+    diff = {'Filled': difference(filled, filled_b.reindex(filled.index))}
+    for key in ['Slope', 'Int', 'Mean']:
+        diff[key] = max(difference(d_slope[side][key], d_slope_b[side][key]) for side in d_slope)
+    diff['Lines'] = max(difference(d_side[side], d_side_b[side].reindex(d_side[side].index)) for side in d_side)
+    return diff
+
+
+if __name__ == '__main__':
+    imp = utils_04_machine_learning.imputation(data_root, figures_root)
+    Well_Data = imp.read_data('Well_Data', data_root)
+    GLDAS_Data = imp.read_data('GLDAS_Data', data_root, lazy = True)
+    Feature_Index = GLDAS_Data[list(GLDAS_Data.keys())[0]].index
+    wells = Well_Data['Data'].columns if n_wells is None else Well_Data['Data'].columns[:n_wells]
+    shift = int(max(windows)/2)
+
+    # Priors of every well, the input of every implementation
+    y_raws, priors = dict(), dict()
+    for well in wells:
+        y_raws[well] = Well_Data['Data'][well].fillna(limit=2, method='ffill')
+        pchip, x_int_index, _ = imp.interpolate(Feature_Index, y_raws[well], well, shift = shift)
+        priors[well] = (x_int_index, pchip.dropna())
+
+    summary = pd.DataFrame(columns = ['Wells', 'Filled', 'Slope', 'Int', 'Mean', 'Lines',
+                                      'baseline (s)', 'linear_extrap (s)', 'well_trends (s)', 'well_trends_batch (s)'])
+    for case, options in cases.items():
+        diffs, times, skipped = [], [0.0, 0.0], 0
+        expected = dict()
+        for well, (x_int_index, y) in priors.items():
+            start = time.perf_counter()
+            try: expected[well] = baseline_extrap(imp, x_int_index, y, shift, reg_perc = reg_perc, **options)
+            except Exception:
+                # Wells too short for the baseline regression
+                skipped += 1
+                continue
+            times[0] += time.perf_counter() - start
+            start = time.perf_counter()
+            result = imp.linear_extrap(x_int_index, y, shift, reg_perc = reg_perc, **options)
+            times[1] += time.perf_counter() - start
+            diffs.append(compare(result, expected[well]))
+
+        # well_trends_batch extrapolates every well at once, without cSlope
+        well_time, batch_time = np.nan, np.nan
+        if not any(key.startswith('cSlope') for key in options):
+            start = time.perf_counter()
+            for well in expected: utils_04_trends.well_trends(imp, Feature_Index, y_raws[well], well, windows,
+                                                              reg_perc = reg_perc, **options)
+            well_time = time.perf_counter() - start
+            start = time.perf_counter()
+            trends = utils_04_trends.well_trends_batch(imp, Feature_Index, {well: y_raws[well] for well in expected}, windows,
+                                                       reg_perc = reg_perc, **options)
+            batch_time = time.perf_counter() - start
+            for well in expected: diffs.append(compare(trends[well][:3], expected[well]))
+
+        worst = pd.DataFrame(diffs).max()
+        summary.loc[case] = [len(expected), *worst[['Filled', 'Slope', 'Int', 'Mean', 'Lines']], *times, well_time, batch_time]
+        if skipped: print(f'{case}: {skipped} wells skipped, the baseline could not fit them')
+
+    pd.set_option('display.width', 250)
+    pd.set_option('display.max_columns', None)
+    print(summary)
+    failed = summary[['Filled', 'Slope', 'Int', 'Mean', 'Lines']].max(axis=1) > tolerance
+    if failed.any(): raise AssertionError(f'Differences above {tolerance}: {failed[failed].index.to_list()}')
+    print(f'Every case matches the baseline within {tolerance}')
@@ -4,33 +4,24 @@ Created on Sat Dec 12 12:32:26 2020
 
 @author: saulg
 """
+import functools
 import pandas as pd
 import numpy as np
 import utils_04_machine_learning
+import utils_04_parallel
+import utils_04_incremental
+import utils_04_checkpoint
+import utils_04_results
+import utils_04_trends
+import utils_04_features
 import warnings
-from scipy.spatial.distance import cdist #Required >1.8.1
-from scipy.stats import pearsonr
 
 from tqdm import tqdm
 
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import KFold
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-
-from tensorflow.random import set_seed
-from tensorflow.keras import callbacks
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.regularizers import L2
-from tensorflow.keras.metrics import RootMeanSquaredError
-
 
 warnings.simplefilter(action='ignore')
 
 np.random.seed(42)
-set_seed(seed=42)
 
 #Data Settings
 aquifer_name = 'Central Valley, CA'
@@ -39,334 +30,285 @@ figures_root = './Figures Imputed'
 val_split = 0.30
 errors = []
 
-# Model Setup
-imp = utils_04_machine_learning.imputation(data_root, figures_root)
-
-# Measured Well Data
-Well_Data = imp.read_pickle('Well_Data_75', data_root)
-PDSI_Data = imp.read_pickle('PDSI_Data', data_root)
-GLDAS_Data = imp.read_pickle('GLDAS_Data', data_root)
-Original_Obs_Points = Well_Data['Data']
-
-
-# Getting Well Dates
-Feature_Index = GLDAS_Data[list(GLDAS_Data.keys())[0]].index
-
-# Importing Metrics and Creating Error DataFrame
-columns = ['Train ME',     'Train RMSE',      'Train MAE',      'Train Points',      'Train r2',
-           'Validation ME','Validation RMSE', 'Validation MAE', 'Validation Points', 'Validation r2',
-           'Test ME',      'Test RMSE',       'Test MAE',       'Test Points',       'Test r2',
-           'Comp R2']
-Summary_Metrics = pd.DataFrame(columns = columns)
-
-# Creating Empty Imputed DataFrame
-Imputed_Data = pd.DataFrame(index=Feature_Index)
-Model_Output = pd.DataFrame(index=Feature_Index)
-Well_Data['Runs'] = {}
-
-# Starting Learning Loop
-loop = tqdm(total = len(Well_Data['Data'].columns), position = 0, leave = False)
-for i, well in enumerate(Well_Data['Data']):
-    try:
-        # Get Well raw readings for single well
-        y_raw = Original_Obs_Points[well].fillna(limit=2, method='ffill')
-        
-        # Get Well readings for single well
-        y_well = pd.DataFrame(Well_Data['Data'][well], index = Feature_Index[:])
-                
-        # Add Dumbies
-        table_dumbies = pd.get_dummies(Feature_Index.month_name())
-        table_dumbies.index = Feature_Index
-        table_dumbies['Months'] = (Feature_Index - Feature_Index[0]).astype(int)
-        table_dumbies['Months'] = table_dumbies['Months']/table_dumbies['Months'][-1]
-        
-        # Create Prior Based on Well Trends
-        windows = [18, 24, 36, 60]
-        shift = int(max(windows)/2)
-        pchip, x_int_index, pchip_int_index  = imp.interpolate(Feature_Index, y_raw, well, shift = shift)
-        prior = imp.linear_extrap(x_int_index, pchip.dropna(), shift, reg_perc = [1.0, 0.5, 0.25, 0.10], 
-                                  max_sd = 6, force_left = 'negative', force_right = 'negative')
-        linear_extrap, extrap_df, extrap_md = prior
-        imp.trend_plot(linear_extrap, extrap_df, extrap_md, y_raw, well)
-        rw = imp.rolling_windows(linear_extrap, windows = windows)
-        rw = rw[rw[rw.columns[-1]].notna()]
-        table_rw = pd.DataFrame(rw, index=rw.index, columns = rw.columns)
-        imp.rw_plot(y_raw, rw, well, save = True, extension = '.png', show=False)
-            
-        # PDSI Selection
-        (well_x, well_y) = Well_Data['Location'].loc[well]
-        well_loc = np.array(([well_x,well_y])).reshape((1,2))
-        df_temp = PDSI_Data['Location'].dropna(axis=0).astype(float)
-        pdsi_dist = pd.DataFrame(cdist(well_loc, df_temp, metric='euclidean'), columns=df_temp.index).T
-        pdsi_key = pdsi_dist[0].idxmin()
-        table_pdsi = PDSI_Data[pdsi_key]
-                
-        # GLDAS Selection
-        df_temp = GLDAS_Data['Location'].dropna(axis=0).astype(float)
-        gldas_dist = pd.DataFrame(cdist(well_loc, df_temp, metric='euclidean'), columns=df_temp.index).T
-        gldas_key = gldas_dist[0].idxmin()
-        table_gldas = GLDAS_Data[gldas_key]
-        table_gldas = table_gldas[['Psurf_f_inst', 
-                            'Wind_f_inst', 
-                            'Qair_f_inst', 
-                            'Qh_tavg', 
-                            'Qsb_acc', 
-                            'PotEvap_tavg', 
-                            'Tair_f_inst', 
-                            'Rainf_tavg',
-                            'SoilMoi0_10cm_inst',
-                            'SoilMoi10_40cm_inst',
-                            'SoilMoi40_100cm_inst',
-                            'SoilMoi100_200cm_inst',
-                            'CanopInt_inst',
-                            'SWE_inst',
-                            'Lwnet_tavg',
-                            'Swnet_tavg',
-                            ]]
-        
-        # Calculate surface water
-        sw_names = ['SoilMoi0_10cm_inst',
-                    'SoilMoi10_40cm_inst',
-                    'SoilMoi40_100cm_inst',
-                    'SoilMoi100_200cm_inst',
-                    'CanopInt_inst',
-                    'SWE_inst']
-        table_sw  = table_gldas[sw_names].sum(axis=1)
-        table_sw.name = 'Surface Water'
-        
-        # Generate additional groundwater features
-        gw_names = ['Qsb_acc',
-                    'SWE_inst',
-                    'Rainf_tavg']
-        table_gwf  = table_gldas[gw_names]
-        table_gwf['ln(QSB_acc)'] = np.log(table_gwf['Qsb_acc'])
-        table_gwf['ln(RW 4 Rainf_tavg)'] = np.log(table_gwf['Rainf_tavg'].rolling(4, min_periods=1).sum())
-        table_gwf['Sum Soil Moist'] = (table_sw - table_gldas['CanopInt_inst'] - table_gldas['SWE_inst']).rolling(3, min_periods=1).sum()
-        table_gwf = table_gwf.drop(gw_names, axis=1)
-        
-        # Temporary merging gldas + PDSI before PCA
-        Feature_Data = imp.Data_Join(table_pdsi, table_gldas).dropna()
-        Feature_Data = imp.Data_Join(Feature_Data, table_rw).dropna()
-        Feature_Data = imp.Data_Join(Feature_Data, table_sw).dropna()
-        Feature_Data = imp.Data_Join(Feature_Data, table_gwf).dropna()
-        Feature_Data = imp.Data_Join(Feature_Data, table_dumbies).dropna()
-        
-        # Joining Features to Well Data
-        Well_set = y_well.join(Feature_Data, how='outer')
-        Well_set = Well_set[Well_set[Well_set.columns[1]].notnull()]
-        Well_set_clean = Well_set.dropna()
-        
-        # Split Data into Training/Validation sets
-        Y, X = imp.Data_Split(Well_set_clean, well)
-        
-        # Run feature scaler on feature data, fs, ws for well scaler
-        only_scale = windows + [table_sw.name] + table_gwf.columns.to_list()
-        no_scale = table_dumbies.columns.to_list()
-        fs = StandardScaler()
-        ws = StandardScaler()
-        
-        # Create number of Folds
-        folds = 5
-        (Y_kfold, X_kfold) = (Y.to_numpy(), X.to_numpy())
-        kfold = KFold(n_splits = folds, shuffle = False)
-        temp_metrics = pd.DataFrame(columns = columns)
-        j = 1
-        n_epochs = []
-        model_run_col = [*range(1, folds+2)]
-        Model_Runs = pd.DataFrame(index=Feature_Index, columns=model_run_col)
-        
-        # Train K-folds grab error metrics average results
-        for train_index, test_index in kfold.split(Y_kfold, X_kfold):
-            x_train, x_test = X.iloc[train_index,:], X.iloc[test_index,:]
-            y_train, y_test = Y.iloc[train_index], Y.iloc[test_index,:]
-            
-            # Create validation and training sets
-            x_train, x_val, y_train, y_val = train_test_split(x_train, y_train, test_size=val_split, random_state=42)
-            
-            x_train, fs = imp.scaler_pipline(x_train, fs, no_scale, train=True)
-        
-            # Transform validation and test sets
-            x_val = imp.scaler_pipline(x_val, fs, no_scale, train=False)
-            x_test = imp.scaler_pipline(x_test, fs, no_scale, train=False)
-            X_pred_temp = imp.scaler_pipline(Feature_Data, fs, no_scale, train=False)
-
-            
-            # Transform Y values
-            y_train = pd.DataFrame(ws.fit_transform(y_train), index = y_train.index, columns = y_train.columns)
-            y_val = pd.DataFrame(ws.transform(y_val), index = y_val.index, columns = y_val.columns)
-            y_test = pd.DataFrame(ws.transform(y_test), index = y_test.index, columns = y_test.columns)
-          
-            # Model Initialization
-            hidden_nodes = 50
-            opt = Adam(learning_rate=0.001)
-            model = Sequential()
-            model.add(Dense(hidden_nodes, input_dim = x_train.shape[1], activation = 'relu', use_bias=True,
-                kernel_initializer='glorot_uniform', kernel_regularizer= L2(l2=0.1)))
-            model.add(Dropout(rate=0.2))
-            model.add(Dense(2*hidden_nodes, input_dim = x_train.shape[1], activation = 'relu', use_bias=True,
-                kernel_initializer='glorot_uniform'))
-            model.add(Dropout(rate=0.2))
-            model.add(Dense(1))
-            model.compile(optimizer = opt, loss='mse', metrics=[RootMeanSquaredError()])
-            
-            # Hyper Paramter Adjustments
-            early_stopping = callbacks.EarlyStopping(
-                                monitor='val_loss', 
-                                patience=5, 
-                                min_delta=0.0, 
-                                restore_best_weights=True)
-            adaptive_lr    = callbacks.ReduceLROnPlateau(
-                                monitor='val_loss', 
-                                factor=0.1, 
-                                min_lr=0)
-            history        = model.fit(
-                                x_train, 
-                                y_train, 
-                                epochs=700, 
-                                validation_data = (x_val, y_val), 
-                                verbose= 0, 
-                                callbacks=[early_stopping, adaptive_lr])
-            
-            # Score and Tracking Metrics
-            y_train     = pd.DataFrame(ws.inverse_transform(y_train), index=y_train.index, 
-                                      columns = ['Y Train']).sort_index(axis=0, ascending=True)
-            y_train_hat = pd.DataFrame(ws.inverse_transform(model.predict(x_train)), index=x_train.index, 
-                                      columns = ['Y Train Hat']).sort_index(axis=0, ascending=True)
-            y_val       = pd.DataFrame(ws.inverse_transform(y_val), index=y_val.index,
-                                       columns = ['Y Val']).sort_index(axis=0, ascending=True)
-            y_val_hat   = pd.DataFrame(ws.inverse_transform(model.predict(x_val)), index=x_val.index,
-                                       columns = ['Y Val Hat']).sort_index(axis=0, ascending=True)
-            
-            train_points, val_points = [len(y_train)], [len(y_val)]
-            
-            train_me    = (sum(y_train_hat.values - y_train.values) / train_points).item()
-            train_rmse  = mean_squared_error(y_train.values, y_train_hat.values, squared=False)
-            train_mae   = mean_absolute_error(y_train.values, y_train_hat.values)
-    
-            val_me      = (sum(y_val_hat.values - y_val.values) / val_points).item()
-            val_rmse    = mean_squared_error(y_val.values, y_val_hat.values, squared=False)
-            val_mae     = mean_absolute_error(y_val.values, y_val_hat.values)
-            
-            train_e      = [train_me, train_rmse, train_mae]
-            val_e        = [val_me, val_rmse, val_mae]
-            
-            test_cols    = ['Test ME', 'Test RMSE', 'Test MAE']
-            
-            train_errors = np.array([train_e + val_e]).reshape((1,6))
-            errors_col   = ['Train ME','Train RMSE', 'Train MAE',
-                            'Validation ME','Validation RMSE', 'Validation MAE']
-            df_metrics   = pd.DataFrame(train_errors, index=([str(j)]), columns = errors_col)
-            
-            df_metrics['Train Points']      = train_points
-            df_metrics['Validation Points'] = val_points
-            df_metrics['Train r2'], _       = pearsonr(y_train.values.flatten(), y_train_hat.values.flatten())
-            df_metrics['Validation r2'], _  = pearsonr(y_val.values.flatten(), y_val_hat.values.flatten())
-            temp_metrics = pd.concat(objs=[temp_metrics, df_metrics])
-            
+# Parallel Settings
+# n_workers is the number of processes training wells, 1 trains every well in
+# this process. worker_threads is the number of TensorFlow threads per worker,
+# keep n_workers * worker_threads at or below the number of cores.
+n_workers = 1
+worker_threads = 1
+# fold_workers trains the folds of a well but the last in that many processes
+# when n_workers is 1, for reruns of a few wells. This process trains the last
+# fold meanwhile and the final model continues from it, optimizer state and
+# learning rate included. Every fold is seeded on its own, results are the
+# same as with fold_workers = 1. More than folds - 1 workers are never busy.
+fold_workers = 1
+seed = 42
+
+# 'keras' trains every well with its own Keras model, 'batched' trains groups
+# of batch_wells wells at once as one stacked network (utils_04_batched), each
+# well keeping its own weights and early stopping.
+trainer = 'keras'
+batch_wells = 64
+
+# Model backend of the per-well trainer (utils_04_models), 'keras' or 'numpy'.
+# numpy trains the same network without importing TensorFlow, the batched
+# trainer always uses TensorFlow.
+backend = 'keras'
+
+# Metric used to find the PDSI and GLDAS cell of each well, 'euclidean' on
+# latitude/longitude or 'haversine' for great circle distances.
+location_metric = 'euclidean'
+
+# Storage Settings
+# Inputs are read from the columnar stores of utils_00_storage when they exist
+# and are not older than their pickles, PDSI and GLDAS cells are only read when
+# a well uses them. columnar also writes the outputs as stores next to the
+# pickles, without it a store left by an earlier run is older and ignored.
+columnar = False
+
+# Checkpoint Settings
+# Finished wells are appended to a checkpoint next to the outputs every
+# checkpoint_every wells. With resume the wells found in the checkpoint are
+# merged again without being trained, a crashed run continues where it
+# stopped. The checkpoint is removed once the outputs are saved.
+resume = False
+checkpoint_every = 10
+
+# Incremental Settings
+# With incremental the previous Well_Data_Imputed is read and only the wells
+# whose raw readings, PDSI/GLDAS cells or training settings changed are
+# retrained, the others keep their previous prediction, runs and metrics.
+incremental = False
+
+# Feature Settings
+# Feature tables are assembled as float32 arrays, 'float64' keeps the full
+# precision of the inputs.
+feature_dtype = 'float32'
+
+# Trend Cache Settings
+# The prior of every well (PCHIP interpolation, linear extrapolation and
+# rolling windows) is cached in trend_cache keyed on the readings and the
+# trend settings, and read again by later runs. The least recently used
+# entries are removed once the cache is over trend_cache_mb, None disables it.
+trend_cache = './Datasets/Trend Cache'
+trend_cache_mb = 1024
+
+# Figure Settings
+# 'now' draws the figures of a well as it is imputed, 'defer' queues them in
+# the figure folder and draws them with render_workers processes once the
+# outputs are saved (04_Render_Figures.py draws the queues of an interrupted
+# run), 'none' makes no figures. figure_wells limits the well figures to a
+# list of wells.
+figures = 'now'
+figure_wells = None
+render_workers = 1
+
+if __name__ == '__main__':
+    # Model Setup
+    imp = utils_04_machine_learning.imputation(data_root, figures_root, figures, figure_wells)
+    Trend_Cache = None if trend_cache is None else utils_04_trends.trend_cache(trend_cache, trend_cache_mb)
+    Previous = None
+    if incremental:
+        try: Previous = imp.read_data('Well_Data_Imputed', data_root)
+        except FileNotFoundError: print('No previous Well_Data_Imputed, every well is trained')
+
+    # Measured Well Data
+    Well_Data = imp.read_data('Well_Data_75', data_root)
+    PDSI_Data = imp.read_data('PDSI_Data', data_root, lazy = True)
+    GLDAS_Data = imp.read_data('GLDAS_Data', data_root, lazy = True)
+    Original_Obs_Points = Well_Data['Data']
+
+
+    # Getting Well Dates
+    Feature_Index = GLDAS_Data[list(GLDAS_Data.keys())[0]].index
+
+    # Nearest PDSI and GLDAS cell of every well, found in one query per dataset
+    pdsi_index = utils_04_machine_learning.spatial_index(PDSI_Data['Location'], metric = location_metric)
+    gldas_index = utils_04_machine_learning.spatial_index(GLDAS_Data['Location'], metric = location_metric)
+    pdsi_keys = pdsi_index.nearest(Well_Data['Location'])
+    gldas_keys = gldas_index.nearest(Well_Data['Location'])
+
+    # Features of the PDSI and GLDAS cells and the dummies, built once
+    Features = utils_04_features.feature_builder(Feature_Index, PDSI_Data, GLDAS_Data, dtype = feature_dtype)
+
+    # Importing Metrics and Creating Error DataFrame
+    columns = ['Train ME',     'Train RMSE',      'Train MAE',      'Train Points',      'Train r2',
+               'Validation ME','Validation RMSE', 'Validation MAE', 'Validation Points', 'Validation r2',
+               'Test ME',      'Test RMSE',       'Test MAE',       'Test Points',       'Test r2',
+               'Comp R2']
+
+    # Imputed data, model output and metrics of every well, preallocated on
+    # the prediction dates and the dates of the readings
+    Results = utils_04_results.results(Feature_Index.union(Well_Data['Data'].index), Well_Data['Data'].columns,
+                                       columns, index_rows = Feature_Index)
+    Well_Data['Runs'] = {}
+
+    # Wells finished by a previous run of this script
+    Checkpoint = utils_04_checkpoint.checkpoint('Well_Data_Imputed', data_root, every = checkpoint_every)
+    if resume: Finished = Checkpoint.read()
+    else:
+        Finished = dict()
+        Checkpoint.remove()
+    Fingerprints = pd.Series(dtype = object)
+    settings = {'val_split': val_split, 'folds': 5, 'l2': 0.1, 'seed': seed, 'backend': backend, 'trainer': trainer,
+                'features': feature_dtype}
+    fold_pool = None
+    if n_workers == 1 and fold_workers > 1:
+        fold_pool = utils_04_parallel.well_pool(fold_workers, worker_threads, tensorflow = backend == 'keras')
+
+    # Feature Preparation Loop, builds the training task of every well
+    tasks = []
+    reused = []
+    well_sets = dict()
+    pending = []
+    for i, well in enumerate(Well_Data['Data']):
+        try:
+            # Get Well raw readings for single well
+            y_raw = Original_Obs_Points[well].fillna(limit=2, method='ffill')
+
+            # Get Well readings for single well
+            y_well = pd.DataFrame(Well_Data['Data'][well], index = Feature_Index[:])
+
+            # Wells trained on the same inputs keep their previous results,
+            # wells in the checkpoint are already finished
+            Fingerprints[well] = utils_04_incremental.fingerprint(Original_Obs_Points[well],
+                                    PDSI_Data[pdsi_keys[well]], GLDAS_Data[gldas_keys[well]], settings)
+            if well in Finished:
+                reused.append(({'i': i, 'well': well}, Finished[well]))
+                well_sets[well] = (y_raw, y_well)
+                continue
+            if utils_04_incremental.unchanged(Previous, well, Fingerprints[well]):
+                reused.append(({'i': i, 'well': well}, utils_04_incremental.reuse_result(Previous, well)))
+                well_sets[well] = (y_raw, y_well)
+                continue
+            pending.append((i, well, y_raw, y_well))
+        except Exception as e:
+            errors.append((i, e))
+            imp.log_errors(errors, 'errors', data_root)
+
+    # Create Prior Based on Well Trends, the priors of every well to train
+    # are extrapolated together
+    windows = [18, 24, 36, 60]
+    Trends = utils_04_trends.well_trends_batch(imp, Feature_Index, {well: y_raw for _, well, y_raw, _ in pending}, windows,
+                                               reg_perc = [1.0, 0.5, 0.25, 0.10], max_sd = 6, force_left = 'negative',
+                                               force_right = 'negative', cache = Trend_Cache)
+    for i, well, y_raw, y_well in pending:
+        try:
+            prior = Trends[well]
+            if isinstance(prior, Exception): raise prior
+            linear_extrap, extrap_df, extrap_md, rw = prior
+            imp.trend_plot(linear_extrap, extrap_df, extrap_md, y_raw, well)
+            rw = rw[rw[rw.columns[-1]].notna()]
+            table_rw = pd.DataFrame(rw, index=rw.index, columns = rw.columns)
+            imp.rw_plot(y_raw, rw, well, save = True, extension = '.png', show=False)
+
+            # PDSI, GLDAS, rolling windows, surface water, groundwater features
+            # and dummies in one table
+            Feature_Data = Features.well_features(pdsi_keys[well], gldas_keys[well], table_rw)
+
+            # Joining Features to Well Data
+            Well_set = y_well.join(Feature_Data, how='outer')
+            Well_set = Well_set[Well_set[Well_set.columns[1]].notnull()]
+            Well_set_clean = Well_set.dropna()
+
+            # Split Data into Training/Validation sets
+            Y, X = imp.Data_Split(Well_set_clean, well)
+
+            # Everything the well needs to be trained independently
+            tasks.append({'i':            i,
+                          'well':         well,
+                          'X':            X,
+                          'Y':            Y,
+                          'Feature_Data': Feature_Data,
+                          'y_well':       y_well,
+                          'index':        Feature_Index,
+                          'no_scale':     Features.no_scale,
+                          'columns':      columns,
+                          'folds':        settings['folds'],
+                          'val_split':    val_split,
+                          'l2':           settings['l2'],
+                          'me_sign':      1,
+                          'refit':        True,
+                          'seed':         seed,
+                          'backend':      backend,
+                          'data_root':    data_root,
+                          'figures_root': figures_root,
+                          'figures':      figures,
+                          'figure_wells': figure_wells})
+            well_sets[well] = (y_raw, y_well)
+        except Exception as e:
+            errors.append((i, e))
+            imp.log_errors(errors, 'errors', data_root)
+
+    # Starting Learning Loop, wells are merged in the order they were prepared
+    pool = utils_04_parallel.well_pool(n_workers, worker_threads, tensorflow = trainer == 'batched' or backend == 'keras')
+    loop = tqdm(total = len(Well_Data['Data'].columns), position = 0, leave = False)
+    if trainer == 'batched':
+        import utils_04_batched
+        trained = pool.run_batched(utils_04_batched.kfold_train_batched, tasks, batch_wells)
+    else: trained = pool.run(functools.partial(utils_04_parallel.kfold_train, fold_pool = fold_pool), tasks)
+    for task, result in utils_04_incremental.in_order(trained, reused):
+        i, well = task['i'], task['well']
+        try:
+            if isinstance(result, Exception): raise result
+            y_raw, y_well = well_sets.pop(well)
+            Results.add_metrics(well, result['Metrics'])
+            Metrics = result['Metrics'].loc[well]
+
             # Model Prediction
-            Prediction_temp = pd.DataFrame(
-                            ws.inverse_transform(model.predict(X_pred_temp)), 
-                            index=X_pred_temp.index, columns = ['Prediction'])
-            
-            # append prediction to model runs
-            Model_Runs[j] = Prediction_temp.astype(float)
-            
-            # Test Sets and Plots
-            try:
-                y_test       = pd.DataFrame(ws.inverse_transform(y_test), index=y_test.index,
-                                   columns = ['Y Test']).sort_index(axis=0, ascending=True)
-                y_test_hat   = pd.DataFrame(ws.inverse_transform(model.predict(x_test)), index=y_test.index, 
-                                   columns = ['Y Test Hat']).sort_index(axis=0, ascending=True)
-                test_points  = len(y_test)
-                test_me      = (sum(y_test_hat.values - y_test.values) / test_points).item()
-                test_rmse    = mean_squared_error(y_test.values, y_test_hat.values, squared=False)
-                test_mae     = mean_absolute_error(y_test.values, y_test_hat.values)
-                            
-                test_errors  = np.array([test_me, test_rmse, test_mae]).reshape((1,3))
-                test_cols    = ['Test ME', 'Test RMSE', 'Test MAE']
-                test_metrics = pd.DataFrame(test_errors,
-                                            index = [str(j)], 
-                                            columns = test_cols)
-                test_metrics['Test Points'] = test_points
-                test_metrics['Test r2'], _  = pearsonr(y_test.values.flatten(), y_test_hat.values.flatten())
-                temp_metrics.loc[str(j), test_metrics.columns] = test_metrics.loc[str(j)]
-                plot_kfolds = True
-                imp.prediction_kfold(Prediction_temp['Prediction'], 
-                                              y_well.drop(y_test.index, axis=0),  
-                                              y_test, 
-                                              str(well) +"_kfold_" + str(j), 
-                                              temp_metrics.loc[str(j)], 
-                                              error_on = True,
-                                              plot = plot_kfolds)
-
-            except: 
-                temp_metrics.loc[str(j), ['Test ME','Test RMSE', 'Test MAE']] = np.NAN
-                temp_metrics.loc[str(j), 'Test Points'] = 0 
-                temp_metrics.loc[str(j),'Test r2'] = np.NAN
-                imp.prediction_kfold(Prediction_temp['Prediction'], 
-                                        y_well.drop(y_test.index, axis=0),
-                                        y_test, 
-                                        str(well) +"_kfold_" + str(j),
-                                        plot = plot_kfolds)
-            j += 1
-            n_epochs.append(len(history.history['loss']))
-            
-        epochs = int(sum(n_epochs)/folds)
-        
-        # Reset feature scalers
-        X, fs  = imp.scaler_pipline(X, fs, no_scale, train=True)
-        X_pred = imp.scaler_pipline(Feature_Data, fs, no_scale, train=False)
-        Y = pd.DataFrame(ws.fit_transform(Y), index = Y.index, columns = Y.columns)
-        
-        # Retrain Model with number of epochs
-        history = model.fit(X, Y, epochs = epochs, verbose = 0)
-        metrics_avg = pd.DataFrame(temp_metrics.mean(), columns=[well]).transpose()
-        Summary_Metrics = pd.concat(objs=[Summary_Metrics, metrics_avg])
-        
-        # Model Prediction
-        Prediction = pd.DataFrame(
-                        ws.inverse_transform(model.predict(X_pred)), 
-                        index=X_pred.index, columns = [well])
-        Model_Runs[folds+1] = Prediction.astype(float)
-        Well_Data['Runs'][well] = Model_Runs
-        spread = pd.DataFrame(index = Prediction.index, columns = ['mean', 'std'])
-        spread['mean'] = Model_Runs.mean(axis=1)
-        spread['std'] = Model_Runs.std(axis=1)
-        Comp_R2    = r2_score(
-                        ws.inverse_transform(Y.values.reshape(-1,1)), 
-                        ws.inverse_transform(model.predict(X)))
-        Summary_Metrics.loc[well,'Comp R2'] = Comp_R2
-
-        # Data Filling
-        Gap_time_series = pd.DataFrame(Well_Data['Data'][well], index = Prediction.index)
-        Filled_time_series = Gap_time_series[well].fillna(Prediction[well])
-        if y_raw.dropna().index[-1] > Prediction.index[-1]:
-            Filled_time_series = pd.concat([Filled_time_series, y_raw.dropna()], join='outer', axis=1)
-            Filled_time_series = Filled_time_series.iloc[:,0]
-            Filled_time_series = Filled_time_series.fillna(y_raw)
-        Imputed_Data = pd.concat([Imputed_Data, Filled_time_series], join='outer', axis=1)
-        Model_Output = pd.concat([Model_Output, Prediction], join='outer', axis=1)
-                
-        # Model Plots
-        imp.prediction_vs_test_kfold(Prediction[well], y_well, str(well), Summary_Metrics.loc[well], error_on = True)
-        imp.raw_observation_vs_prediction(Prediction[well], y_raw, str(well), aquifer_name, Summary_Metrics.loc[well], error_on = True, test=True)
-        imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well) + '_Confidence Interval', aquifer_name, 
-                spread, ci = 3, conf_interval = True, metrics = Summary_Metrics.loc[well], error_on = True, test=True) 
-        imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well), aquifer_name, 
-                metrics = Summary_Metrics.loc[well], error_on = True, test=True) 
-        imp.residual_plot(Prediction.index, Prediction[well], y_well.index, y_well, well)
-        imp.Model_Training_Metrics_plot(history.history, str(well))
-        loop.update(1)
-    except Exception as e:
-        errors.append((i, e))
-        imp.log_errors(errors, 'errors', data_root)
-
-loop.close()
-Well_Data['Data_Smooth'] = imp.smooth(Imputed_Data.loc[Prediction.index], Well_Data['Data'], window = 18)
-Well_Data['Data'] = Imputed_Data.loc[Prediction.index]
-Well_Data['Raw_Output'] = Model_Output.loc[Prediction.index]
-Well_Data['Metrics'] = Summary_Metrics
-Summary_Metrics.to_csv(data_root  + '/' + '06_Metrics.csv', index=True)
-imp.Save_Pickle(Well_Data, 'Well_Data_Imputed', data_root)
-imp.Save_Pickle(Imputed_Data, 'Well_Data_Imputed_Raw', data_root)
-imp.Aquifer_Plot(Well_Data['Data'])
\ No newline at end of file
+            Prediction = result['Prediction']
+            Model_Runs = result['Model_Runs']
+            Well_Data['Runs'][well] = Model_Runs
+            spread = pd.DataFrame(index = Prediction.index, columns = ['mean', 'std'])
+            spread['mean'] = Model_Runs.mean(axis=1)
+            spread['std'] = Model_Runs.std(axis=1)
+
+            # Data Filling
+            Gap_time_series = pd.DataFrame(Well_Data['Data'][well], index = Prediction.index)
+            Filled_time_series = Gap_time_series[well].fillna(Prediction[well])
+            if y_raw.dropna().index[-1] > Prediction.index[-1]:
+                Filled_time_series = pd.concat([Filled_time_series, y_raw.dropna()], join='outer', axis=1)
+                Filled_time_series = Filled_time_series.iloc[:,0]
+                Filled_time_series = Filled_time_series.fillna(y_raw)
+            Results.add_series('Imputed', well, Filled_time_series)
+            Results.add_series('Output', well, Prediction)
+            if not result.get('reused', False): Checkpoint.add(well, result)
+
+            # Model Plots, reused wells keep their figures
+            if not result.get('reused', False):
+                imp.prediction_vs_test_kfold(Prediction[well], y_well, str(well), Metrics, error_on = True)
+                imp.raw_observation_vs_prediction(Prediction[well], y_raw, str(well), aquifer_name, Metrics, error_on = True, test=True)
+                imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well) + '_Confidence Interval', aquifer_name,
+                        spread, ci = 3, conf_interval = True, metrics = Metrics, error_on = True, test=True)
+                imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well), aquifer_name,
+                        metrics = Metrics, error_on = True, test=True)
+                imp.residual_plot(Prediction.index, Prediction[well], y_well.index, y_well, well)
+                imp.Model_Training_Metrics_plot(result['history'], str(well))
+            loop.update(1)
+        except Exception as e:
+            errors.append((i, e))
+            imp.log_errors(errors, 'errors', data_root)
+
+    loop.close()
+    pool.close()
+    if fold_pool is not None: fold_pool.close()
+    Checkpoint.flush()
+    Imputed_Data = Results.frame('Imputed')
+    Model_Output = Results.frame('Output')
+    Summary_Metrics = Results.metrics_frame()
+    Well_Data['Data_Smooth'] = imp.smooth(Imputed_Data.loc[Prediction.index], Well_Data['Data'], window = 18)
+    Well_Data['Data'] = Imputed_Data.loc[Prediction.index]
+    Well_Data['Raw_Output'] = Model_Output.loc[Prediction.index]
+    Well_Data['Metrics'] = Summary_Metrics
+    Well_Data['Fingerprints'] = Fingerprints
+    print(f'{len(reused)}/{len(Fingerprints)} wells reused from the previous run')
+    Summary_Metrics.to_csv(data_root  + '/' + '06_Metrics.csv', index=True)
+    imp.Save_Pickle(Well_Data, 'Well_Data_Imputed', data_root)
+    imp.Save_Pickle(Imputed_Data, 'Well_Data_Imputed_Raw', data_root)
+    if columnar:
+        imp.Save_Store(Well_Data, 'Well_Data_Imputed', data_root)
+        imp.Save_Store(Imputed_Data, 'Well_Data_Imputed_Raw', data_root)
+    Checkpoint.remove()
+    if Trend_Cache is not None: Trend_Cache.evict()
+    imp.Aquifer_Plot(Well_Data['Data'])
+    if figures == 'defer': utils_04_machine_learning.render_figures(figures_root, render_workers)
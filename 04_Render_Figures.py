@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:15:00 2026
+
+@author: saulg
+"""
+import os
+import time
+import utils_04_machine_learning
+
+# Draws the figures queued by 04_Imputation_Remote.py and
+# 05_Imputation_Iteration.py with figures = 'defer'. The imputation scripts
+# draw their queues when they finish, this script draws the queues left by an
+# interrupted run or by a run whose figures are only wanted later.
+
+# Figure folders with queues
+figures_roots = ['./Figures Imputed',
+                 './Wells Imputed_iteration_1',
+                 './Wells Imputed_iteration_2',
+                 './Wells Imputed_iteration_3']
+
+# Number of processes drawing figures
+n_workers = 4
+
+if __name__ == '__main__':
+    for figures_root in figures_roots:
+        if not os.path.isdir(figures_root): continue
+        start = time.perf_counter()
+        rendered = utils_04_machine_learning.render_figures(figures_root, n_workers)
+        print(f'{figures_root}: {rendered} figures in {time.perf_counter() - start:.1f} s')
@@ -5,33 +5,24 @@ Created on Sat Dec 12 12:32:26 2020
 @author: saulg
 """
 
+import os
+import time
+import functools
 import pandas as pd #1.3.5
 import numpy as np
-import math
 import utils_04_machine_learning
+import utils_04_parallel
+import utils_05_iteration
+import utils_04_incremental
+import utils_04_checkpoint
+import utils_04_results
+import utils_04_trends
 import warnings
-from scipy.stats import pearsonr
-from scipy.spatial.distance import cdist
 from tqdm import tqdm
 
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import KFold
-from sklearn.feature_selection import r_regression #1.1.2
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-
-from tensorflow.random import set_seed
-from tensorflow.keras import callbacks
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.regularizers import L2
-from tensorflow.keras.metrics import RootMeanSquaredError
-
 warnings.simplefilter(action='ignore')
 
 np.random.seed(42)
-set_seed(seed=42)
 
 #Data Settings
 aquifer_name = 'Beryl-Enterprise, Utah'
@@ -42,341 +33,282 @@ weight_cor = 0.70
 weight_dist = 1 - weight_cor
 min_features = 5
 # Must be set to a multiple of 0.10
-feature_thresh = 0.6 
+feature_thresh = 0.6
 iterations = 3
 errors = []
 
-for iteration in range(0, iterations):
-    # Print Iteration, Set up Figures, Create model class
-    print(f'Starting iteration: {iteration+1}/{iterations}.')
-    figures_root = f'./Wells Imputed_iteration_{iteration+1}'
-    imp = utils_04_machine_learning.imputation(data_root, figures_root)
-
-
-    # Measured Well Data
-    Well_Data = imp.read_pickle('Well_Data_100', data_root)
-    Original_Obs_Points = Well_Data['Data']
-    if iteration == 0: Well_Data_Pretrained = imp.read_pickle('Well_Data_Imputed', data_root)
-    else: Well_Data_Pretrained = imp.read_pickle(f'Well_Data_Imputed_iteration_{iteration-1}', data_root)
-    
-    # Replace data from 3 std, perhaps look at replace where change between points
-    temp_data = Well_Data_Pretrained['Data']
-    temp_columns = Well_Data_Pretrained['Data'].columns.to_list()
-    Well_Data_Pretrained['Data'] = imp.hampel_filter(temp_data, Well_Data['Data'], max_sd = 3, window = 36)
-
-    # Getting Well Dates
-    Feature_Index = Well_Data_Pretrained['Data'].index
-    
-    # Importing Metrics and Creating Error DataFrame
-    columns = ['Train ME',     'Train RMSE',      'Train MAE',      'Train Points',      'Train r2',
-               'Validation ME','Validation RMSE', 'Validation MAE', 'Validation Points', 'Validation r2',
-               'Test ME',      'Test RMSE',       'Test MAE',       'Test Points',       'Test r2',
-               'Comp R2']
-    Summary_Metrics = pd.DataFrame(columns = columns)
-    
-    # Feature importance Tracker
-    Feature_Importance = pd.DataFrame()
-    
-    # Creating Empty Imputed DataFrame
-    Imputed_Data = pd.DataFrame(index=Feature_Index)
-    Model_Output = pd.DataFrame(index=Feature_Index)
-    Feature_Correlation = pd.DataFrame(index=Well_Data['Data'].columns, columns = ['FI', 'WI'])
-    Well_Data['Runs'] = {}
-    
-    loop = tqdm(total = len(Well_Data['Data'].columns), position = 0, leave = False)
-    for i, well in enumerate(Well_Data['Data']):
-        try:
-            # Get Well raw readings for single well
-            y_raw = Original_Obs_Points[well].fillna(limit=2, method='ffill')
-            
-            # Get Well readings for single well
-            y_well = pd.DataFrame(Well_Data['Data'][well], index = Feature_Index[:])
-
-            # Add Dumbies
-            table_dumbies = pd.get_dummies(Feature_Index.month_name())
-            table_dumbies.index = Feature_Index
-            table_dumbies['Months'] = (Feature_Index - Feature_Index[0]).astype(int)
-            table_dumbies['Months'] = table_dumbies['Months']/table_dumbies['Months'][-1]
-            
-            # Create Well Trend
-            windows = [24]
-            shift = int(max(windows)/2)
-            pchip, x_int_index, pchip_int_index  = imp.interpolate(Feature_Index, y_raw, well, shift = shift)
-            temp = imp.linear_extrap(x_int_index, pchip.dropna(), shift, reg_perc = [1.0, 0.5, 0.25, 0.10], 
-                                     max_sd = 6, force_left = False, force_right = False)
-            linear_extrap, extrap_df, extrap_md = temp
-            imp.trend_plot(linear_extrap, extrap_df, extrap_md, y_raw, well)
-            rw = imp.rolling_windows(linear_extrap, windows = windows)
-            rw = rw[rw[rw.columns[-1]].notna()]
-            table_rw = pd.DataFrame(rw, index=rw.index, columns = rw.columns)
-            imp.rw_plot(y_raw, rw, well, save = True, extension = '.png', show=False)
-
-            # Load Pretrained Data Drop current Column
-            Feature_Data = Well_Data_Pretrained['Data'].drop(well, axis=1)
-            
-            # Calculate Pearsons Correlation Value
-            fs_data = imp.Data_Join(Feature_Data, y_well).dropna()
-            pearsons_r = r_regression(fs_data.drop(well, axis=1), fs_data[well])
-            pearsons_r = pd.DataFrame(pearsons_r.T, index=Feature_Data.columns, columns=['r'])
-            
-            # Calculate normalized distance
-            (well_x, well_y) = Well_Data['Location'].loc[well]
-            well_loc = np.array(([well_x,well_y])).reshape((1,2))
-            feature_loc = Well_Data['Location'].drop(well, axis=0)
-            dist = pd.DataFrame(cdist(well_loc, feature_loc, metric='euclidean'), columns=feature_loc.index, index=['dist']).T
-            dist = 1 - (dist/dist.max())
-            
-            # Calculate weighed score
-            fs_data = imp.Data_Join(pearsons_r, dist).dropna()
-            fs_data['w_score'] = fs_data['r'] * weight_cor + fs_data['dist'] * weight_dist
-            fs_data.sort_values(by=['w_score'], axis=0, ascending=False, inplace=True)
-                        
-            # Calculate number of Features
-            fs_name = fs_data.index.to_list()
-            fs_data_score = fs_data.loc[fs_name[0:min_features]]['w_score'].mean()
-            fs_data_score = math.floor(fs_data_score*10)/10
-            if feature_thresh - fs_data_score <= 0: add_features = 0
-            else: add_features = int((feature_thresh - fs_data_score) * 10)
-            num_features = min_features + add_features
-            
-            # Select Features
-            fs_name = fs_name[0:num_features]
-            Feature_Data = Feature_Data[fs_name]
-            
-            # Calculate correlation metrics
-            feature_temp = pd.concat([y_well, Feature_Data], axis=1, join='outer')
-            imp.feature_plot(feature_temp, Well_Data['Data'], well)
-            Feature_Correlation = imp.feature_correlation(Feature_Correlation, feature_temp, Well_Data['Data'], fs_data.loc[fs_name])
-            
-            # Join Best features with Rolling Windows
-            Feature_Data = imp.Data_Join(Feature_Data, table_rw).dropna()
-            
-            # Joining Features to Well Data
-            Well_set = y_well.join(Feature_Data, how='outer')
-            Well_set = Well_set[Well_set[Well_set.columns[1]].notnull()]
-            Well_set_clean = Well_set.dropna()
-            
-            # Feature Split
-            Y, X = imp.Data_Split(Well_set_clean, well)
-            
-            # Initialize scalers
-            fs = StandardScaler()
-            ws = StandardScaler()
-            
-            # Create number of Folds
-            folds = 5
-            (Y_kfold, X_kfold) = (Y.to_numpy(), X.to_numpy())
-            kfold = KFold(n_splits = folds, shuffle = False)
-            temp_metrics = pd.DataFrame(columns = columns)
-            j = 1
-            n_epochs = []
-            
-            # Create Dataframe to store all predictions from folds and final prediction 
-            model_run_col = [*range(1, folds+2)]
-            Model_Runs = pd.DataFrame(index=Feature_Index, columns=model_run_col)
-            
-            # Train K-folds grab error metrics average results
-            for train_index, test_index in kfold.split(Y_kfold, X_kfold):
-                x_train, x_test = X.iloc[train_index,:], X.iloc[test_index,:]
-                y_train, y_test = Y.iloc[train_index], Y.iloc[test_index,:]
-                
-                # Create validation and training sets
-                x_train, x_val, y_train, y_val = train_test_split(x_train, y_train, test_size=val_split, random_state=42)
-                
-                # Transform feature data
-                x_train = pd.DataFrame(fs.fit_transform(x_train), index = x_train.index, columns = x_train.columns)
-                x_train = imp.Data_Join(x_train, table_dumbies, method='inner')
-                        
-                # Feature scaling and joining of dumbie variables for validation, test, prediction
-                x_val = pd.DataFrame(fs.transform(x_val), index = x_val.index, columns = x_val.columns)
-                x_val = imp.Data_Join(x_val, table_dumbies, method='inner')
-                            
-                x_test = pd.DataFrame(fs.transform(x_test), index = x_test.index, columns = x_test.columns)
-                x_test = imp.Data_Join(x_test, table_dumbies, method='inner')
-                
-                X_pred_temp = pd.DataFrame(fs.transform(Feature_Data), index = Feature_Data.index, columns = Feature_Data.columns)
-                X_pred_temp = imp.Data_Join(X_pred_temp, table_dumbies, method='inner')
-                
-                # Transform Y values
-                y_train = pd.DataFrame(ws.fit_transform(y_train), index = y_train.index, columns = y_train.columns)
-                y_val = pd.DataFrame(ws.transform(y_val), index = y_val.index, columns = y_val.columns)
-                y_test = pd.DataFrame(ws.transform(y_test), index = y_test.index, columns = y_test.columns)
-                                
-                # Model Initialization
-                hidden_nodes = 50
-                opt = Adam(learning_rate=0.001)
-                model = Sequential()
-                model.add(Dense(hidden_nodes, input_dim = x_train.shape[1], activation = 'relu', use_bias=True,
-                    kernel_initializer='glorot_uniform', kernel_regularizer= L2(l2=0.01)))
-                model.add(Dropout(rate=0.2))
-                model.add(Dense(2*hidden_nodes, input_dim = x_train.shape[1], activation = 'relu', use_bias=True,
-                    kernel_initializer='glorot_uniform'))
-                model.add(Dropout(rate=0.2))
-                model.add(Dense(1))
-                model.compile(optimizer = opt, loss='mse', metrics=[RootMeanSquaredError()])
-                
-                # Hyper Paramter Adjustments
-                early_stopping = callbacks.EarlyStopping(
-                                    monitor='val_loss', 
-                                    patience=5, 
-                                    min_delta=0.0, 
-                                    restore_best_weights=True)
-                adaptive_lr    = callbacks.ReduceLROnPlateau(
-                                    monitor='val_loss', 
-                                    factor=0.1, 
-                                    min_lr=0)
-                history        = model.fit(
-                                    x_train, 
-                                    y_train, 
-                                    epochs=700, 
-                                    validation_data = (x_val, y_val), 
-                                    verbose= 0, 
-                                    callbacks=[early_stopping, adaptive_lr])
-                
-                # Score and Tracking Metrics
-                y_train     = pd.DataFrame(ws.inverse_transform(y_train), index=y_train.index, 
-                                          columns = ['Y Train']).sort_index(axis=0, ascending=True)
-                y_train_hat = pd.DataFrame(ws.inverse_transform(model.predict(x_train)), index=x_train.index, 
-                                          columns = ['Y Train Hat']).sort_index(axis=0, ascending=True)
-                y_val       = pd.DataFrame(ws.inverse_transform(y_val), index=y_val.index,
-                                           columns = ['Y Val']).sort_index(axis=0, ascending=True)
-                y_val_hat   = pd.DataFrame(ws.inverse_transform(model.predict(x_val)), index=x_val.index,
-                                           columns = ['Y Val Hat']).sort_index(axis=0, ascending=True)
-                
-                train_points, val_points = [len(y_train)], [len(y_val)]
-                
-                train_me    = (sum(y_train.values - y_train_hat.values) / train_points).item()
-                train_rmse  = mean_squared_error(y_train.values, y_train_hat.values, squared=False)
-                train_mae   = mean_absolute_error(y_train.values, y_train_hat.values)
-        
-                val_me      = (sum(y_val.values - y_val_hat.values) / val_points).item()
-                val_rmse    = mean_squared_error(y_val.values, y_val_hat.values, squared=False)
-                val_mae     = mean_absolute_error(y_val.values, y_val_hat.values)
-                
-                train_e      = [train_me, train_rmse, train_mae]
-                val_e        = [val_me, val_rmse, val_mae]
-                
-                test_cols    = ['Test ME', 'Test RMSE', 'Test MAE']
-                
-                train_errors = np.array([train_e + val_e]).reshape((1,6))
-                errors_col   = ['Train ME','Train RMSE', 'Train MAE',
-                                'Validation ME','Validation RMSE', 'Validation MAE']
-                df_metrics   = pd.DataFrame(train_errors, index=([str(j)]), columns = errors_col)
-                
-                df_metrics['Train Points']      = train_points
-                df_metrics['Validation Points'] = val_points
-                df_metrics['Train r2'], _       = pearsonr(y_train.values.flatten(), y_train_hat.values.flatten())
-                df_metrics['Validation r2'], _  = pearsonr(y_val.values.flatten(), y_val_hat.values.flatten())
-                temp_metrics = pd.concat(objs=[temp_metrics, df_metrics])
-                
+# Parallel Settings
+# n_workers is the number of processes imputing wells within an iteration, 1
+# imputes every well in this process. worker_threads is the number of
+# TensorFlow threads per worker.
+n_workers = 1
+worker_threads = 1
+# fold_workers trains the folds of a well but the last in that many processes
+# when n_workers is 1. This process trains the last fold meanwhile and the
+# final model continues from it, optimizer state and learning rate included.
+# Every fold is seeded on its own, results are the same as with
+# fold_workers = 1.
+fold_workers = 1
+seed = 42
+
+# 'keras' trains every well with its own Keras model, 'batched' trains groups
+# of batch_wells wells at once as one stacked network (utils_04_batched), each
+# well keeping its own weights and early stopping.
+trainer = 'keras'
+batch_wells = 64
+
+# Model backend of the per-well trainer (utils_04_models), 'keras' or 'numpy'.
+# numpy trains the same network without importing TensorFlow, the batched
+# trainer always uses TensorFlow.
+backend = 'keras'
+
+# Warm Start Settings
+# The models of every well and fold (weights, scalers and features) are saved
+# as Well_Models_iteration_n. With warm_start the next iteration starts a well
+# from its previous weights when its features did not change, otherwise the
+# well is trained from a new initialization.
+warm_start = True
+
+# Checkpoint Settings
+# Finished wells are appended to a checkpoint of every iteration every
+# checkpoint_every wells. With resume the wells found in the checkpoints are
+# merged again without being trained, a crashed run continues where it
+# stopped. The checkpoints are removed once every iteration is saved.
+resume = False
+checkpoint_every = 10
+
+# Incremental Settings
+# With incremental every iteration reads its output of the previous run and
+# only retrains the wells whose readings, selected feature wells or settings
+# changed, or whose feature wells moved more than tolerance (in the units of
+# the readings) in the pretrained matrix. The others keep their previous
+# prediction, runs, metrics and model.
+incremental = False
+tolerance = 0.01
+
+# Metric of the well to well distance, 'euclidean' on latitude/longitude or
+# 'haversine' for great circle distances.
+location_metric = 'euclidean'
+
+# Storage Settings
+# Inputs are read from the columnar stores of utils_00_storage when they exist
+# and are not older than their pickles. columnar also writes the outputs as
+# stores next to the pickles, without it a store left by an earlier run is
+# older and ignored.
+columnar = False
+
+# Trend Cache Settings
+# The prior of every well (PCHIP interpolation, linear extrapolation and
+# rolling windows) only depends on its readings, it is cached in trend_cache
+# and read by every iteration and later runs instead of being fitted again.
+# The least recently used entries are removed once the cache is over
+# trend_cache_mb, None disables it.
+trend_cache = './Datasets/Trend Cache'
+trend_cache_mb = 1024
+
+# Figure Settings
+# 'now' draws the figures of a well as it is imputed, 'defer' queues them in
+# the figure folder and draws them with render_workers processes once the
+# outputs are saved (04_Render_Figures.py draws the queues of an interrupted
+# run), 'none' makes no figures. figure_wells limits the well figures to a
+# list of wells.
+figures = 'now'
+figure_wells = None
+render_workers = 1
+
+if __name__ == '__main__':
+    Trend_Cache = None if trend_cache is None else utils_04_trends.trend_cache(trend_cache, trend_cache_mb)
+    fold_pool = None
+    if n_workers == 1 and fold_workers > 1:
+        fold_pool = utils_04_parallel.well_pool(fold_workers, worker_threads, tensorflow = backend == 'keras')
+    for iteration in range(0, iterations):
+        # Print Iteration, Set up Figures, Create model class
+        print(f'Starting iteration: {iteration+1}/{iterations}.')
+        iteration_start = time.perf_counter()
+        figures_root = f'./Wells Imputed_iteration_{iteration+1}'
+        imp = utils_04_machine_learning.imputation(data_root, figures_root, figures, figure_wells)
+
+
+        # Measured Well Data
+        Well_Data = imp.read_data('Well_Data_100', data_root)
+        Original_Obs_Points = Well_Data['Data']
+        if iteration == 0: Well_Data_Pretrained = imp.read_data('Well_Data_Imputed', data_root)
+        else: Well_Data_Pretrained = imp.read_data(f'Well_Data_Imputed_iteration_{iteration-1}', data_root)
+
+        # Replace data from 3 std, perhaps look at replace where change between points
+        temp_data = Well_Data_Pretrained['Data']
+        Well_Data_Pretrained['Data'] = imp.hampel_filter(temp_data, Well_Data['Data'], max_sd = 3, window = 36)
+
+        # Getting Well Dates
+        Feature_Index = Well_Data_Pretrained['Data'].index
+
+        # Importing Metrics and Creating Error DataFrame
+        columns = ['Train ME',     'Train RMSE',      'Train MAE',      'Train Points',      'Train r2',
+                   'Validation ME','Validation RMSE', 'Validation MAE', 'Validation Points', 'Validation r2',
+                   'Test ME',      'Test RMSE',       'Test MAE',       'Test Points',       'Test r2',
+                   'Comp R2']
+
+        # Models of the previous iteration and the training log of this one
+        Well_Models = dict()
+        Previous_Models = dict()
+        previous_name = f'Well_Models_iteration_{iteration-1}'
+        if warm_start and iteration > 0 and os.path.isfile(data_root + previous_name + '.pickle'):
+            Previous_Models = imp.read_pickle(previous_name, data_root)
+        Training_Rows = dict()
+
+        # Output and models of this iteration in the previous run
+        Previous, Previous_Run_Models = None, dict()
+        if incremental:
+            try: Previous = imp.read_data(f'Well_Data_Imputed_iteration_{iteration}', data_root)
+            except FileNotFoundError: print(f'No previous Well_Data_Imputed_iteration_{iteration}, every well is trained')
+            if os.path.isfile(data_root + f'Well_Models_iteration_{iteration}.pickle'):
+                Previous_Run_Models = imp.read_pickle(f'Well_Models_iteration_{iteration}', data_root)
+
+        # Imputed data, model output and metrics of every well, preallocated
+        # on the prediction dates and the dates of the readings
+        Results = utils_04_results.results(Feature_Index.union(Well_Data['Data'].index), Well_Data['Data'].columns,
+                                           columns, index_rows = Feature_Index)
+        Feature_Correlation = pd.DataFrame(index=Well_Data['Data'].columns, columns = ['FI', 'WI'])
+        Well_Data['Runs'] = {}
+
+        # Wells of one iteration only read the pretrained matrix, which is
+        # shared with the workers instead of being sent with every well
+        shared = {'Pretrained': Well_Data_Pretrained['Data'],
+                  'Data':       Well_Data['Data']}
+
+        # Feature selection of every well from one correlation and distance matrix
+        well_index = utils_04_machine_learning.spatial_index(Well_Data['Location'], metric = location_metric)
+        selection = utils_05_iteration.feature_selection(Well_Data_Pretrained['Data'], Well_Data['Data'],
+                        Well_Data['Location'], well_index, weight_cor, weight_dist,
+                        min_features = min_features, feature_thresh = feature_thresh)
+        # Wells finished by a previous run of this script
+        Checkpoint = utils_04_checkpoint.checkpoint(f'Well_Data_Imputed_iteration_{iteration}', data_root, every = checkpoint_every)
+        if resume: Finished = Checkpoint.read()
+        else:
+            Finished = dict()
+            Checkpoint.remove()
+        tasks = []
+        reused = []
+        Fingerprints = pd.Series(dtype = object)
+        settings = {'windows': [24], 'folds': 5, 'val_split': val_split, 'l2': 0.01, 'seed': seed,
+                    'backend': backend, 'trainer': trainer}
+        for i, well in enumerate(Well_Data['Data']):
+            task = {'i':              i,
+                    'well':           well,
+                    'selection':      selection.get(well),
+                    'columns':        columns,
+                    'warm_start':     Previous_Models.get(well),
+                    'data_root':      data_root,
+                    'figures_root':   figures_root,
+                    'figures':        figures,
+                    'figure_wells':   figure_wells,
+                    'trend_cache':    Trend_Cache}
+            task.update(settings)
+
+            # Wells trained on the same inputs keep their previous results,
+            # wells in the checkpoint are already finished
+            features = [] if task['selection'] is None else task['selection'].index.to_list()
+            Fingerprints[well] = utils_04_incremental.fingerprint(Well_Data['Data'][well], features, settings)
+            if well in Finished: reused.append((task, Finished[well]))
+            elif (utils_04_incremental.unchanged(Previous, well, Fingerprints[well]) and
+                not utils_04_incremental.inputs_moved(Well_Data_Pretrained['Data'], Previous, features, tolerance)):
+                reused.append((task, utils_04_incremental.reuse_result(Previous, well, Previous_Run_Models)))
+            else: tasks.append(task)
+        utils_05_iteration.iteration_trends(imp, Feature_Index, Well_Data['Data'], tasks, cache = Trend_Cache)
+        pool = utils_04_parallel.well_pool(n_workers, worker_threads, shared = shared,
+                                           tensorflow = trainer == 'batched' or backend == 'keras')
+
+        # Results are gathered in well order
+        loop = tqdm(total = len(Well_Data['Data'].columns), position = 0, leave = False)
+        if trainer == 'batched': trained = pool.run_batched(utils_05_iteration.iteration_batch, tasks, batch_wells)
+        else: trained = pool.run(functools.partial(utils_05_iteration.iteration_well, fold_pool = fold_pool), tasks)
+        for task, result in utils_04_incremental.in_order(trained, reused):
+            i, well = task['i'], task['well']
+            try:
+                if isinstance(result, Exception): raise result
+                # Get Well raw readings for single well
+                y_raw = Original_Obs_Points[well].fillna(limit=2, method='ffill')
+
+                # Get Well readings for single well
+                y_well = pd.DataFrame(Well_Data['Data'][well], index = Feature_Index[:])
+
+                # Merge correlation metrics, feature columns are added as needed
+                for col in result['Feature_Correlation'].columns:
+                    if col not in Feature_Correlation.columns: Feature_Correlation[col] = np.nan
+                Feature_Correlation.loc[well, result['Feature_Correlation'].columns] = result['Feature_Correlation'].loc[well]
+                Results.add_metrics(well, result['Metrics'])
+                Metrics = result['Metrics'].loc[well]
+
                 # Model Prediction
-                Prediction_temp = pd.DataFrame(
-                            ws.inverse_transform(model.predict(X_pred_temp)), 
-                            index=X_pred_temp.index, columns = ['Prediction'])
-                
-                # append prediction to model runs
-                Model_Runs[j] = Prediction_temp.astype(float)
-                
-                # Test Sets and Plots
-                try:
-                    y_test       = pd.DataFrame(ws.inverse_transform(y_test), index=y_test.index,
-                                       columns = ['Y Test']).sort_index(axis=0, ascending=True)
-                    y_test_hat   = pd.DataFrame(ws.inverse_transform(model.predict(x_test)), index=y_test.index, 
-                                       columns = ['Y Test Hat']).sort_index(axis=0, ascending=True)
-                    test_points  = len(y_test)
-                    test_me      = (sum(y_test.values - y_test_hat.values) / test_points).item()
-                    test_rmse    = mean_squared_error(y_test.values, y_test_hat.values, squared=False)
-                    test_mae     = mean_absolute_error(y_test.values, y_test_hat.values)
-                                
-                    test_errors  = np.array([test_me, test_rmse, test_mae]).reshape((1,3))
-                    test_cols    = ['Test ME', 'Test RMSE', 'Test MAE']
-                    test_metrics = pd.DataFrame(test_errors,
-                                                index = [str(j)], 
-                                                columns = test_cols)
-                    test_metrics['Test Points'] = test_points
-                    test_metrics['Test r2'], _  = pearsonr(y_test.values.flatten(), y_test_hat.values.flatten())
-                    temp_metrics.loc[str(j), test_metrics.columns] = test_metrics.loc[str(j)]
-                    plot_kfolds = True
-                    imp.prediction_kfold(Prediction_temp['Prediction'], 
-                                              y_well.drop(y_test.index, axis=0),  
-                                              y_test, 
-                                              str(well) +"_kfold_" + str(j), 
-                                              temp_metrics.loc[str(j)], 
-                                              error_on = True,
-                                              plot = plot_kfolds)
-    
-                except: 
-                    temp_metrics.loc[str(j), ['Test ME','Test RMSE', 'Test MAE']] = np.NAN
-                    temp_metrics.loc[str(j), 'Test Points'] = 0 
-                    temp_metrics.loc[str(j),'Test r2'] = np.NAN
-                    imp.prediction_kfold(Prediction_temp['Prediction'], 
-                                        y_well.drop(y_test.index, axis=0),
-                                        y_test, 
-                                        str(well) +"_kfold_" + str(j),
-                                        plot = plot_kfolds)
-                j += 1
-                n_epochs.append(len(history.history['loss']))
-            
-            epochs = int(sum(n_epochs)/folds)
-            
-            X = pd.DataFrame(fs.transform(X), index = X.index, columns = X.columns)
-            X = imp.Data_Join(X, table_dumbies, method='inner')
-            
-            X_pred = pd.DataFrame(fs.transform(Feature_Data), index = Feature_Data.index, columns = Feature_Data.columns)
-            X_pred = imp.Data_Join(X_pred, table_dumbies, method='inner')
-            
-            Y = pd.DataFrame(ws.transform(Y), index = Y.index, columns = Y.columns)
-                    
-            # Retrain Model with number of epochs
-            history = model.fit(X, Y, epochs = epochs, verbose = 0)
-            metrics_avg = pd.DataFrame(temp_metrics.mean(), columns=[well]).transpose()
-            Summary_Metrics = pd.concat(objs=[Summary_Metrics, metrics_avg])
-
-            # Model Prediction
-            Prediction = pd.DataFrame(
-                            ws.inverse_transform(model.predict(X_pred)), 
-                            index=X_pred.index, columns = [well])
-            Model_Runs[folds+1] = Prediction.astype(float)
-            Well_Data['Runs'][well] = Model_Runs
-            spread = pd.DataFrame(index = Prediction.index, columns = ['mean', 'std'])
-            spread['mean'] = Model_Runs.mean(axis=1)
-            spread['std'] = Model_Runs.std(axis=1)
-            Comp_R2    = r2_score(
-                            ws.inverse_transform(Y.values.reshape(-1,1)), 
-                            ws.inverse_transform(model.predict(X)))
-            Summary_Metrics.loc[well,'Comp R2'] = Comp_R2
-            
-            # Data Filling
-            Gap_time_series = pd.DataFrame(Well_Data['Data'][well], index = Prediction.index)
-            Filled_time_series = Gap_time_series[well].fillna(Prediction[well])
-            if y_raw.dropna().index[-1] > Prediction.index[-1]:
-                Filled_time_series = pd.concat([Filled_time_series, y_raw.dropna()], join='outer', axis=1)
-                Filled_time_series = Filled_time_series.iloc[:,0]
-                Filled_time_series = Filled_time_series.fillna(y_raw)
-            Imputed_Data = pd.concat([Imputed_Data, Filled_time_series], join='outer', axis=1)
-            Model_Output = pd.concat([Model_Output, Prediction], join='outer', axis=1)
-    
-            # Model Plots
-            imp.prediction_vs_test_kfold(Prediction[well], y_well, str(well), Summary_Metrics.loc[well], error_on = True)
-            imp.raw_observation_vs_prediction(Filled_time_series, y_raw, str(well), aquifer_name, Summary_Metrics.loc[well], error_on = True, test=True) 
-            imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well) + '_Confidence Interval', aquifer_name, 
-                spread, ci = 3, conf_interval = True, metrics = Summary_Metrics.loc[well], error_on = True, test=True)
-            imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well), aquifer_name, 
-                metrics = Summary_Metrics.loc[well], error_on = True, test=True) 
-            imp.residual_plot(Prediction.index, Prediction[well], y_well.index, y_well, well)
-            imp.Model_Training_Metrics_plot(history.history, str(well))
-            loop.update(1)
-        except Exception as e:
-            errors.append((i, e))
-            imp.log_errors(errors, 'errors', data_root)
-    
-    loop.close()
-    Well_Data['Data_Smooth'] = imp.smooth(Imputed_Data.loc[Prediction.index], Well_Data['Data'], window = 18)
-    Well_Data['Feature Correlation'] = Feature_Correlation   
-    Well_Data['Data'] = Imputed_Data.loc[Prediction.index]
-    Well_Data['Raw_Output'] = Model_Output.loc[Prediction.index]
-    Well_Data['Metrics'] = Summary_Metrics
-    Summary_Metrics.to_csv(data_root  + '/' + f'06-{iteration}_Metrics.csv', index=True)
-    imp.Save_Pickle(Well_Data, f'Well_Data_Imputed_iteration_{iteration}', data_root)
-    imp.Save_Pickle(Imputed_Data, f'Well_Data_Imputed_Raw_{iteration}', data_root)
-    imp.Aquifer_Plot(Well_Data['Data']) 
\ No newline at end of file
+                Prediction = result['Prediction']
+                Model_Runs = result['Model_Runs']
+                Well_Data['Runs'][well] = Model_Runs
+                if result['Model'] is not None: Well_Models[well] = result['Model']
+                Training_Rows[well] = [result['warm_start'], result.get('reused', False), sum(result['fold_epochs']),
+                                          result['epochs'], result['seconds']]
+                spread = pd.DataFrame(index = Prediction.index, columns = ['mean', 'std'])
+                spread['mean'] = Model_Runs.mean(axis=1)
+                spread['std'] = Model_Runs.std(axis=1)
+
+                # Data Filling
+                Gap_time_series = pd.DataFrame(Well_Data['Data'][well], index = Prediction.index)
+                Filled_time_series = Gap_time_series[well].fillna(Prediction[well])
+                if y_raw.dropna().index[-1] > Prediction.index[-1]:
+                    Filled_time_series = pd.concat([Filled_time_series, y_raw.dropna()], join='outer', axis=1)
+                    Filled_time_series = Filled_time_series.iloc[:,0]
+                    Filled_time_series = Filled_time_series.fillna(y_raw)
+                Results.add_series('Imputed', well, Filled_time_series)
+                Results.add_series('Output', well, Prediction)
+                if not result.get('reused', False): Checkpoint.add(well, result)
+
+                # Model Plots, reused wells keep their figures
+                if not result.get('reused', False):
+                    imp.prediction_vs_test_kfold(Prediction[well], y_well, str(well), Metrics, error_on = True)
+                    imp.raw_observation_vs_prediction(Filled_time_series, y_raw, str(well), aquifer_name, Metrics, error_on = True, test=True)
+                    imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well) + '_Confidence Interval', aquifer_name,
+                        spread, ci = 3, conf_interval = True, metrics = Metrics, error_on = True, test=True)
+                    imp.raw_observation_vs_filled(Filled_time_series, y_raw, str(well), aquifer_name,
+                        metrics = Metrics, error_on = True, test=True)
+                    imp.residual_plot(Prediction.index, Prediction[well], y_well.index, y_well, well)
+                    imp.Model_Training_Metrics_plot(result['history'], str(well))
+                loop.update(1)
+            except Exception as e:
+                errors.append((i, e))
+                imp.log_errors(errors, 'errors', data_root)
+
+        loop.close()
+        pool.close()
+        Checkpoint.flush()
+        Imputed_Data = Results.frame('Imputed')
+        Model_Output = Results.frame('Output')
+        Summary_Metrics = Results.metrics_frame()
+        Training_Log = pd.DataFrame.from_dict(Training_Rows, orient = 'index',
+                                              columns = ['Warm Start', 'Reused', 'Fold Epochs', 'Epochs', 'Seconds'])
+        Well_Data['Data_Smooth'] = imp.smooth(Imputed_Data.loc[Prediction.index], Well_Data['Data'], window = 18)
+        Well_Data['Feature Correlation'] = Feature_Correlation
+        Well_Data['Data'] = Imputed_Data.loc[Prediction.index]
+        Well_Data['Raw_Output'] = Model_Output.loc[Prediction.index]
+        Well_Data['Metrics'] = Summary_Metrics
+        Well_Data['Training'] = Training_Log
+        Well_Data['Fingerprints'] = Fingerprints
+        Well_Data['Inputs'] = Well_Data_Pretrained['Data']
+        Summary_Metrics.to_csv(data_root  + '/' + f'06-{iteration}_Metrics.csv', index=True)
+        Training_Log.to_csv(data_root  + '/' + f'06-{iteration}_Training.csv', index=True)
+        print(f'Iteration {iteration+1}: {int(Training_Log["Warm Start"].sum())}/{len(Training_Log)} wells warm started, '
+              f'{len(reused)} reused, '
+              f'{int(Training_Log["Fold Epochs"].sum() + Training_Log["Epochs"].sum())} epochs, '
+              f'{time.perf_counter() - iteration_start:.0f} s')
+        imp.Save_Pickle(Well_Data, f'Well_Data_Imputed_iteration_{iteration}', data_root)
+        imp.Save_Pickle(Well_Models, f'Well_Models_iteration_{iteration}', data_root)
+        imp.Save_Pickle(Imputed_Data, f'Well_Data_Imputed_Raw_{iteration}', data_root)
+        if columnar:
+            imp.Save_Store(Well_Data, f'Well_Data_Imputed_iteration_{iteration}', data_root)
+            imp.Save_Store(Imputed_Data, f'Well_Data_Imputed_Raw_{iteration}', data_root)
+        imp.Aquifer_Plot(Well_Data['Data'])
+        if Trend_Cache is not None: Trend_Cache.evict()
+    if fold_pool is not None: fold_pool.close()
+
+    # Every iteration is saved
+    for iteration in range(0, iterations):
+        utils_04_checkpoint.checkpoint(f'Well_Data_Imputed_iteration_{iteration}', data_root).remove()
+        if figures == 'defer': utils_04_machine_learning.render_figures(f'./Wells Imputed_iteration_{iteration+1}', render_workers)
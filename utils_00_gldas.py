@@ -10,6 +10,10 @@ import numpy as np
 import datetime as dt
 import pandas as pd
 import pickle
+import os
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 
@@ -42,33 +46,205 @@ def Date_Index_Creation(date_start:str, week_buffer=16):
     return dates
 
 
-root = r'C:\Users\saulg\OneDrive\Dissertation\Well Imputation\Master Code\Satellite Data Prep'
-file_list = 'subset_GLDAS_NOAH025_M_2.0_20210628_013227.txt'
-data_root = r'C:\Users\saulg\Desktop\Remote_Data\GLDAS'
-file_list = Data_List(root, file_list, data_root)
-variables_list = r'C:\Users\saulg\OneDrive\Dissertation\Well Imputation\Master Code\Satellite Data Prep\variables_list.txt'
-variables_list = Variable_List(variables_list)
-#dates = Date_Index_Creation('1948-01-01')
-# probably should be changed to datetime offset based on length of file list
-dates = pd.date_range(start='1948-01-01', end='2021-11-01', freq='MS')
-
-dic = {v:[] for v in variables_list}
-cell_name = ['Cell_' + str(i) for i in range(600*1440)]
-print('Break Point')
-debug = False
-for i, variable in enumerate(variables_list):
-    for j, file_name in tqdm(enumerate(file_list)):
-        ds = nc.Dataset(file_name)
-        temp_var = ds.variables[variable]
-        array = temp_var[:]
-        array = np.squeeze(array, axis = 0).data
-        array = np.flip(array, axis = 0)
-        dic[variable].append(array)
-    temp_array1 = np.array(dic[variable])
-    temp_df = pd.DataFrame(temp_array1.reshape(temp_array1.shape[0], 600*1440), index = dates[0:len(file_list)], columns = cell_name[:])
-    print(variable + ': ' + str(i+1) + '/' + str(len(variables_list)))
-    if debug: break
-    Save_Pickle(temp_df, r'C:\Users\saulg\Desktop\Remote_Data\Tabular GLDAS', str(variable))
-    del temp_array1
-    del temp_df
-    del dic[variable]
\ No newline at end of file
+def Land_Mask(file_name, variable):
+    # Flat index of the cells holding data in a GLDAS file, ocean cells are
+    # masked in every month so one file is enough.
+    ds = nc.Dataset(file_name)
+    array = np.squeeze(ds.variables[variable][:], axis = 0)
+    ds.close()
+    mask = np.flip(np.ma.getmaskarray(array), axis = 0)
+    return np.flatnonzero(~mask)
+
+def Region_Index(file_name, bounds, buffer = None):
+    # Turns the bounds of utils_netCDF.Shape_Boundary (min lon, min lat,
+    # max lon, max lat) into the lat and lon slices of the file holding the
+    # cell centroids inside the bounds padded by buffer, half a cell by default.
+    ds = nc.Dataset(file_name)
+    lat = ds.variables['lat'][:].data
+    lon = ds.variables['lon'][:].data
+    ds.close()
+    if buffer is None: buffer = (abs(lon[1] - lon[0])/2, abs(lat[1] - lat[0])/2)
+    rows = np.flatnonzero((lat > bounds[1] - buffer[1]) & (lat < bounds[3] + buffer[1]))
+    cols = np.flatnonzero((lon > bounds[0] - buffer[0]) & (lon < bounds[2] + buffer[0]))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+def Region_Cells(region, shape = (600, 1440)):
+    # Global cell numbers (Cell_i, rows counted from the north) of a region
+    # of the file, in the order of the flipped region.
+    rows = np.arange(shape[0] - region[0].stop, shape[0] - region[0].start)
+    cols = np.arange(region[1].start, region[1].stop)
+    return (rows[:,np.newaxis] * shape[1] + cols).reshape(-1)
+
+def Region_Position(cells, region, shape = (600, 1440)):
+    # Position of global cells within the flipped and flattened region
+    rows = cells // shape[1] - (shape[0] - region[0].stop)
+    cols = cells % shape[1] - region[1].start
+    return rows * (region[1].stop - region[1].start) + cols
+
+def Create_Store(store_path, variable, dates, cells, dtype, time_chunk = 12, cell_chunk = 4096):
+    # netCDF of one variable with dimensions time x cell. Chunks hold
+    # time_chunk months of cell_chunk cells and are compressed. cell holds the
+    # global cell number (Cell_i), done flags the months already written.
+    ds = nc.Dataset(store_path, 'w')
+    ds.createDimension('time', len(dates))
+    ds.createDimension('cell', len(cells))
+    time = ds.createVariable('time', 'f8', ('time',))
+    time.units = 'days since 1900-01-01'
+    time[:] = nc.date2num(dates.to_pydatetime(), time.units)
+    ds.createVariable('cell', 'i4', ('cell',))[:] = cells
+    ds.createVariable('done', 'i1', ('time',), fill_value = 0)
+    ds.createVariable(variable, dtype, ('time', 'cell'), zlib = True, complevel = 4,
+                      chunksizes = (min(time_chunk, len(dates)), min(cell_chunk, len(cells))))
+    return ds
+
+def Open_Stores(file_list, variables, dates, save_root, land = None, region = None, time_chunk = 12, cell_chunk = 4096):
+    # Creates the store of every variable that has none yet, holding the
+    # cells of the region (whole grid if None) that are on land (all if None).
+    # Returns the cells and time chunk of the stores and the months already
+    # done in all of them.
+    dates = dates[0:len(file_list)]
+    first = nc.Dataset(file_list[0])
+    cells = np.arange(600*1440) if region is None else Region_Cells(region)
+    if land is not None: cells = cells[np.isin(cells, land)]
+    for variable in variables:
+        store_path = save_root + '/' + variable + '.nc'
+        if os.path.isfile(store_path): continue
+        Create_Store(store_path, variable, dates, cells, first.variables[variable].dtype, time_chunk, cell_chunk).close()
+    first.close()
+    # A resumed store must hold the months and cells of this run, otherwise
+    # blocks would be written into the wrong rows or columns
+    done = np.ones(len(file_list), dtype = bool)
+    for variable in variables:
+        ds = nc.Dataset(save_root + '/' + variable + '.nc')
+        if len(ds.dimensions['time']) != len(file_list):
+            raise ValueError(f'The {variable} store holds {len(ds.dimensions["time"])} months, the file list {len(file_list)}')
+        time = ds.variables['time']
+        stored = pd.DatetimeIndex(nc.num2date(time[:], time.units, only_use_cftime_datetimes = False,
+                                              only_use_python_datetimes = True))
+        if not stored.equals(pd.DatetimeIndex(dates)):
+            raise ValueError(f'The {variable} store holds other dates than this run, remove it or use its dates')
+        if not np.array_equal(ds.variables['cell'][:], cells):
+            raise ValueError(f'The {variable} store holds other cells than this run, the bounds or land mask changed')
+        done &= ds.variables['done'][:].filled(0).astype(bool)
+        chunk = ds.variables[variable].chunking()[0]
+        ds.close()
+    return cells, chunk, done
+
+_locks = None
+
+def _init_extract(locks):
+    global _locks
+    _locks = locks
+
+def Extract_Block(task):
+    # Reads a block of monthly files, each file is opened once for all
+    # variables and only the region hyperslab is read, then writes the time
+    # slice of the block into every store. position holds the store cells
+    # within the flipped region. A netCDF file cannot take concurrent
+    # writers, so each store has its own lock shared by the workers: a worker
+    # writes the stores no other worker is writing first and only waits when
+    # every store it has left is busy.
+    file_block, start, variables, region, position, save_root = task
+    buffer = dict()
+    for j, file_name in enumerate(file_block):
+        file = nc.Dataset(file_name)
+        for variable in variables:
+            array = np.squeeze(file.variables[variable][:, region[0], region[1]], axis = 0).data
+            if j == 0: buffer[variable] = np.empty((len(file_block), len(position)), dtype = array.dtype)
+            buffer[variable][j] = np.flip(array, axis = 0).reshape(-1)[position]
+        file.close()
+    stop = start + len(file_block)
+    pending = list(variables)
+    while pending:
+        variable = next((v for v in pending if _locks[v].acquire(False)), None)
+        if variable is None:
+            variable = pending[0]
+            _locks[variable].acquire()
+        try:
+            ds = nc.Dataset(save_root + '/' + variable + '.nc', 'a')
+            ds.variables[variable][start:stop] = buffer[variable]
+            ds.variables['done'][start:stop] = 1
+            ds.close()
+        finally: _locks[variable].release()
+        pending.remove(variable)
+    return start
+
+def Extract_Variables(file_list, variables, dates, save_root, land = None, bounds = None,
+                      time_chunk = 12, cell_chunk = 4096, n_workers = 1):
+    # Writes every variable of every monthly file into save_root/variable.nc.
+    # Files are read in blocks of time_chunk months, one chunk of the stores,
+    # and the blocks are spread over n_workers processes, each writing the
+    # time slice of its block into the stores. With bounds only
+    # the hyperslab around them is read and stored. Memory per worker is
+    # fixed at time_chunk x cells x variables. Blocks already done in every
+    # store are skipped, so a rerun resumes.
+    region = None if bounds is None else Region_Index(file_list[0], bounds)
+    cells, chunk, done = Open_Stores(file_list, variables, dates, save_root, land, region, time_chunk, cell_chunk)
+    if region is None: region, position = (slice(None), slice(None)), cells
+    else: position = Region_Position(cells, region)
+    tasks = [(file_list[start:start + chunk], start, variables, region, position, save_root)
+             for start in range(0, len(file_list), chunk) if not done[start:start + chunk].all()]
+    if n_workers > 1:
+        context = mp.get_context('spawn')
+        locks = {variable: context.Lock() for variable in variables}
+        with ProcessPoolExecutor(n_workers, mp_context = context, initializer = _init_extract,
+                                 initargs = (locks,)) as pool:
+            for _ in tqdm(pool.map(Extract_Block, tasks), total = len(tasks)): pass
+    else:
+        _init_extract({variable: threading.Lock() for variable in variables})
+        for task in tqdm(tasks): Extract_Block(task)
+
+def Stream_Variable(file_list, variable, dates, save_root, land = None, bounds = None, time_chunk = 12, cell_chunk = 4096):
+    # Single variable of Extract_Variables, kept for the per variable runs.
+    Extract_Variables(file_list, [variable], dates, save_root, land, bounds, time_chunk, cell_chunk)
+
+def Read_Store(store_path, variable, cells = None):
+    # Reads cells (global cell numbers) of a store into the tabular layout of
+    # the pickles, time x Cell_i. Cells left out by the land mask are -9999
+    # like the ocean cells of the full grid.
+    ds = nc.Dataset(store_path)
+    time = ds.variables['time']
+    dates = pd.DatetimeIndex(nc.num2date(time[:], time.units, only_use_cftime_datetimes = False,
+                                         only_use_python_datetimes = True))
+    store_cells = ds.variables['cell'][:]
+    cells = store_cells if cells is None else np.asarray(cells)
+    columns = pd.Index(store_cells).get_indexer(cells)
+    found = np.flatnonzero(columns >= 0)
+    order = np.argsort(columns[found])
+    values = np.full((len(dates), len(cells)), -9999, dtype = ds.variables[variable].dtype)
+    if len(found):
+        values[:, found[order]] = np.ma.filled(ds.variables[variable][:, columns[found][order]], -9999)
+    ds.close()
+    return pd.DataFrame(values, index = dates, columns = ['Cell_' + str(i) for i in cells])
+
+
+if __name__ == '__main__':
+    root = r'C:\Users\saulg\OneDrive\Dissertation\Well Imputation\Master Code\Satellite Data Prep'
+    file_list = 'subset_GLDAS_NOAH025_M_2.0_20210628_013227.txt'
+    data_root = r'C:\Users\saulg\Desktop\Remote_Data\GLDAS'
+    file_list = Data_List(root, file_list, data_root)
+    variables_list = r'C:\Users\saulg\OneDrive\Dissertation\Well Imputation\Master Code\Satellite Data Prep\variables_list.txt'
+    variables_list = Variable_List(variables_list)
+    #dates = Date_Index_Creation('1948-01-01')
+    # probably should be changed to datetime offset based on length of file list
+    dates = pd.date_range(start='1948-01-01', end='2021-11-01', freq='MS')
+
+    # Each variable is streamed into its own chunked store, land_only keeps the
+    # cells with data only. Every file is opened once for all variables and
+    # the files are split between n_workers processes. Rerunning resumes from
+    # the last completed chunk.
+    # shape_location limits the stores to the cells around an aquifer, None
+    # keeps the whole globe.
+    save_root = r'C:\Users\saulg\Desktop\Remote_Data\Tabular GLDAS'
+    shape_location = None
+    land_only = True
+    time_chunk = 12
+    n_workers = 4
+    bounds = None
+    if shape_location is not None:
+        import utils_01_satellite_data as usd
+        bounds = usd.utils_netCDF(save_root).Shape_Boundary(shape_location)
+    land = Land_Mask(file_list[0], variables_list[0]) if land_only else None
+    print('Break Point')
+    Extract_Variables(file_list, variables_list, dates, save_root, land = land, bounds = bounds,
+                      time_chunk = time_chunk, n_workers = n_workers)
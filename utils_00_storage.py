@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:20:00 2026
+
+@author: saulg
+"""
+import os
+import glob
+import pickle
+import numpy as np
+import pandas as pd
+import h5py
+
+
+# Columnar store for the dictionaries the scripts pass between each other
+# (Well_Data, GLDAS_Data, PDSI_Data, ...). Every DataFrame of the dictionary is
+# a group of one HDF5 file holding:
+#   values:  numeric array stored column by column (columns x time), contiguous
+#            so a single well or cell variable is one block on disk and the
+#            array can be memory mapped
+#   index:   datetime index as int64 nanoseconds with its frequency, integers
+#            or strings
+#   columns: column names as strings
+# Nested dictionaries such as Runs become nested groups. Tables that are not
+# numeric (Feature Correlation) are kept as a pickled blob inside the file.
+
+
+def save_store(Data, name:str, path:str):
+    # A single table is written under the key Data and returned as is
+    with h5py.File(os.path.join(path, name + '.h5'), 'w', track_order = True) as store:
+        if not isinstance(Data, dict):
+            store.attrs['single'] = True
+            Data = {'Data': Data}
+        for key in Data: _write(store, str(key), Data[key])
+
+def _write(store, key, obj):
+    if isinstance(obj, dict):
+        group = store.create_group(key, track_order = True)
+        group.attrs['kind'] = 'dict'
+        for sub_key in obj: _write(group, str(sub_key), obj[sub_key])
+    elif isinstance(obj, (pd.DataFrame, pd.Series)) and _numeric(obj):
+        df = obj.to_frame() if isinstance(obj, pd.Series) else obj
+        group = store.create_group(key, track_order = True)
+        group.attrs['kind'] = 'series' if isinstance(obj, pd.Series) else 'frame'
+        if isinstance(obj, pd.Series) and obj.name is not None: group.attrs['name'] = str(obj.name)
+        group.attrs['dtypes'] = [str(dtype) for dtype in df.dtypes]
+        values = df.values.astype(np.result_type(*df.dtypes)) if len(df.columns) else df.values.astype(float)
+        group.create_dataset('values', data = np.ascontiguousarray(values.T))
+        _write_index(group, 'index', df.index)
+        _write_index(group, 'columns', df.columns)
+    else:
+        group = store.create_group(key, track_order = True)
+        group.attrs['kind'] = 'pickle'
+        group.create_dataset('blob', data = np.void(pickle.dumps(obj, protocol = 3)))
+
+def _numeric(df):
+    dtypes = [df.dtype] if isinstance(df, pd.Series) else df.dtypes
+    return all(np.issubdtype(dtype, np.number) or dtype == bool for dtype in dtypes)
+
+def _write_index(group, name, index):
+    if isinstance(index, pd.DatetimeIndex):
+        group.create_dataset(name, data = index.values.astype('datetime64[ns]').astype(np.int64))
+        group[name].attrs['kind'] = 'datetime'
+        if index.freqstr is not None: group[name].attrs['freq'] = index.freqstr
+    elif pd.api.types.is_integer_dtype(index):
+        group.create_dataset(name, data = index.values.astype(np.int64))
+        group[name].attrs['kind'] = 'int'
+    else:
+        group.create_dataset(name, data = np.array(index.astype(str), dtype = h5py.string_dtype()))
+        group[name].attrs['kind'] = 'str'
+
+def _read_index(dataset):
+    if dataset.attrs['kind'] == 'datetime':
+        return pd.DatetimeIndex(dataset[:].astype('datetime64[ns]'), freq = dataset.attrs.get('freq', None))
+    if dataset.attrs['kind'] == 'int':
+        index = pd.Index(dataset[:])
+        if len(index) and (np.diff(index.values) == 1).all(): index = pd.RangeIndex(index[0], index[-1] + 1)
+        return index
+    return pd.Index(dataset.asstr()[:], dtype = object)
+
+
+class columnar_store():
+    # Read only view of a store written by save_store. Behaves like the
+    # dictionary it was written from, Data['Location'] or Data['Cell_10'] only
+    # reads that table, and read() projects columns and a time range:
+    #   store = columnar_store('GLDAS_Data', './Datasets/')
+    #   store.read('Cell_10', columns = ['Tair_f_inst'], start = '2000-01-01')
+    #   store.read('Runs/373338113431502')
+    # With mmap the values are memory mapped and only the selected columns are
+    # paged in, otherwise the selection is read from the file.
+    def __init__(self, name:str, path:str, mmap = True):
+        self.file = os.path.join(path, name + '.h5')
+        self.mmap = mmap
+        self.store = h5py.File(self.file, 'r')
+
+    def keys(self):
+        return list(self.store.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return str(key) in self.store
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def items(self):
+        return [(key, self.read(key)) for key in self.keys()]
+
+    def index(self, key):
+        return _read_index(self.store[key]['index'])
+
+    def columns(self, key):
+        return _read_index(self.store[key]['columns'])
+
+    def read(self, key, columns = None, start = None, end = None):
+        group = self.store[str(key)]
+        kind = group.attrs['kind']
+        if kind == 'dict':
+            return {sub_key: self.read(str(key) + '/' + sub_key, columns, start, end) for sub_key in group}
+        if kind == 'pickle':
+            return pickle.loads(group['blob'][()].tobytes())
+
+        index = _read_index(group['index'])
+        names = _read_index(group['columns'])
+        if columns is None: col_idx = np.arange(len(names))
+        else:
+            col_idx = names.get_indexer(list(columns))
+            if (col_idx < 0).any(): raise KeyError(f'{list(np.array(columns)[col_idx < 0])} not in {key}')
+        rows = slice(None if start is None else index.searchsorted(pd.Timestamp(start), side='left'),
+                     None if end is None else index.searchsorted(pd.Timestamp(end), side='right'))
+        values = self._values(group['values'])
+        if isinstance(values, np.ndarray):
+            values = values[col_idx, rows]
+        else:
+            # h5py needs increasing indices
+            order = np.argsort(col_idx)
+            values = values[col_idx[order], rows][np.argsort(order)] if len(col_idx) else np.empty((0, 0))
+        if columns is not None: names = names[col_idx]
+        df = pd.DataFrame(np.array(values.T), index = index[rows], columns = names)
+        dtypes = np.array(group.attrs['dtypes'])[col_idx]
+        if (dtypes != str(df.values.dtype)).any(): df = df.astype(dict(zip(df.columns, dtypes)))
+        if kind == 'series':
+            df = df.iloc[:,0]
+            df.name = group.attrs.get('name', None)
+        return df
+
+    def _values(self, dataset):
+        offset = dataset.id.get_offset()
+        if not self.mmap or offset is None or dataset.chunks is not None: return dataset
+        return np.memmap(self.file, mode = 'r', dtype = dataset.dtype, shape = dataset.shape, offset = offset)
+
+    def to_dict(self):
+        return {key: self.read(key) for key in self.keys()}
+
+    def close(self):
+        self.store.close()
+
+
+def read_store(name:str, path:str, lazy = False):
+    # lazy returns the columnar_store, otherwise the whole dictionary
+    store = columnar_store(name, path)
+    if lazy: return store
+    if store.store.attrs.get('single', False): Data = store.read('Data')
+    else: Data = store.to_dict()
+    store.close()
+    return Data
+
+def store_exists(name:str, path:str):
+    return os.path.isfile(os.path.join(path, name + '.h5'))
+
+def store_current(name:str, path:str):
+    # The store of name exists and is not older than its pickle. Scripts
+    # always write the pickle, a store left by an earlier columnar run is
+    # older than the pickle written since and is not read.
+    if not store_exists(name, path): return False
+    pickle_file = os.path.join(path, name + '.pickle')
+    if not os.path.isfile(pickle_file): return True
+    return os.path.getmtime(os.path.join(path, name + '.h5')) >= os.path.getmtime(pickle_file)
+
+def convert_pickles(path:str, names = None):
+    # Converts the pickled dictionaries of a data folder into stores next to
+    # them, the pickles are left in place
+    files = glob.glob(os.path.join(path, '*.pickle')) if names is None else [os.path.join(path, name + '.pickle') for name in names]
+    for file in files:
+        name = os.path.splitext(os.path.basename(file))[0]
+        with open(file, 'rb') as handle:
+            Data = pickle.load(handle)
+        save_store(Data, name, path)
+        print('Converted ' + name)
+
+
+if __name__ == '__main__':
+    convert_pickles('./Datasets/')
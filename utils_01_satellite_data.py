@@ -8,10 +8,35 @@ import numpy as np
 import os
 import fiona
 import shapely
+import shapely.geometry
+import shapely.prepared
+import shapely.ops
 import datetime as dt
 import pandas as pd
 import pickle
+import warnings
 import grids
+import utils_00_gldas
+
+def Stack_Cells(Variable_Dictionary, cells, index = None):
+    # Stacks the time x cell table of every variable into one cell x time x
+    # variable array, joined on the union of the variable indexes (and index)
+    # as the outer concat of the per cell tables did. Each cell frame is then
+    # a view of the array.
+    frames = [pd.DataFrame(index=index)] if index is not None else []
+    frames += [Variable_Dictionary[var].iloc[:, :0] for var in Variable_Dictionary]
+    index = pd.concat(frames, join="outer", axis=1).index
+    dtype = np.result_type(*[Variable_Dictionary[var].values.dtype for var in Variable_Dictionary])
+    values = np.empty((len(cells), len(index), len(Variable_Dictionary)), dtype = dtype)
+    for j, var in enumerate(Variable_Dictionary):
+        table = Variable_Dictionary[var]
+        if not table.index.equals(index): table = table.reindex(index)
+        values[:, :, j] = table[cells].values.T
+    return index, values
+
+def Cell_Frames(values, index, columns, cells):
+    return {cell: pd.DataFrame(values[i], index = index, columns = columns, copy = False) for i, cell in enumerate(cells)}
+
 
 class utils_netCDF():
     def __init__(self, data_root ='./Datasets'):
@@ -31,48 +56,57 @@ class utils_netCDF():
         self.nec_lon = north_east_corner_lon
         self.swc_lon = south_west_corner_lon
         
-        lat_range = np.arange(self.nec_lat, self.swc_lat - self.dy, -self.dy).tolist()
-        lon_range = np.arange(self.swc_lon, self.nec_lon + self.dx,  self.dx).tolist()      
-        grid_locations = dict()
-        cell_int = -1
-        for i, lat in enumerate(lat_range):
-            for j, lon in enumerate(lon_range):
-                cell_int += 1
-                grid_locations['Cell_' + str(cell_int)] = {'Latitude':lat, 'Longitude':lon}
-        return grid_locations
+        lat_range = np.arange(self.nec_lat, self.swc_lat - self.dy, -self.dy)
+        lon_range = np.arange(self.swc_lon, self.nec_lon + self.dx,  self.dx)
+        return netCDF_grid(lat_range, lon_range)
     
     def Shape_Boundary(self, shape_file_path):
         self.shape_file_path = shape_file_path
         user_shape = fiona.open(shape_file_path)
         user_shape_boundary = user_shape.bounds
         return user_shape_boundary
+
+    def Shape_Polygon(self, shape_file_path):
+        # Union of the shapes of a shape file
+        self.shape_file_path = shape_file_path
+        with fiona.open(shape_file_path) as user_shape:
+            polygons = [shapely.geometry.shape(feature['geometry']) for feature in user_shape]
+        return shapely.ops.unary_union(polygons)
     
     def Find_intercepting_cells(self, grid_locations, bound_location, padding=True, buffer=None):
         self.padding = padding
         if self.padding == True and buffer == None: self.buffer=(self.dx/2, self.dy/2)
-        cells = dict.fromkeys(grid_locations.keys(),[])
+        elif buffer != None: self.buffer = buffer
         boundary = bound_location
         
-        if self.padding: new_shape = shapely.geometry.Polygon((
-            [boundary[0] - self.buffer[0], boundary[1] - self.buffer[1]], 
-            [boundary[0] - self.buffer[0], boundary[3] + self.buffer[1]], 
-            [boundary[2] + self.buffer[0], boundary[3] + self.buffer[1]], 
-            [boundary[2] + self.buffer[0], boundary[1] - self.buffer[1]]))
-        
-        else: new_shape = shapely.geometry.Polygon((
-            [boundary[0], boundary[1]], [boundary[0], boundary[3]], 
-            [boundary[2], boundary[3]], [boundary[2], boundary[1]]))
+        if self.padding: box = (boundary[0] - self.buffer[0], boundary[1] - self.buffer[1],
+                                boundary[2] + self.buffer[0], boundary[3] + self.buffer[1])
+        else: box = tuple(boundary)
         
         print('Starting Cell Selection...')
-        for i, c in enumerate(grid_locations):
-            point = shapely.geometry.Point(grid_locations[c]['Longitude'], 
-                                           grid_locations[c]['Latitude']) 
-            if new_shape.contains(point): cells[c]= True
-            else: del cells[c]
+        if isinstance(grid_locations, netCDF_grid):
+            cells = dict.fromkeys(grid_locations.cell_names(grid_locations.box_cells(box)), True)
+        else:
+            new_shape = shapely.prepared.prep(shapely.geometry.box(*box))
+            cells = dict()
+            for i, c in enumerate(grid_locations):
+                point = shapely.geometry.Point(grid_locations[c]['Longitude'],
+                                               grid_locations[c]['Latitude'])
+                if new_shape.contains(point): cells[c]= True
+        print('Cells Found.')
+        return cells
+
+    def Find_polygon_cells(self, grid, polygon, buffer=0.0):
+        # Cells of the grid with their centroid inside a polygon, such as the
+        # one of Shape_Polygon, optionally grown by buffer degrees.
+        if buffer: polygon = polygon.buffer(buffer)
+        print('Starting Cell Selection...')
+        cells = dict.fromkeys(grid.cell_names(grid.polygon_cells(polygon)), True)
         print('Cells Found.')
         return cells
     
     def Cell_Mask(self, intercepting_cells, grid_locations):
+        if isinstance(grid_locations, netCDF_grid): return grid_locations.mask(intercepting_cells)
         Mask = dict()
         for i, key in enumerate(intercepting_cells):
             Mask[key] = grid_locations[key]
@@ -93,6 +127,71 @@ class utils_netCDF():
             data = pickle.load(handle)
         return data      
 
+class netCDF_grid():
+    # Grid of cell centroids kept as the latitude and longitude vectors of the
+    # netCDF. Cell_n numbers the cells row by row from the first latitude, as
+    # the dictionary netCDF_Grid_Creation used to build. The grid can still be
+    # used as that dictionary, grid['Cell_n'] gives its Latitude and Longitude.
+    def __init__(self, lat_range, lon_range):
+        self.lat_range = np.asarray(lat_range, dtype=float)
+        self.lon_range = np.asarray(lon_range, dtype=float)
+        self.shape = (len(self.lat_range), len(self.lon_range))
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.cell_names(np.arange(len(self)))
+
+    def __contains__(self, key):
+        return 0 <= self.cell_ids([key])[0] < len(self)
+
+    def __getitem__(self, key):
+        row, col = divmod(int(self.cell_ids([key])[0]), self.shape[1])
+        return {'Latitude': self.lat_range[row].item(), 'Longitude': self.lon_range[col].item()}
+
+    def cell_ids(self, names):
+        return np.array([int(name.split('_')[-1]) for name in names], dtype=np.int64)
+
+    def cell_names(self, ids):
+        return ['Cell_' + str(i) for i in ids]
+
+    def coordinates(self, ids):
+        # Latitude and longitude of cell numbers
+        ids = np.asarray(ids, dtype=np.int64)
+        return self.lat_range[ids // self.shape[1]], self.lon_range[ids % self.shape[1]]
+
+    def box_cells(self, box):
+        # Cell numbers with their centroid strictly inside box (min lon,
+        # min lat, max lon, max lat), as Polygon.contains(Point).
+        rows = np.flatnonzero((self.lat_range > box[1]) & (self.lat_range < box[3]))
+        cols = np.flatnonzero((self.lon_range > box[0]) & (self.lon_range < box[2]))
+        return (rows[:,np.newaxis] * self.shape[1] + cols).reshape(-1)
+
+    def polygon_cells(self, polygon):
+        # Cell numbers with their centroid inside a polygon. Only the cells of
+        # the polygon bounds are tested, with a prepared geometry.
+        ids = self.box_cells(polygon.bounds)
+        lat, lon = self.coordinates(ids)
+        prepared = shapely.prepared.prep(polygon)
+        inside = [prepared.contains(shapely.geometry.Point(x, y)) for x, y in zip(lon, lat)]
+        return ids[np.array(inside, dtype=bool)]
+
+    def mask(self, cells):
+        # Dictionary of cell name to Latitude and Longitude, as Cell_Mask
+        ids = self.cell_ids(cells)
+        lat, lon = self.coordinates(ids)
+        return {name: {'Latitude': y, 'Longitude': x} for name, y, x in zip(cells, lat.tolist(), lon.tolist())}
+
+    def location(self, cells):
+        # Location frame of cells, as the one parse and Parse_Data build
+        lat, lon = self.coordinates(self.cell_ids(cells))
+        return pd.DataFrame({'Longitude': lon, 'Latitude': lat}, index = list(cells))
+
+
 class GLDAS_parse():
     def __init__(self, data_folder, cell_names):
         self.data_folder = data_folder
@@ -111,8 +210,20 @@ class GLDAS_parse():
         return Variables
     
     def Open_GLDAS(self, variables_list, mask):
+        # Reads the chunked store written by utils_00_gldas when there is one,
+        # only the cells of the mask are read, else the whole-globe tabular
+        # pickle with a warning.
+        missing = [var for var in variables_list if not os.path.isfile(self.data_folder + '/' + var + '.nc')]
+        if missing:
+            warnings.warn(f'No GLDAS store for {missing} in {self.data_folder}, reading the whole-globe pickles. '
+                          'utils_00_gldas.py writes the stores that read only the cells of the aquifer.')
         Variable_Dictionary = dict()
+        cells = [int(cell.split('_')[-1]) for cell in self.cell_names]
         for i, var in enumerate(variables_list):
+            store_path = self.data_folder + '/' + var + '.nc'
+            if os.path.isfile(store_path):
+                Variable_Dictionary[var] = utils_00_gldas.Read_Store(store_path, var, cells)
+                continue
             data_temp = self.read_pickle(var, self.data_folder)
             Variable_Dictionary[var] = data_temp[self.cell_names]
             del data_temp
@@ -120,19 +231,22 @@ class GLDAS_parse():
         
     def parse(self, Variable_Dictionary, mask):
         Data = dict.fromkeys(mask.keys(),[])
-        df_temp = pd.DataFrame(index=list(mask.keys()), columns =(['Longitude', 'Latitude']))
-        for i, cell in enumerate(mask): df_temp.loc[df_temp.index[i]] = mask[cell]
-        Data['Location'] = df_temp        
+        df_temp = pd.DataFrame.from_dict(mask, orient='index', columns=['Longitude', 'Latitude']).astype(object)
+        Data['Location'] = df_temp
+        print('Parsing ' + str(len(self.cell_names)) + ' cells.')
+        index, values = Stack_Cells(Variable_Dictionary, self.cell_names)
+        values = values.astype(float)
+
+        # Cells where every value is -9999 are outside of the land mask
+        with np.errstate(invalid='ignore'):
+            count = (~np.isnan(values)).sum(axis=(1,2))
+            mean = np.nansum(values, axis=(1,2))/count
+        empty = mean == -9999.0
+        frames = Cell_Frames(values, index, list(Variable_Dictionary), self.cell_names)
         for i, cell in enumerate(self.cell_names):
-            print('Parsing ' + cell + ' ' + str(i+1)+ '/' + str(len(self.cell_names)))
-            feature_df = pd.DataFrame()
-            for j, var in enumerate(Variable_Dictionary):
-                df = pd.DataFrame(Variable_Dictionary[var][cell].values, index = Variable_Dictionary[var].index, columns=[var])
-                feature_df = pd.concat([feature_df, df], join="outer", axis=1)
-            if feature_df.stack().mean() != -9999.0: Data[cell] = feature_df.astype(float)
-            else: 
-                del Data[cell]
-                Data['Location'].drop([cell],inplace=True, axis=0)
+            if not empty[i]: Data[cell] = frames[cell]
+            else: del Data[cell]
+        Data['Location'].drop([cell for i, cell in enumerate(self.cell_names) if empty[i]], inplace=True, axis=0)
         return Data
 
 
@@ -154,8 +268,7 @@ class grids_netCDF():
         
     def Parse_Data(self, Mask, dates, data_path = None, data_folder=None, file_list=None, variable_name=None, variables_list=None):
         Data = dict.fromkeys(Mask.keys(),[])
-        df_temp = pd.DataFrame(index=list(Mask.keys()), columns =(['Longitude', 'Latitude']))
-        for i, cell in enumerate(Mask): df_temp.loc[df_temp.index[i]] = Mask[cell]
+        df_temp = pd.DataFrame.from_dict(Mask, orient='index', columns=['Longitude', 'Latitude']).astype(object)
         Data['Location'] = df_temp
         print('Loading netCDF location.')
         Data_Location = self._Data_List(data_path)
@@ -183,41 +296,39 @@ class grids_netCDF():
         Data['Location'] = Data['Location'].astype(float)
         
         # Splits the variables and assigns to proper cell
-        for i, cell in enumerate(Mask):
-            print('Parsing ' + cell + ' ' + str(i+1)+ '/' + str(len(Mask)))
-            feature_df = pd.DataFrame(index=dates)
-            for j, var in enumerate(Variable_Dictionary):
-                df = pd.DataFrame(Variable_Dictionary[var][cell].values, index = Variable_Dictionary[var].index, columns=[var])
-                feature_df = pd.concat([feature_df, df], join="outer", axis=1)
-            Data[cell] = feature_df
+        print('Parsing ' + str(len(Mask)) + ' cells.')
+        cells = list(Mask.keys())
+        index, values = Stack_Cells(Variable_Dictionary, cells, index = dates)
+        Data.update(Cell_Frames(values, index, list(Variable_Dictionary), cells))
         return Data
     
     def Validate_Data(self, Mask, Data):
+        # Cells missing a variable entirely are removed, the others keep the
+        # months where every variable has a value. Cells sharing the same
+        # table layout are checked together.
         print('Validating Data.')
+        groups = dict()
         for i, cell in enumerate(Mask):
-            try: 
-                Validated_Data = pd.DataFrame(index=Data[cell].index)
-                for j, var in enumerate(Data[cell].columns):
-                    data_temp = Data[cell][var].to_frame()
-                    data_temp = data_temp.astype(float)
-                    data_temp = data_temp.dropna(axis=0, how='any')
-                    if data_temp.empty:
-                        del Data[cell]
-                        Data['Location'].drop([cell],inplace=True, axis=0)
-                        print('Removed Cell ' + cell)
-                    else: Validated_Data=pd.concat([Validated_Data, data_temp], join="inner", axis=1)
-                if not Validated_Data.empty: Data[cell] = Validated_Data
-            except: 
+            if not isinstance(Data.get(cell), pd.DataFrame):
                 print('Error with cell: ' + cell + '. Cell Not Validated.')
-                pass
+                continue
+            key = (id(Data[cell].index), tuple(Data[cell].columns))
+            groups.setdefault(key, []).append(cell)
+        for key, cells in groups.items():
+            try: values = np.stack([Data[cell].values.astype(float) for cell in cells])
+            except Exception:
+                print('Error with cells: ' + ', '.join(cells) + '. Cells Not Validated.')
+                continue
+            present = ~np.isnan(values)
+            removed = ~present.any(axis=1).all(axis=1)
+            complete = present.all(axis=2)
+            for i, cell in enumerate(cells):
+                if removed[i]:
+                    del Data[cell]
+                    Data['Location'].drop([cell],inplace=True, axis=0)
+                    print('Removed Cell ' + cell)
+                elif complete[i].any():
+                    df = Data[cell]
+                    Data[cell] = pd.DataFrame(values[i][complete[i]], index=df.index[complete[i]], columns=df.columns)
         print('Data Validated.')
         return Data
-    
-    
-    
-    
-    
-    
-    
-    
-    
\ No newline at end of file
@@ -76,7 +76,11 @@ class wellfunc():
     
     # Extracts Well Time series, and drops any well without a minimum amount
     # of Data (MinExTotal) within a user specified window (Left, Right)
-    def extractwelldata(self, wells, Left=1948, Right=2018, Min_Obs_Months=50, outlier = 3):
+    # With long_format wells['Data'] is a long table of (date, well, value)
+    # rows named by long_columns, such as EscalanteBerylTimeseries.csv, and is
+    # screened and returned in that format without building the wide table.
+    def extractwelldata(self, wells, Left=1948, Right=2018, Min_Obs_Months=50, outlier = 3,
+                        long_format = False, long_columns = ['Date', 'Well ID', 'Measurement']):
         # Validates that right-side window is greater than left-side window.
         assert Left < Right, 'Error: Left Cap Year is greater than Right Cap year.'
         # Validates that Aquifer pickle dataframe contains 
@@ -88,84 +92,290 @@ class wellfunc():
         begtime = pd.Timestamp(dt.datetime(Left, 1, 1))# data before this date
         endtime = pd.Timestamp(dt.datetime(Right, 1, 1))# data after this date
         
-        # Remove outliers from original data larger than 3 standard deviations
-        for col in wells['Data']:
-            wells['Data'][col] = wells['Data'][col][np.abs(wells['Data'][col] - 
-                    wells['Data'][col].mean()) <= (outlier*wells['Data'][col].std())]
-        
-        # Vectorized subsetting of well data. Mask wells with data between 
-        # left cap (begtime) and right cap (endtime). Results in binary array
-        # showing wells within time range containing specified number of points.
-        mask = (wells['Data'].index > begtime) & (wells['Data'].index < endtime)
-        well_subset = wells['Data'].loc[mask]
-        
+        if long_format:
+            wells_dict['Data'] = self._extract_long(wells['Data'], begtime, endtime, Min_Obs_Months, outlier, long_columns)
+            well_names = pd.unique(wells_dict['Data'][long_columns[1]])
+        else:
+            # Remove outliers from original data larger than 3 standard deviations
+            data = wells['Data']
+            wells['Data'] = data.where(np.abs(data - data.mean()) <= (outlier*data.std()))
+
+            # Vectorized subsetting of well data. Mask wells with data between
+            # left cap (begtime) and right cap (endtime). Results in binary array
+            # showing wells within time range containing specified number of points.
+            mask = (wells['Data'].index > begtime) & (wells['Data'].index < endtime)
+            well_subset = wells['Data'].loc[mask]
             
-        # Creates subset of well data between caps. Determines number of unique
-        # months, by determining the number unique (Year/Month) codings. Drop 
-        # any column in subset that has less than MinExTotal non empty cells
-        well_subset = well_subset.drop(well_subset.columns[well_subset.apply(
-            lambda col: len(np.unique((col.dropna().index).strftime('%Y/%m')).tolist()) < Min_Obs_Months)], axis=1)
-
-        # Creating filtered Well Data DataFrame. This DataFrame will include 
-        # all values for the wells selected in the pervious function- including
-        # values outside of the caps range
-        wells_dict['Data'] = wells['Data'][well_subset.columns]
+            # Creates subset of well data between caps. Determines number of unique
+            # months, by counting the distinct year*12 + month codes of the
+            # observations of every well. Drop any column in subset that has
+            # less than Min_Obs_Months observed months
+            codes = well_subset.index.year.values * 12 + well_subset.index.month.values
+            row, well = np.nonzero(well_subset.notna().values)
+            months = self._count_months(codes[row], well, len(well_subset.columns))
+            well_subset = well_subset.drop(well_subset.columns[months < Min_Obs_Months], axis=1)
+
+            # Creating filtered Well Data DataFrame. This DataFrame will include
+            # all values for the wells selected in the pervious function- including
+            # values outside of the caps range
+            wells_dict['Data'] = wells['Data'][well_subset.columns]
+            well_names = wells_dict['Data'].columns
         
         
         # Unpack dataframe well coorindates: Lat Long
         location_df = wells['Location']
         # Create new Locations dataframe with only wells that exist in the data.
-        location_df = location_df.loc[wells_dict['Data'].columns]
+        location_df = location_df.loc[well_names]
         wells_dict['Location'] = location_df   
         
         
         # Unpack dataframe of well location centroid
-        centroid = wells['Centroid']
+        if 'Centroid' in wells: centroid = wells['Centroid']
+        else: centroid = pd.DataFrame(index=['Longitude', 'Latitude'], columns=[0], dtype=float)
         # Create new Centroid Data Frame
         centroid.loc['Latitude'][0]  = location_df['Latitude'].min()  + ((location_df['Latitude'].max()  - location_df['Latitude'].min())/2)
         centroid.loc['Longitude'][0] = location_df['Longitude'].min() + ((location_df['Longitude'].max() - location_df['Longitude'].min())/2)
         wells_dict['Centroid'] = centroid
         
         return wells_dict
+
+    def _count_months(self, codes, well, n_wells):
+        # Number of distinct month codes of every well from (code, well) pairs
+        if len(codes) == 0: return np.zeros(n_wells, dtype=np.int64)
+        pairs = np.unique(well.astype(np.int64) * (codes.max() + 1) + codes)
+        return np.bincount(pairs // (codes.max() + 1), minlength = n_wells)
+
+    def _extract_long(self, data, begtime, endtime, Min_Obs_Months, outlier, long_columns):
+        # extractwelldata on a long table: outliers are screened with the mean
+        # and standard deviation of every well, observed months are counted
+        # from month codes. Rows of removed outliers and dropped wells are left
+        # out of the returned table.
+        date_col, well_col, value_col = long_columns
+        data = data.dropna(subset=[value_col])
+        dates = pd.DatetimeIndex(pd.to_datetime(data[date_col]))
+        well_names, well = np.unique(data[well_col].values, return_inverse=True)
+        values = data[value_col].values.astype(float)
+
+        # Remove outliers larger than outlier standard deviations of the well
+        n = np.bincount(well, minlength=len(well_names))
+        mean = np.bincount(well, weights=values, minlength=len(well_names)) / n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(np.bincount(well, weights=(values - mean[well])**2, minlength=len(well_names)) / (n - 1))
+        keep = np.abs(values - mean[well]) <= outlier*std[well]
+
+        # Observed months between the caps
+        inside = keep & (dates > begtime) & (dates < endtime)
+        codes = dates.year.values * 12 + dates.month.values
+        months = self._count_months(codes[inside], well[inside], len(well_names))
+        keep &= (months >= Min_Obs_Months)[well]
+        return data[keep]
+
+    # Streams a long table of measurements (date, well, value), such as
+    # EscalanteBerylTimeseries.csv, in chunks of chunksize rows and returns the
+    # monthly mean of every well kept by the filters of extractwelldata, with
+    # its Location and Centroid. The first pass gathers the mean and standard
+    # deviation of every well for the outlier screen, the second one adds the
+    # screened values to (well, month) sums. Only those sums are kept in memory
+    # and the wide table is built for the retained wells only.
+    def stream_long_csv(self, data_file, location_file, Left=1948, Right=2018, Min_Obs_Months=50, outlier = 3,
+                        long_columns = ['Date', 'Well ID', 'Measurement'], chunksize = 500000):
+        assert Left < Right, 'Error: Left Cap Year is greater than Right Cap year.'
+        assert Min_Obs_Months > 0, 'Error: Original Data dataframe must have at least 1 example.'
+        date_col, well_col, value_col = long_columns
+        begtime = pd.Timestamp(dt.datetime(Left, 1, 1))
+        endtime = pd.Timestamp(dt.datetime(Right, 1, 1))
+        well_ids = dict()
+
+        def read_chunks():
+            for chunk in pd.read_csv(data_file, usecols = long_columns, dtype = {well_col: str}, chunksize = chunksize):
+                chunk = chunk.dropna(subset = [well_col, value_col])
+                names, inverse = np.unique(chunk[well_col].values, return_inverse = True)
+                ids = np.array([well_ids.setdefault(name, len(well_ids)) for name in names], dtype = np.int64)
+                yield ids[inverse], chunk[value_col].values.astype(float), pd.DatetimeIndex(pd.to_datetime(chunk[date_col]))
+
+        # Pass 1: count, shifted sum and sum of squares of every well
+        shift, moments = np.zeros(0), np.zeros((3, 0))
+        for well, values, dates in read_chunks():
+            if len(well_ids) > len(shift):
+                # Any reading of a new well serves as its shift
+                new = len(well_ids) - len(shift)
+                shift = np.concatenate([shift, np.full(new, np.nan)])
+                moments = np.concatenate([moments, np.zeros((3, new))], axis = 1)
+            unset = np.isnan(shift[well])
+            if unset.any(): shift[well[unset]] = values[unset]
+            d = values - shift[well]
+            moments += [np.bincount(well, minlength = len(shift)),
+                        np.bincount(well, weights = d, minlength = len(shift)),
+                        np.bincount(well, weights = d**2, minlength = len(shift))]
+        n, s1, s2 = moments
+        mean = shift + s1/n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(np.maximum(s2 - s1**2/n, 0)/(n - 1))
+
+        # Pass 2: screened values added to (well, month) sums, months with a
+        # reading between the caps are flagged
+        span = 12 * 10000
+        keys, sums = [], []
+        for well, values, dates in read_chunks():
+            keep = np.abs(values - mean[well]) <= outlier*std[well]
+            code = dates.year.values * 12 + dates.month.values - 1
+            key, inverse = np.unique(well[keep] * span + code[keep], return_inverse = True)
+            inside = ((dates > begtime) & (dates < endtime))[keep]
+            keys.append(key)
+            sums.append(np.stack([np.bincount(inverse, weights = values[keep], minlength = len(key)),
+                                  np.bincount(inverse, minlength = len(key)),
+                                  np.bincount(inverse, weights = inside, minlength = len(key))]))
+        key, inverse = np.unique(np.concatenate(keys), return_inverse = True)
+        sums = np.concatenate(sums, axis = 1)
+        total, count, inside = [np.bincount(inverse, weights = row, minlength = len(key)) for row in sums]
+        well, code = key // span, key % span
+
+        # Wells with enough observed months between the caps
+        months = np.bincount(well[inside > 0], minlength = len(well_ids))
+        names = np.array(list(well_ids.keys()), dtype = object)
+        retained = np.flatnonzero(months >= Min_Obs_Months)
+        retained = retained[np.argsort(names[retained])]
+        kept = np.isin(well, retained)
+        dates, row = np.unique(code[kept], return_inverse = True)
+        column = np.full(len(well_ids), -1)
+        column[retained] = np.arange(len(retained))
+        column = column[well[kept]]
+        data = np.full((len(dates), len(retained)), np.nan)
+        data[row, column] = total[kept] / count[kept]
+        index = pd.DatetimeIndex([dt.datetime(c // 12, c % 12 + 1, 1) for c in dates])
+
+        wells_dict = dict()
+        wells_dict['Data'] = pd.DataFrame(data, index = index, columns = names[retained].tolist())
+        location_df = pd.read_csv(location_file, dtype = {well_col: str}).set_index(well_col)
+        location_df = location_df.loc[wells_dict['Data'].columns, ['Longitude', 'Latitude']]
+        wells_dict['Location'] = location_df
+        centroid = pd.DataFrame(index = ['Longitude', 'Latitude'], columns = [0], dtype = float)
+        centroid.loc['Latitude', 0]  = location_df['Latitude'].min()  + ((location_df['Latitude'].max()  - location_df['Latitude'].min())/2)
+        centroid.loc['Longitude', 0] = location_df['Longitude'].min() + ((location_df['Longitude'].max() - location_df['Longitude'].min())/2)
+        wells_dict['Centroid'] = centroid
+        return wells_dict
         
     def interp_well(self, wells_raw, gap_size = '365 days', pad = 90, spacing = '1MS'):
         # gaps bigger than this are set to nan
         # padding on either side of a measured point not set to nan, even if in a gap
         # spacing to interpolate to 1st day of the month (MS or month start)
-        well_interp_df = pd.DataFrame()
+        # All wells are interpolated together: the observations of every well
+        # are laid end to end and the pchip of scipy is evaluated with array
+        # operations, well by well results are identical to interpolate.pchip.
         # create a time index to interpolate over - cover entire range
         interp_index: DatetimeIndex = pd.date_range(start=min(wells_raw.index), freq=spacing, end=max(wells_raw.index))
-        # loop over each well, interpolate data using pchip
-        for well in wells_raw:
-            temp_df = wells_raw[well].dropna()  # available data for a well drops NaN
-            x_index = temp_df.index.astype('int')  # dates for available data
-            x_diff = temp_df.index.to_series().diff()  # data gap sizes
-            fit2 = interpolate.pchip(x_index, temp_df)  # pchip fit to data
-            ynew = fit2(interp_index.astype('int'))  # interpolated data on full range
-            interp_df = pd.DataFrame(ynew, index=interp_index, columns=[well])
-    
-            # replace data in gaps of > gap size with nans
-            gaps = np.where(x_diff > gap_size)  # list of indexes where gaps are large
-            
-            # Can Probably optimize and remove this code
-            # if padding plus start is larger than the gap size currently 1 year
-            # Non nans will be replaced
-            for g in gaps[0]:
-                start = x_diff.index[g - 1] + dt.timedelta(days=pad)
-                end = x_diff.index[g] - dt.timedelta(days=pad)
-                interp_df[start:end] = np.nan
-            beg_meas_date = x_diff.index[0]      # date of 1st measured point
-            end_meas_date = temp_df.index[-1]    # date of last measured point
-            mask1 = (interp_df.index < beg_meas_date)  # Check values before measured date
-            interp_df[mask1] = np.nan  # blank out data before 1st measured point
-            mask2 = (interp_df.index >= end_meas_date) # data from last measured point to end
-            interp_df[mask2] = np.nan # blank data from last measured point
-            
-            # add the interp_df data to the full data frame
-            well_interp_df = pd.concat([well_interp_df, interp_df], join="outer", axis=1, sort=False)
-            
+        grid = interp_index.astype('int').values
+
+        # available data of all wells laid end to end, well by well
+        values = wells_raw.values
+        well_id, row = np.nonzero(~np.isnan(values.T))
+        x_int = wells_raw.index.astype('int').values[row]
+        x = x_int.astype(float)
+        y = values[row, well_id].astype(float)
+        counts = np.bincount(well_id, minlength = values.shape[1])
+        if (counts < 2).any(): raise ValueError("`x` must contain at least 2 elements.")
+        first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        last = first + counts - 1
+
+        # segment k joins point k and k+1, only segments inside a well are used
+        hk = x[1:] - x[:-1]
+        inner = np.ones(len(hk), dtype=bool)
+        inner[last[:-1]] = False
+        if (hk[inner] <= 0).any(): raise ValueError("`x` must be strictly increasing sequence.")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mk = (y[1:] - y[:-1]) / hk
+        dk = self._pchip_derivatives(hk, mk, first, last)
+
+        # Hermite coefficients of every segment, as CubicHermiteSpline
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.diff(y) / hk
+            t = (dk[:-1] + dk[1:] - 2 * slope) / hk
+            c0 = t / hk
+            c1 = (slope - dk[:-1]) / hk - t
+        c2 = dk[:-1]
+        c3 = y[:-1]
+
+        # grid points between the first measured point and the last one
+        # (excluded), the only ones kept. Each is placed in its segment with a
+        # search on (well, date rank) keys.
+        lo = np.searchsorted(grid, x_int[first], side='left')
+        hi = np.searchsorted(grid, x_int[last], side='left')
+        n_points = np.maximum(hi - lo, 0)
+        q_well = np.repeat(np.arange(len(counts)), n_points)
+        q_row = np.arange(n_points.sum()) - np.repeat(np.cumsum(n_points) - n_points, n_points) + np.repeat(lo, n_points)
+        times, rank = np.unique(np.concatenate([x_int, grid]), return_inverse = True)
+        keys = well_id.astype(np.int64) * (len(times) + 1) + rank[:len(x_int)]
+        q_keys = q_well.astype(np.int64) * (len(times) + 1) + rank[len(x_int):][q_row]
+        seg = np.searchsorted(keys, q_keys, side='right') - 1
+        seg = np.minimum(seg, last[q_well] - 1)
+
+        # PPoly evaluation, powers of s added from the constant term up
+        s = grid[q_row].astype(float) - x[seg]
+        z = s * s
+        ynew = c3[seg] + c2[seg] * s
+        ynew = ynew + c1[seg] * z
+        ynew = ynew + c0[seg] * (z * s)
+        well_interp = np.full((len(grid), len(counts)), np.nan)
+        well_interp[q_row, q_well] = ynew
+
+        # replace data in gaps of > gap size with nans, keeping pad days on
+        # either side of the measured points
+        x_diff = np.diff(x_int)
+        gaps = np.flatnonzero((x_diff > pd.Timedelta(gap_size).value) & inner)
+        start = x_int[gaps] + pd.Timedelta(days=pad).value
+        end = x_int[gaps + 1] - pd.Timedelta(days=pad).value
+        g_lo = np.searchsorted(grid, start, side='left')
+        g_hi = np.searchsorted(grid, end, side='right')
+        keep = g_lo < g_hi
+        blank = np.zeros((len(grid) + 1, len(counts)), dtype=np.int64)
+        np.add.at(blank, (g_lo[keep], well_id[gaps][keep]), 1)
+        np.add.at(blank, (g_hi[keep], well_id[gaps][keep]), -1)
+        well_interp[np.cumsum(blank, axis=0)[:-1] > 0] = np.nan
+
         # return a pd data frame with interpolated wells - gaps with nans
-        return well_interp_df
+        return pd.DataFrame(well_interp, index=interp_index, columns=wells_raw.columns)
+
+    def _pchip_derivatives(self, hk, mk, first, last):
+        # Derivatives of scipy PchipInterpolator._find_derivatives for wells laid
+        # end to end, first and last are the first and last point of each well.
+        n = len(mk) + 1
+        dk = np.zeros(n)
+        interior = np.ones(n, dtype=bool)
+        interior[first] = False
+        interior[last] = False
+        k = np.flatnonzero(interior)
+        m0, m1 = mk[k-1], mk[k]
+        h0, h1 = hk[k-1], hk[k]
+        condition = (np.sign(m1) != np.sign(m0)) | (m1 == 0) | (m0 == 0)
+        w1 = 2*h1 + h0
+        w2 = h1 + 2*h0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            whmean = (w1/m0 + w2/m1) / (w1 + w2)
+        dk[k[~condition]] = 1.0 / whmean[~condition]
+
+        # two points, linear interpolation
+        two = (last - first) == 1
+        dk[first[two]] = mk[first[two]]
+        dk[last[two]] = mk[first[two]]
+
+        # special case endpoints, one-sided three-point estimate
+        f, l = first[~two], last[~two]
+        dk[f] = self._edge_case(hk[f], hk[f+1], mk[f], mk[f+1])
+        dk[l] = self._edge_case(hk[l-1], hk[l-2], mk[l-1], mk[l-2])
+        return dk
+
+    def _edge_case(self, h0, h1, m0, m1):
+        # one-sided three-point estimate for the derivative
+        d = ((2*h0 + h1)*m0 - h0*m1) / (h0 + h1)
+
+        # try to preserve shape
+        mask = np.sign(d) != np.sign(m0)
+        mask2 = (np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3.*np.abs(m0))
+        mmm = (~mask) & mask2
+
+        d[mask] = 0.
+        d[mmm] = 3.*m0[mmm]
+        return d
         
 
     '''###################################
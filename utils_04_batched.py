@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:00 2026
+
+@author: saulg
+"""
+import random
+import time
+import numpy as np
+import tensorflow as tf
+import utils_04_parallel
+
+from tensorflow.random import set_seed
+
+
+# Support Script for Groundwater Imputation Tool
+# Trains the networks of many wells at once. The Dense/Dropout/L2 network of
+# utils_04_models.keras_mlp is stacked along a well axis, every well keeps
+# its own weights, Adam moments, learning rate and early stopping, and the
+# batches of all wells go through one batched matrix product. Wells with fewer
+# features are padded with zero columns that are masked out of the first
+# layer, wells with fewer samples are padded with masked rows, and a well that
+# stopped or ran out of batches is left untouched by the update.
+# kfold_train_batched takes the same tasks as utils_04_parallel.kfold_train
+# and returns the same results, well by well.
+
+
+class batched_mlp():
+    # input_dims and l2 hold one value per well, l2 may also be a single value.
+    # Initialization follows Keras: glorot uniform kernels on the true fan in
+    # of every well and zero biases.
+    def __init__(self, input_dims, hidden_nodes = 50, l2 = 0.1, learning_rate = 0.001,
+                 dropout = 0.2, seed = 42):
+        self.input_dims = np.array(input_dims, dtype = int)
+        self.wells = len(self.input_dims)
+        self.features = max(int(self.input_dims.max()), 1)
+        self.dropout = dropout
+        rng = np.random.RandomState(seed)
+        H = hidden_nodes
+
+        def glorot(fan_in, fan_out):
+            limit = np.sqrt(6 / (fan_in + fan_out))
+            return rng.uniform(-limit, limit, (fan_in, fan_out))
+
+        W1 = np.zeros((self.wells, self.features, H))
+        for g, dim in enumerate(self.input_dims): W1[g,:dim] = glorot(dim, H)
+        W2 = np.stack([glorot(H, 2*H) for g in range(self.wells)])
+        W3 = np.stack([glorot(2*H, 1) for g in range(self.wells)])
+        weights = [W1, np.zeros((self.wells, H)),
+                   W2, np.zeros((self.wells, 2*H)),
+                   W3, np.zeros((self.wells, 1))]
+        self.weights = [tf.Variable(w.astype(np.float32)) for w in weights]
+        self.m = [tf.Variable(tf.zeros_like(w)) for w in self.weights]
+        self.v = [tf.Variable(tf.zeros_like(w)) for w in self.weights]
+        self.iterations = tf.Variable(tf.zeros(self.wells))
+        self.lr = tf.Variable(tf.fill([self.wells], float(learning_rate)))
+        self.l2 = tf.constant(np.broadcast_to(l2, self.wells).astype(np.float32))
+        mask = np.arange(self.features)[np.newaxis,:] < self.input_dims[:,np.newaxis]
+        self.feature_mask = tf.constant(mask[:,:,np.newaxis].astype(np.float32))
+        self.generator = tf.random.Generator.from_seed(seed)
+
+        signature = [tf.TensorSpec([self.wells, None, self.features], tf.float32),
+                     tf.TensorSpec([self.wells, None], tf.float32),
+                     tf.TensorSpec([self.wells, None], tf.float32)]
+        self._train_step = tf.function(self._train_step, input_signature = signature + [tf.TensorSpec([self.wells], tf.bool)])
+        self._evaluate = tf.function(self._evaluate, input_signature = signature)
+
+    def _forward(self, x, training):
+        W1, b1, W2, b2, W3, b3 = self.weights
+        h = tf.nn.relu(tf.einsum('gbd,gdh->gbh', x, W1 * self.feature_mask) + b1[:,tf.newaxis,:])
+        if training: h = self._drop(h)
+        h = tf.nn.relu(tf.einsum('gbd,gdh->gbh', h, W2) + b2[:,tf.newaxis,:])
+        if training: h = self._drop(h)
+        return tf.einsum('gbd,gdh->gbh', h, W3)[:,:,0] + b3
+
+    def _drop(self, h):
+        keep = tf.cast(self.generator.uniform(tf.shape(h)) >= self.dropout, h.dtype)
+        return h * keep / (1 - self.dropout)
+
+    def _penalty(self):
+        return self.l2 * tf.reduce_sum(tf.square(self.weights[0] * self.feature_mask), axis = [1,2])
+
+    def _losses(self, x, y, mask, training):
+        # Mean squared error of the samples of every well plus its L2 penalty,
+        # the loss Keras reports, and the sum of squared errors for the RMSE
+        sse = tf.reduce_sum(tf.square(self._forward(x, training) - y) * mask, axis = 1)
+        count = tf.reduce_sum(mask, axis = 1)
+        loss = sse / tf.maximum(count, 1) + self._penalty()
+        return loss, sse, count
+
+    def _train_step(self, x, y, mask, active):
+        with tf.GradientTape() as tape:
+            loss, sse, count = self._losses(x, y, mask, True)
+            total = tf.reduce_sum(tf.where(active, loss, 0))
+        grads = tape.gradient(total, self.weights)
+
+        # Adam as in Keras, with a step count and learning rate per well
+        beta_1, beta_2, epsilon = 0.9, 0.999, 1e-7
+        step = self.iterations + tf.cast(active, tf.float32)
+        alpha = self.lr * tf.sqrt(1 - tf.pow(beta_2, step)) / (1 - tf.pow(beta_1, tf.maximum(step, 1)))
+        for var, grad, m, v in zip(self.weights, grads, self.m, self.v):
+            shape = [self.wells] + [1] * (len(var.shape) - 1)
+            on = tf.reshape(active, shape)
+            m_new = m + (grad - m) * (1 - beta_1)
+            v_new = v + (tf.square(grad) - v) * (1 - beta_2)
+            update = tf.reshape(alpha, shape) * m_new / (tf.sqrt(v_new) + epsilon)
+            var.assign(tf.where(on, var - update, var))
+            m.assign(tf.where(on, m_new, m))
+            v.assign(tf.where(on, v_new, v))
+        self.iterations.assign(step)
+        return loss, sse, count
+
+    def _evaluate(self, x, y, mask):
+        return self._losses(x, y, mask, False)
+
+    def _stack(self, x, y = None):
+        # Pads the tables of every well into one array, None leaves a well out
+        n = np.array([0 if a is None else len(a) for a in x])
+        X = np.zeros((self.wells, max(n.max(), 1), self.features), dtype = np.float32)
+        Y = np.zeros((self.wells, max(n.max(), 1)), dtype = np.float32)
+        for g, a in enumerate(x):
+            if a is None: continue
+            X[g,:n[g],:self.input_dims[g]] = np.asarray(a, dtype = np.float32)
+            if y is not None: Y[g,:n[g]] = np.asarray(y[g], dtype = np.float32).ravel()
+        mask = (np.arange(X.shape[1])[np.newaxis,:] < n[:,np.newaxis]).astype(np.float32)
+        return X, Y, mask, n
+
+    def get_weights(self):
+        return [w.numpy() for w in self.weights]
+
+    def set_weights(self, weights):
+        for var, w in zip(self.weights, weights): var.assign(w)
+
+    def fit(self, x, y, epochs = 700, validation_data = None, batch_size = 32, patience = 5,
+            min_delta = 0.0, lr_factor = 0.1, lr_patience = 10, lr_min_delta = 1e-4, min_lr = 0,
+            shuffle = True, seed = 42):
+        # x and y are lists with the training tables of every well, None for a
+        # well that is not trained. epochs is one value or one per well. With
+        # validation_data every well runs EarlyStopping(patience,
+        # restore_best_weights = True) and ReduceLROnPlateau(lr_factor,
+        # lr_patience) on its val_loss, as kfold_train. Returns the history of
+        # every well.
+        X, Y, mask, n = self._stack(x, y)
+        epochs = np.broadcast_to(epochs, self.wells).astype(int)
+        active = (n > 0) & (epochs > 0)
+        validate = validation_data is not None
+        if validate:
+            X_val, Y_val, mask_val, n_val = self._stack(*validation_data)
+            best = np.full(self.wells, np.inf)
+            wait = np.zeros(self.wells, dtype = int)
+            best_lr = np.full(self.wells, np.inf)
+            wait_lr = np.zeros(self.wells, dtype = int)
+            best_weights = self.get_weights()
+        keys = ['loss', 'root_mean_squared_error'] + (['val_loss', 'val_root_mean_squared_error', 'lr'] if validate else [])
+        history = [{key: [] for key in keys} for g in range(self.wells)]
+        rng = np.random.RandomState(seed)
+
+        steps = int(np.ceil(n.max() / batch_size)) if n.max() > 0 else 0
+        for epoch in range(int(epochs.max())):
+            if not active.any(): break
+            # Every well is shuffled on its own, batches past the end of a
+            # well are padding
+            order = np.full((self.wells, steps * batch_size), -1)
+            for g in np.flatnonzero(active):
+                order[g,:n[g]] = rng.permutation(n[g]) if shuffle else np.arange(n[g])
+            loss_sum = np.zeros(self.wells)
+            sse_sum = np.zeros(self.wells)
+            seen = np.zeros(self.wells)
+            for s in range(steps):
+                batch = order[:,s*batch_size:(s+1)*batch_size]
+                batch_mask = batch >= 0
+                step_active = active & batch_mask.any(axis=1)
+                if not step_active.any(): break
+                rows = np.maximum(batch, 0)
+                wells = np.arange(self.wells)[:,np.newaxis]
+                loss, sse, count = self._train_step(X[wells, rows], Y[wells, rows],
+                                                    batch_mask.astype(np.float32), step_active)
+                count = count.numpy() * step_active
+                loss_sum += loss.numpy() * count
+                sse_sum += sse.numpy() * step_active
+                seen += count
+            with np.errstate(divide='ignore', invalid='ignore'):
+                epoch_loss = loss_sum / seen
+                epoch_rmse = np.sqrt(sse_sum / seen)
+
+            if validate:
+                val_loss, val_sse, val_count = [t.numpy() for t in self._evaluate(X_val, Y_val, mask_val)]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    val_rmse = np.sqrt(val_sse / val_count)
+                weights = self.get_weights()
+                lr = self.lr.numpy()
+            for g in np.flatnonzero(active):
+                history[g]['loss'].append(float(epoch_loss[g]))
+                history[g]['root_mean_squared_error'].append(float(epoch_rmse[g]))
+                if not validate:
+                    if epoch + 1 >= epochs[g]: active[g] = False
+                    continue
+                history[g]['val_loss'].append(float(val_loss[g]))
+                history[g]['val_root_mean_squared_error'].append(float(val_rmse[g]))
+                history[g]['lr'].append(float(lr[g]))
+
+                # EarlyStopping, the learning rate is still reduced on the
+                # epoch a well stops as Keras runs every callback
+                wait[g] += 1
+                if val_loss[g] < best[g] - min_delta:
+                    best[g], wait[g] = val_loss[g], 0
+                    for best_w, w in zip(best_weights, weights): best_w[g] = w[g]
+                elif wait[g] >= patience and epoch > 0:
+                    active[g] = False
+                    for w, best_w in zip(weights, best_weights): w[g] = best_w[g]
+
+                # ReduceLROnPlateau
+                if val_loss[g] < best_lr[g] - lr_min_delta:
+                    best_lr[g], wait_lr[g] = val_loss[g], 0
+                else:
+                    wait_lr[g] += 1
+                    if wait_lr[g] >= lr_patience:
+                        lr[g] = max(lr[g] * lr_factor, min_lr)
+                        wait_lr[g] = 0
+                if epoch + 1 >= epochs[g]: active[g] = False
+            if validate:
+                self.set_weights(weights)
+                self.lr.assign(lr)
+        return history
+
+    def predict_well(self, g, x):
+        # Prediction of well g without dropout, shaped as Keras' (n, 1)
+        W1, b1, W2, b2, W3, b3 = [w[g] for w in self.get_weights()]
+        x = np.asarray(x, dtype = np.float32)
+        h = np.maximum(x @ W1[:x.shape[1]] + b1, 0)
+        h = np.maximum(h @ W2 + b2, 0)
+        return h @ W3 + b3
+
+    def well_weights(self, g):
+        # Weights of well g in the layout of utils_04_models
+        weights = [w[g] for w in self.get_weights()]
+        weights[0] = weights[0][:self.input_dims[g]]
+        return weights
+
+    def set_well_weights(self, g, weights):
+        # weights of a model trained on the features of well g, see
+        # utils_04_parallel.warm_start_fits
+        if np.shape(weights[0])[0] != self.input_dims[g]:
+            raise ValueError(f'Weights of {np.shape(weights[0])[0]} features for a well of {self.input_dims[g]}')
+        stacked = self.get_weights()
+        # The first kernel of a padded well only fills its own feature rows
+        for w, new in zip(stacked, weights): w[g][:len(new)] = np.asarray(new, dtype = np.float32)
+        self.set_weights(stacked)
+
+    def well(self, g):
+        # predict of a single well, the model argument kfold_train expects
+        return lambda x: self.predict_well(g, x)
+
+
+def kfold_train_batched(tasks):
+    # Trains the wells of tasks together, fold by fold, with one batched_mlp
+    # per fold and the final retraining continuing from the last fold as in
+    # kfold_train. Tasks must share folds and hidden layers. Returns the
+    # results in task order, a well that failed returns its exception.
+    start = time.perf_counter()
+    seed = tasks[0].get('seed', 42)
+    folds = tasks[0].get('folds', 5)
+    random.seed(seed)
+    np.random.seed(seed)
+    set_seed(seed=seed)
+    results = [None] * len(tasks)
+    states = [None] * len(tasks)
+    for g, task in enumerate(tasks):
+        try: states[g] = utils_04_parallel.kfold_state(task)
+        except Exception as e: results[g] = e
+    l2 = [task.get('l2', 0.1) for task in tasks]
+
+    def live():
+        return [g for g in range(len(tasks)) if results[g] is None]
+
+    for j in range(1, folds+1):
+        sets = [None] * len(tasks)
+        for g in live():
+            try: sets[g] = utils_04_parallel.fold_sets(states[g], *states[g]['splits'][j-1])
+            except Exception as e: results[g] = e
+        dims = [0 if s is None else s[0].shape[1] for s in sets]
+        model = batched_mlp(dims, l2 = l2, seed = seed + j)
+        for g in live():
+            if states[g]['warm']: model.set_well_weights(g, utils_04_parallel.warm_weights(states[g], j))
+        history = model.fit([None if s is None else s[0] for s in sets],
+                            [None if s is None else s[4] for s in sets],
+                            epochs = 700, seed = seed + j,
+                            validation_data = ([None if s is None else s[1] for s in sets],
+                                               [None if s is None else s[5] for s in sets]))
+        for g in live():
+            try:
+                utils_04_parallel.fold_metrics(states[g], j, sets[g], model.well(g))
+                utils_04_parallel.keep_model(states[g], model.well_weights(g))
+                states[g]['n_epochs'].append(len(history[g]['loss']))
+            except Exception as e: results[g] = e
+
+    # Retrain every well with its number of epochs
+    final = [None] * len(tasks)
+    epochs = np.zeros(len(tasks), dtype = int)
+    for g in live():
+        try:
+            final[g] = utils_04_parallel.final_sets(states[g])
+            epochs[g] = int(sum(states[g]['n_epochs'])/folds)
+        except Exception as e: results[g] = e
+    history = model.fit([None if f is None or results[g] is not None else f[0] for g, f in enumerate(final)],
+                        [None if f is None or results[g] is not None else f[1] for g, f in enumerate(final)],
+                        epochs = epochs, seed = seed + folds + 1)
+    for g in live():
+        try:
+            X, Y, X_pred = final[g]
+            results[g] = utils_04_parallel.final_result(states[g], X, Y, X_pred, model.well(g),
+                                                        history[g], int(epochs[g]), model.well_weights(g))
+        except Exception as e: results[g] = e
+
+    # Training time of the group shared among its wells
+    for result in results:
+        if not isinstance(result, Exception): result['seconds'] = (time.perf_counter() - start) / len(tasks)
+    return results
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:30:00 2026
+
+@author: saulg
+"""
+import os
+import pickle
+
+
+# Support Script for Groundwater Imputation Tool
+# Checkpoints of the wells an imputation run has finished. Every finished well
+# is one pickled record appended to <name>.checkpoint, records are only ever
+# appended and written in groups of every wells, flushed and synced to disk.
+# A crash while writing leaves at most one incomplete record at the end of the
+# file, it is dropped when the file is read. The scripts remove the checkpoint
+# once their outputs are saved.
+
+# Result entries kept for a finished well, enough to merge it again
+record_keys = ['Metrics', 'Model_Runs', 'Prediction', 'Feature_Correlation', 'Model',
+               'epochs', 'fold_epochs', 'warm_start', 'seconds']
+
+
+class checkpoint():
+    def __init__(self, name:str, path:str, every = 10):
+        self.file = os.path.join(path, name + '.checkpoint')
+        self.every = every
+        self.pending = []
+
+    def read(self):
+        # Finished wells as {well: result}, the results are marked reused so
+        # they are merged without being trained or plotted again
+        records = dict()
+        if not os.path.isfile(self.file): return records
+        end = 0
+        with open(self.file, 'rb') as handle:
+            while True:
+                try: well, record = pickle.load(handle)
+                except EOFError: break
+                except (pickle.UnpicklingError, ValueError, AttributeError, IndexError): break
+                end = handle.tell()
+                record.update({'well': well, 'history': None, 'reused': True})
+                records[well] = record
+        # Drop an incomplete record left by a crash
+        if end < os.path.getsize(self.file):
+            with open(self.file, 'r+b') as handle: handle.truncate(end)
+        return records
+
+    def add(self, well, result):
+        self.pending.append((well, {key: result[key] for key in record_keys if key in result}))
+        if len(self.pending) >= self.every: self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        with open(self.file, 'ab') as handle:
+            for record in self.pending: pickle.dump(record, handle, protocol = 3)
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.pending = []
+
+    def remove(self):
+        self.pending = []
+        if os.path.isfile(self.file): os.remove(self.file)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 00:30:00 2026
+
+@author: saulg
+"""
+import numpy as np
+import pandas as pd
+
+
+# Support Script for Groundwater Imputation Tool
+# Feature tables of 04_Imputation_Remote.py. The features of a well are its
+# PDSI cell, its GLDAS cell with the surface water and groundwater features
+# derived from it, the rolling windows of its prior and the month dummies,
+# kept on the dates where every one of them has values. The blocks of a cell
+# and the dummies do not depend on the well, they are built once on
+# Feature_Index and the table of a well is one array of dtype filled by
+# slicing the blocks on the dates they share.
+
+gldas_names = ['Psurf_f_inst',
+               'Wind_f_inst',
+               'Qair_f_inst',
+               'Qh_tavg',
+               'Qsb_acc',
+               'PotEvap_tavg',
+               'Tair_f_inst',
+               'Rainf_tavg',
+               'SoilMoi0_10cm_inst',
+               'SoilMoi10_40cm_inst',
+               'SoilMoi40_100cm_inst',
+               'SoilMoi100_200cm_inst',
+               'CanopInt_inst',
+               'SWE_inst',
+               'Lwnet_tavg',
+               'Swnet_tavg']
+
+# Surface water is the sum of the soil moisture, canopy and snow columns
+sw_names = ['SoilMoi0_10cm_inst',
+            'SoilMoi10_40cm_inst',
+            'SoilMoi40_100cm_inst',
+            'SoilMoi100_200cm_inst',
+            'CanopInt_inst',
+            'SWE_inst']
+
+
+def gldas_features(table_gldas):
+    # GLDAS columns of a cell followed by Surface Water and the groundwater
+    # features ln(QSB_acc), ln(RW 4 Rainf_tavg) and Sum Soil Moist
+    table_gldas = table_gldas[gldas_names]
+    table_sw = table_gldas[sw_names].sum(axis=1)
+    table_gwf = pd.DataFrame(index = table_gldas.index)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        table_gwf['ln(QSB_acc)'] = np.log(table_gldas['Qsb_acc'])
+        table_gwf['ln(RW 4 Rainf_tavg)'] = np.log(table_gldas['Rainf_tavg'].rolling(4, min_periods=1).sum())
+    table_gwf['Sum Soil Moist'] = (table_sw - table_gldas['CanopInt_inst'] - table_gldas['SWE_inst']).rolling(3, min_periods=1).sum()
+    return pd.concat([table_gldas, table_sw.rename('Surface Water'), table_gwf], axis=1)
+
+
+def month_dummies(feature_index):
+    # One column per month name and Months, the time since the first month
+    # scaled to 0 - 1
+    table_dumbies = pd.get_dummies(feature_index.month_name())
+    table_dumbies.index = feature_index
+    table_dumbies['Months'] = (feature_index - feature_index[0]).astype(int)
+    table_dumbies['Months'] = table_dumbies['Months']/table_dumbies['Months'][-1]
+    return table_dumbies
+
+
+class feature_builder():
+    def __init__(self, feature_index, PDSI_Data, GLDAS_Data, dtype = 'float32'):
+        self.index = feature_index
+        self.pdsi = PDSI_Data
+        self.gldas = GLDAS_Data
+        self.dtype = np.dtype(dtype)
+        self.blocks = dict()
+        dummies = month_dummies(feature_index)
+        self.no_scale = dummies.columns.to_list()
+        self.dummies = self._block(dummies)
+
+    def _block(self, df):
+        # Values of a table on Feature_Index and the dates where it is complete
+        df = df.to_frame() if isinstance(df, pd.Series) else df
+        values = df.reindex(self.index).to_numpy(dtype = float)
+        return values, ~np.isnan(values).any(axis=1), df.columns.to_list()
+
+    def _cell(self, name, key):
+        if (name, key) not in self.blocks:
+            if name == 'pdsi': self.blocks[name, key] = self._block(self.pdsi[key])
+            else: self.blocks[name, key] = self._block(gldas_features(self.gldas[key]))
+        return self.blocks[name, key]
+
+    def well_features(self, pdsi_key, gldas_key, table_rw):
+        # Feature_Data of a well: PDSI, GLDAS, rolling windows, surface water,
+        # groundwater features and dummies on the dates all of them share
+        pdsi = self._cell('pdsi', pdsi_key)
+        gldas = self._cell('gldas', gldas_key)
+        values, complete, columns = gldas
+        n_gldas = len(gldas_names)
+        gldas_only = (values[:, :n_gldas], complete, columns[:n_gldas])
+        derived = (values[:, n_gldas:], complete, columns[n_gldas:])
+        blocks = [pdsi, gldas_only, self._block(table_rw), derived, self.dummies]
+
+        rows = np.logical_and.reduce([block[1] for block in blocks])
+        width = sum(block[0].shape[1] for block in blocks)
+        data = np.empty((rows.sum(), width), dtype = self.dtype)
+        start = 0
+        for values, _, _ in blocks:
+            data[:, start:start + values.shape[1]] = values[rows]
+            start += values.shape[1]
+        columns = [column for block in blocks for column in block[2]]
+        return pd.DataFrame(data, index = self.index[rows], columns = columns)
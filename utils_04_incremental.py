@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:10:00 2026
+
+@author: saulg
+"""
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# Support Script for Groundwater Imputation Tool
+# Incremental re-imputation. Every well of an imputation run gets a fingerprint
+# of what it was trained on (raw readings, PDSI/GLDAS cells or selected feature
+# wells, and the training settings), stored in Well_Data['Fingerprints']. When
+# a run is repeated in incremental mode, a well whose fingerprint did not
+# change, and whose feature wells moved less than a tolerance in the iterative
+# stage, takes its prediction, runs and metrics from the previous output
+# instead of being retrained.
+
+
+def fingerprint(*parts):
+    # sha1 of tables (values, index and columns) and plain settings
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            digest.update(pd.util.hash_pandas_object(part, index = True).values.tobytes())
+            if isinstance(part, pd.DataFrame): digest.update(repr(part.columns.to_list()).encode())
+            else: digest.update(repr(part.name).encode())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def unchanged(previous, well, well_fingerprint):
+    # The well was imputed by the previous run with the same fingerprint
+    if previous is None or well not in previous.get('Runs', {}): return False
+    return previous.get('Fingerprints', pd.Series(dtype = object)).get(well) == well_fingerprint
+
+
+def inputs_moved(pretrained, previous, features, tolerance):
+    # Largest change of the feature wells between the pretrained matrix of the
+    # previous run (Well_Data['Inputs']) and the current one is over tolerance
+    if previous is None or 'Inputs' not in previous: return True
+    old = previous['Inputs']
+    if not set(features).issubset(old.columns): return True
+    old = old.reindex(index = pretrained.index, columns = features).values
+    new = pretrained[features].values
+    if (np.isnan(old) != np.isnan(new)).any(): return True
+    return bool(np.nanmax(np.abs(new - old), initial = 0) > tolerance)
+
+
+def reuse_result(previous, well, models = None):
+    # Result of the previous run shaped as the result of kfold_train
+    result = {'well':        well,
+              'Metrics':     previous['Metrics'].loc[[well]],
+              'Model_Runs':  previous['Runs'][well],
+              'Prediction':  previous['Raw_Output'][[well]].dropna(),
+              'history':     None,
+              'epochs':      0,
+              'fold_epochs': [],
+              'warm_start':  False,
+              'seconds':     0.0,
+              'Model':       None if models is None else models.get(well),
+              'reused':      True}
+    if 'Feature Correlation' in previous:
+        result['Feature_Correlation'] = previous['Feature Correlation'].loc[[well]].dropna(axis = 1, how = 'all')
+    return result
+
+
+def in_order(trained, reused):
+    # Merges the (task, result) stream of well_pool.run with the reused wells,
+    # both ordered by task['i']
+    pending = sorted(reused, key = lambda pair: pair[0]['i'])
+    for task, result in trained:
+        while pending and pending[0][0]['i'] < task['i']: yield pending.pop(0)
+        yield task, result
+    yield from pending
@@ -12,11 +12,48 @@ plt.style.use('ggplot')
 import pickle
 import os
 from scipy import interpolate
+from scipy.spatial import cKDTree
 from sklearn.metrics import mean_squared_error
 import gc
+import glob
+import inspect
+import functools
+import utils_00_storage
+import utils_04_trends
+import utils_04_rolling
+
+
+# Figure modes of imputation
+#   now:   figures are rendered when they are called, as before
+#   defer: every call is appended as a plot spec (method, arguments, the test
+#          split and data_root of the object) to figures_<pid>.queue in
+#          figures_root, render_figures draws the queues later, also in
+#          parallel
+#   none:  no figures
+# figure_wells limits the per well figures to a list of wells, aquifer figures
+# are always made unless the mode is none.
+figure_modes = ['now', 'defer', 'none']
+figure_state = ['cut_left', 'cut_right', 'gap_year']
+
+
+def _figure(plot):
+    @functools.wraps(plot)
+    def method(self, *args, **kwargs):
+        if self.figures == 'none': return
+        arguments = inspect.signature(plot).bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        arguments = arguments.arguments
+        if arguments.get('plot') is False: return
+        name = arguments.get('name')
+        if self.figure_wells is not None and name is not None:
+            if not any(str(name) == str(well) or str(name).startswith(str(well) + '_') for well in self.figure_wells): return
+        if self.figures == 'defer': return self._queue(plot.__name__, args, kwargs)
+        return plot(self, *args, **kwargs)
+    return method
+
 
 class imputation():
-    def __init__(self, data_root ='./Datasets', figures_root = './Figures Imputed'):
+    def __init__(self, data_root ='./Datasets', figures_root = './Figures Imputed', figures = 'now', figure_wells = None):
         # Data Path
         if os.path.isdir(data_root) is False:
             os.makedirs(data_root)
@@ -27,7 +64,17 @@ class imputation():
         if os.path.isdir(figures_root) is False:
             os.makedirs(figures_root)
         self.figures_root = figures_root
+        if figures not in figure_modes: raise ValueError(f'figures must be one of {figure_modes}, not {figures}')
+        self.figures = figures
+        self.figure_wells = None if figure_wells is None else list(figure_wells)
         return
+
+    def _queue(self, method, args, kwargs):
+        # One queue per process, workers never write to the same file
+        state = {key: getattr(self, key) for key in figure_state if hasattr(self, key)}
+        queue = os.path.join(self.figures_root, f'figures_{os.getpid()}.queue')
+        with open(queue, 'ab') as handle:
+            pickle.dump((method, args, kwargs, state, self.data_root), handle, protocol = 3)
        
     def read_pickle(self, pickle_file, pickle_root):
         wellfile = pickle_root + pickle_file + '.pickle'
@@ -38,6 +85,16 @@ class imputation():
     def Save_Pickle(self, Data, name:str, path:str, protocol:int = 3):
         with open(path + '/' + name + '.pickle', 'wb') as handle:
             pickle.dump(Data, handle, protocol=protocol)
+
+    def read_data(self, name, root, lazy = False):
+        # Reads the columnar store of name when it is at least as new as the
+        # pickle, else the pickle. lazy returns the store itself, tables are
+        # read when indexed.
+        if utils_00_storage.store_current(name, root): return utils_00_storage.read_store(name, root, lazy = lazy)
+        return self.read_pickle(name, root)
+
+    def Save_Store(self, Data, name:str, path:str):
+        utils_00_storage.save_store(Data, name, path)
             
     def log_errors(self, errors, name:str, path:str):
         if len(errors) == 0: pass
@@ -137,153 +194,26 @@ class imputation():
         return int_y, x_index
     
     def linear_extrap(self, f_index, y, shift, reg_perc = [1.0, 0.5, 0.25, 0.10], max_sd = 3 , outlier = 3, force_left = False, force_right=False, cSlope_left=False, cSlope_right=False):
-        # Generate extrapolation df for left and right sides
-        left = pd.DataFrame(index = f_index.index, columns = reg_perc)
-        right = pd.DataFrame(index = f_index.index, columns = reg_perc)
-        # Add df to dict to be iteratable 
-        d_side = {"left":left, "right":right}
-        # Dictionary to store metadata about slope corrections
-        d_slope = {}
-        # Find smallest slope percentage to save index for linear regression
-        # and data to determine y-intercept
-        s_min = min(reg_perc)
-        
-        # High-Level: Generate slope metadata df with S_raw, Int, Mean, Slope
-        for i, side in enumerate(d_side):
-            slope_df = pd.DataFrame(index = reg_perc, columns = ['Slope', 'Int', 'Mean'])
-            for j, perc in enumerate(reg_perc):
-                points = int(len(y.dropna()) * perc)
-                
-                # Obtain the percentage of points in each side
-                # Grab all indecies associated with the data range
-                # reindex data so that regression makes sense
-                if side == "left":
-                    data = y[:points]
-                    index = f_index[f_index.index <= data.index[-1]]
-                    index = pd.DataFrame(np.arange(points - len(index), points, 1), index = index.index, columns = ['x'])
-                    if perc == s_min:
-                        index_l = index
-                
-                elif side == "right":
-                    data = y[-points:]
-                    index = f_index[f_index.index >= data.index[0]]
-                    index = pd.DataFrame(np.arange(len(index) - len(index), len(index), 1), index = index.index, columns = ['x'])
-                    if perc == s_min:
-                        index_r = index
-
-                # Get sample Mean and Standard Deviation
-                mean = data['pchip'].mean()
-                sd = data['pchip'].std()
-                # Remove outliers for linear regression
-                data = data[(data['pchip'] <= mean + outlier * sd)]
-                # Perform Linear Regression
-                reg = self.linear_regression(index, data)
-                # Unpack slope and intercept
-                slope, intercept, _ = reg
-                # Get Mean of data set once outliers are removed
-                mean = data['pchip'].mean()
-                # Save slope mean and intercept
-                slope_df.loc[perc] = np.array([slope, intercept, mean])
-                # Extrapolate based on slope store extrapolation
-                d_side[side][perc] = index * slope + intercept
-                
-            # Update datafrme in dictionary
-            d_slope[side] = slope_df
-            # Get average slope for each side
-            if side == 'left': slope_l = slope_df['Slope'].mean()
-            elif side == 'right': slope_r = slope_df['Slope'].mean()
-        
-        # Calculate population Mean, Std, Max value, Min Value
-        pop_mean = y['pchip'].mean()
-        pop_std = y['pchip'].std()
-        max_value = pop_mean + max_sd * pop_std
-        min_value = pop_mean - max_sd * pop_std
-        
-        # Check if we're forcing prior different than data: Left
-        if force_left == 'positive': slope_l = abs(slope_l) 
-        elif force_left == 'negative': slope_l = -1 * abs(slope_l)
-        elif cSlope_left != False: slope_l = cSlope_left
-        
-        # Check if we're forcing prior different than data: Right
-        if force_right == 'positive': slope_r = abs(slope_r) 
-        elif force_right == 'negative': slope_r = -1 * abs(slope_r)
-        elif cSlope_right != False: slope_r = cSlope_right
-        
-        # Extrapolate based on mean slope
-        extrap_l = index_l * slope_l + d_slope['left']['Mean'].loc[s_min]
-        extrap_r = index_r * slope_r + d_slope['right']['Mean'].loc[s_min]
-        
-        # Replace extrapolated values that exceed limits
-        # Correct Left Side
-        extrap_l['x'] = np.where(extrap_l['x'] <= max_value, extrap_l['x'], max_value)
-        extrap_l['x'] = np.where(extrap_l['x'] >= min_value, extrap_l['x'], min_value)
-        
-        # Correct Right Side
-        extrap_r['x'] = np.where(extrap_r['x'] <= max_value, extrap_r['x'], max_value)
-        extrap_r['x'] = np.where(extrap_r['x'] >= min_value, extrap_r['x'], min_value)
-        
-        # Fill Extrapolation
-        extrap_df = self.Data_Join(f_index, y).drop(['x'], axis=1)
-        filled = extrap_df['pchip'].fillna(extrap_l['x'])
-        filled = filled.fillna(extrap_r['x'])
-        return filled, d_side, d_slope
+        # One well of utils_04_trends.linear_extrap_batch on the dates of f_index,
+        # returns the filled prior, the lines of every side and percentage and
+        # their slope metadata
+        prior = np.full((1, len(f_index)), np.nan)
+        prior[0, f_index.index.get_indexer(y.index)] = y['pchip'].values
+        filled, sides = utils_04_trends.linear_extrap_batch(prior, reg_perc, max_sd, outlier, force_left, force_right,
+                                                            cSlope_left, cSlope_right)
+        return utils_04_trends.extrap_frames(filled, sides, f_index.index, reg_perc)
 
     def hampel_filter(self, df_imp, df_obs, max_sd  = 3, window = 36, center = True):
-        # set dataframe filtering limits
-        left = max(df_imp.index[0], df_obs.index[0])
-        right = min(df_imp.index[-1], df_obs.index[-1])
-        
-        # Create empty df same size as imputation df
-        df = pd.DataFrame(index = df_imp.index, columns = df_imp.columns)
-        # Filter observed values within data range
-        df_obs = df_obs.loc[(df_obs.index >= left) & (df_obs.index <= right), :]
-        # Fill df to ensure hampel doesn't remove observed measurements
-        df = df.fillna(df_obs)
-        
-        # Standard deviation approximation
-        L = 1.4826
-        
-        # Copy data
-        data = df_imp.copy()
-        
-        # Generate find average median Done because edges will not have data
-        if center == True:
-            roll = data.rolling(window=window, min_periods = 1, center=True).median()
-        elif center == False:
-            roll = data.rolling(window=window, min_periods = 1, center=False).median()
-        
-        # Applying filter
-        difference = np.abs(roll - data)
-        mad = difference.rolling(window, min_periods = 1).median()
-        threshold = max_sd * L * mad
-        outlier_idx = difference > threshold
-        data[outlier_idx] = roll # np.nan #roll_median #
-        
-        # Fill observed data with filtered measurements
-        df = df.fillna(data).astype(float)
-        return df
+        # Rolling median filter of utils_04_rolling, observed measurements
+        # within the imputation dates are never removed
+        observed = df_obs.reindex(index = df_imp.index, columns = df_imp.columns).to_numpy(dtype = float)
+        data = utils_04_rolling.hampel(df_imp.to_numpy(dtype = float), observed, max_sd = max_sd, window = window, center = center)
+        return pd.DataFrame(data, index = df_imp.index, columns = df_imp.columns)
     
     def smooth(self, df_imp, df_obs, window = 36, center = True):
-        # set dataframe filtering limits
-        left = max(df_imp.index[0], df_obs.index[0])
-        right = min(df_imp.index[-1], df_obs.index[-1])
-        
-        # Create empty df same size as imputation df
-        df = pd.DataFrame(index = df_imp.index, columns = df_imp.columns)
-        # Filter observed values within data range
-        df_obs = df_obs.loc[(df_obs.index >= left) & (df_obs.index <= right), :]
-        # Fill df to ensure hampel doesn't remove observed measurements
-        df = df.fillna(df_obs)
-        # Copy data
-        data = df_imp.copy()
-        # Generate find average median Done because edges will not have data
-        if center == True:
-            roll = data.rolling(window=window, min_periods = 1, center=True).median()
-        elif center == False:
-            roll = data.rolling(window=window, min_periods = 1, center=False).median()
-        # Fill observed data with filtered measurements
-        df = df.fillna(roll).astype(float)
-        return df
+        observed = df_obs.reindex(index = df_imp.index, columns = df_imp.columns).to_numpy(dtype = float)
+        data = utils_04_rolling.smooth(df_imp.to_numpy(dtype = float), observed, window = window, center = center)
+        return pd.DataFrame(data, index = df_imp.index, columns = df_imp.columns)
         
     
     def linear_regression(self, f_index, y):
@@ -360,6 +290,7 @@ class imputation():
         np.savetxt(self.figures_root + 'Error_Wells.txt', Metrics.values, fmt='%d')
         return metrics_result, normalized_metrics
 
+    @_figure
     def Model_Training_Metrics_plot(self, Data, name, show=False):
         fig = plt.figure()
         for key in Data: plt.plot(Data[key])
@@ -373,8 +304,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
     
+    @_figure
     def trend_plot(self, pchip, extrap_df, extrap_md, raw, name, extension = '.png', show=False):
         slopes_l = extrap_df['left']
         slopes_r = extrap_df['right']
@@ -412,8 +343,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
 
+    @_figure
     def rw_plot(self, y, rw, name, save = False, extension = '.png', show=False):
         fig = plt.figure(figsize=(12, 8))
         plt.plot(rw)
@@ -426,8 +357,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
     
+    @_figure
     def Q_Q_plot(self, Prediction, Observation, name, limit_low = 0, limit_high = 1, extension = '.png', show=False):
         #Plotting Prediction Correlation
         fig = plt.figure()
@@ -448,8 +379,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
 
+    @_figure
     def observeation_vs_prediction_plot(self, Prediction_X, Prediction_Y, Observation_X, Observation_Y, name, metrics=None, error_on = False, show=False):
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111)
@@ -471,8 +402,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
         
+    @_figure
     def residual_plot(self, Prediction_X, Prediction_Y, Observation_X, Observation_Y, name, show=False):
         date_rng = pd.DataFrame(np.arange(0, len(Observation_X), 1), index = Observation_X)
         data = self.Data_Join(Prediction_Y, Observation_Y).dropna()
@@ -501,8 +432,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)  
-        gc.collect()
 
+    @_figure
     def observeation_vs_imputation_plot(self, Prediction_X, Prediction_Y, Observation_X, Observation_Y, name, show=False):
         fig = plt.figure(figsize=(12, 8))
         plt.plot(Prediction_X, Prediction_Y, "darkblue")
@@ -516,8 +447,8 @@ class imputation():
         else: 
             fig.clf()
             plt.close(fig)
-        gc.collect()
 
+    @_figure
     def raw_observation_vs_prediction(self, Prediction, Raw, name, Aquifer, metrics=None, error_on = False, test=False, show=False):
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111)
@@ -541,8 +472,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
         
+    @_figure
     def raw_observation_vs_filled(self, Prediction, Raw, name, Aquifer, df_spread=None, conf_interval = None, 
                                   ci = 1, metrics=None, error_on = False, test=False, show=False):
         fig = plt.figure(figsize=(12, 8))
@@ -575,8 +506,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
     
+    @_figure
     def raw_observation_vs_imputation(self, Prediction, Raw, name, Aquifer, metrics=None, show=False):
         fig = plt.figure(figsize=(12, 8))
         plt.plot(Prediction.index, Prediction, 'darkblue', label='Model', linewidth=1.0)
@@ -588,8 +519,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
 
+    @_figure
     def observeation_vs_prediction_scatter_plot(self, Prediction, Y_train, Y_val, name, metrics=None, error_on = False, show=False):
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111)
@@ -611,8 +542,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
     
+    @_figure
     def prediction_vs_test(self, Prediction, Well_set_original, y_test, name, metrics=None, error_on = False, show=False):
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111)
@@ -638,8 +569,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
         
+    @_figure
     def prediction_kfold(self, Prediction, Well_set_original, y_test, name, metrics=None, error_on = False, show=False, plot=False):
         if plot == True:
             fig = plt.figure(figsize=(12, 8))
@@ -666,8 +597,8 @@ class imputation():
             else:
                 fig.clf()
                 plt.close(fig)
-            gc.collect()
         
+    @_figure
     def prediction_vs_test_kfold(self, Prediction, Well_set_original, name, metrics=None, error_on = False, show=False):
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111)
@@ -690,8 +621,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)    
-        gc.collect()
         
+    @_figure
     def Feature_Importance_box_plot(self, importance_df, show=False):
         #All Data       
         importance_df.boxplot(figsize=(20,10))
@@ -727,8 +658,8 @@ class imputation():
         plt.savefig(self.figures_root  + '/' + 'Feature_Importance_Lower')
         if show: plt.show()
         else: plt.close()
-        gc.collect()
 
+    @_figure
     def feature_plot(self, Feature_Data, raw, name, show=False):
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111)
@@ -746,8 +677,8 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
 
+    @_figure
     def Aquifer_Plot(self, imputed_df, show=False):
         fig = plt.figure(figsize=(12, 8))
         plt.plot(imputed_df)
@@ -757,5 +688,107 @@ class imputation():
         else:
             fig.clf()
             plt.close(fig)
-        gc.collect()
-           
\ No newline at end of file
+
+
+class spatial_index():
+    # KD-tree built once on a Location table (Longitude, Latitude) such as
+    # PDSI_Data['Location'], GLDAS_Data['Location'] or Well_Data['Location'].
+    # Answers nearest and k-nearest queries for many points in one call and
+    # returns the keys of the Location table. With metric 'haversine' the
+    # coordinates are placed on the unit sphere, the nearest chord is the
+    # nearest great circle and distances are returned in the units of radius.
+    def __init__(self, location, metric = 'euclidean', radius = 6371.0):
+        location = location.dropna(axis=0).astype(float)
+        self.keys = location.index
+        self.metric = metric
+        self.radius = radius
+        self.tree = cKDTree(self._coordinates(location))
+
+    def _coordinates(self, location):
+        if isinstance(location, pd.DataFrame):
+            location = location[['Longitude', 'Latitude']].values
+        location = np.asarray(location, dtype=float).reshape((-1,2))
+        if self.metric == 'haversine':
+            lon = np.radians(location[:,0])
+            lat = np.radians(location[:,1])
+            return np.column_stack([np.cos(lat) * np.cos(lon),
+                                    np.cos(lat) * np.sin(lon),
+                                    np.sin(lat)])
+        return location
+
+    def _distance(self, dist):
+        if self.metric == 'haversine':
+            return 2 * np.arcsin(np.clip(dist/2, 0, 1)) * self.radius
+        return dist
+
+    def query(self, location, k = 1):
+        # Distances and keys of the k nearest entries, one row per point
+        k = min(k, len(self.keys))
+        dist, idx = self.tree.query(self._coordinates(location), k = k)
+        dist = self._distance(dist).reshape((-1, k))
+        keys = self.keys.values[idx.reshape((-1, k))]
+        return dist, keys
+
+    def nearest(self, location):
+        # Series of the nearest key for every row of a Location table, rows
+        # without coordinates are left out
+        location = location.dropna(axis=0)
+        dist, keys = self.query(location, k = 1)
+        return pd.Series(keys[:,0], index = location.index)
+
+    def distances(self, location):
+        # Distance from every point to every entry, columns follow self.keys
+        dist, idx = self.tree.query(self._coordinates(location), k = len(self.keys))
+        dist = self._distance(dist).reshape((-1, len(self.keys)))
+        idx = idx.reshape((-1, len(self.keys)))
+        out = np.empty_like(dist)
+        np.put_along_axis(out, idx, dist, axis=1)
+        return pd.DataFrame(out, index = location.index, columns = self.keys)
+
+
+def _read_queue(queue):
+    # Plot specs of a queue, a spec cut short by a crash is dropped
+    specs = []
+    with open(queue, 'rb') as handle:
+        while True:
+            try: specs.append(pickle.load(handle))
+            except EOFError: break
+            except (pickle.UnpicklingError, ValueError, AttributeError, IndexError): break
+    return specs
+
+
+def _render(figures_root, specs):
+    import matplotlib
+    matplotlib.use('Agg')
+    # One object per data folder of the queued objects
+    imps = dict()
+    rendered = 0
+    for method, args, kwargs, state, data_root in specs:
+        if data_root not in imps: imps[data_root] = imputation(data_root, figures_root)
+        imp = imps[data_root]
+        for key, value in state.items(): setattr(imp, key, value)
+        try:
+            getattr(imputation, method).__wrapped__(imp, *args, **kwargs)
+            rendered += 1
+        except Exception as e:
+            plt.close('all')
+            print(f'Could not render {method}: {e}')
+    gc.collect()
+    return rendered
+
+
+def render_figures(figures_root, n_workers = 1, chunk = 25):
+    # Draws the figures queued in figures_root by imputation(figures = 'defer'),
+    # in chunks of specs over n_workers processes, and removes the queues. The
+    # oldest queue is drawn first so a newer run overwrites its figures.
+    queues = sorted(glob.glob(os.path.join(figures_root, 'figures_*.queue')), key = os.path.getmtime)
+    specs = [spec for queue in queues for spec in _read_queue(queue)]
+    chunks = [specs[start:start+chunk] for start in range(0, len(specs), chunk)]
+    if n_workers > 1 and len(chunks) > 1:
+        import multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers = n_workers, mp_context = mp.get_context('spawn')) as executor:
+            rendered = sum(executor.map(_render, [figures_root]*len(chunks), chunks))
+    else: rendered = sum(_render(figures_root, specs) for specs in chunks)
+    for queue in queues: os.remove(queue)
+    return rendered
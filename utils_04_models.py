@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:05:00 2026
+
+@author: saulg
+"""
+import random
+import numpy as np
+
+
+# Support Script for Groundwater Imputation Tool
+# Model backends of the per-well network: two Dense layers of 50 and 100 relu
+# units with Dropout(0.2), an L2 penalty on the first kernel and a linear
+# output, trained with Adam on the mean squared error. fit with validation
+# data stops early (patience 5, best weights restored) and reduces the
+# learning rate on plateaus (factor 0.1, patience 10), fit without it trains
+# for a fixed number of epochs continuing from the current state.
+#   keras: TensorFlow Sequential model, imported only when it is used
+#   numpy: the same network in NumPy, no TensorFlow in the process
+# Every backend has reset(seed), fit(x, y, epochs, validation_data) returning
+# the history dictionary, predict(x) returning an (n, 1) array and
+# get_weights/set_weights with the Keras layout [W1, b1, W2, b2, W3, b3], so
+# the weights of one backend can start another.
+
+
+class keras_mlp():
+    def __init__(self, input_dim, hidden_nodes = 50, l2 = 0.1, learning_rate = 0.001):
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.layers import Dense, Dropout
+        from tensorflow.keras.optimizers import Adam
+        from tensorflow.keras.regularizers import L2
+        from tensorflow.keras.metrics import RootMeanSquaredError
+        opt = Adam(learning_rate=learning_rate)
+        model = Sequential()
+        model.add(Dense(hidden_nodes, input_dim = input_dim, activation = 'relu', use_bias=True,
+            kernel_initializer='glorot_uniform', kernel_regularizer= L2(l2=l2)))
+        model.add(Dropout(rate=0.2))
+        model.add(Dense(2*hidden_nodes, input_dim = input_dim, activation = 'relu', use_bias=True,
+            kernel_initializer='glorot_uniform'))
+        model.add(Dropout(rate=0.2))
+        model.add(Dense(1))
+        model.compile(optimizer = opt, loss='mse', metrics=[RootMeanSquaredError()])
+        self.model = model
+
+    @staticmethod
+    def reset(seed):
+        # Keras draws unseeded initializers from python's random module
+        from tensorflow.keras import backend
+        from tensorflow.random import set_seed
+        backend.clear_session()
+        random.seed(seed)
+        np.random.seed(seed)
+        set_seed(seed=seed)
+
+    def fit(self, x, y, epochs = 700, validation_data = None):
+        from tensorflow.keras import callbacks
+        if validation_data is None:
+            return self.model.fit(x, y, epochs = epochs, verbose = 0).history
+
+        # Hyper Paramter Adjustments
+        early_stopping = callbacks.EarlyStopping(
+                            monitor='val_loss',
+                            patience=5,
+                            min_delta=0.0,
+                            restore_best_weights=True)
+        adaptive_lr    = callbacks.ReduceLROnPlateau(
+                            monitor='val_loss',
+                            factor=0.1,
+                            min_lr=0)
+        history        = self.model.fit(
+                            x,
+                            y,
+                            epochs=epochs,
+                            validation_data = validation_data,
+                            verbose= 0,
+                            callbacks=[early_stopping, adaptive_lr])
+        return history.history
+
+    def predict(self, x):
+        return self.model.predict(x)
+
+    def get_weights(self):
+        return self.model.get_weights()
+
+    def set_weights(self, weights):
+        self.model.set_weights(weights)
+
+
+class numpy_mlp():
+    # Mirrors keras_mlp: glorot uniform kernels, zero biases, Adam with the
+    # Keras constants, shuffled batches of 32, loss = mse + l2 * sum(W1**2).
+    # The weights are drawn from the global NumPy state so a well seeded with
+    # reset returns the same models in the same order.
+    def __init__(self, input_dim, hidden_nodes = 50, l2 = 0.1, learning_rate = 0.001, dropout = 0.2):
+        self.rng = np.random.RandomState(np.random.randint(2**31 - 1))
+        self.l2 = l2
+        self.lr = learning_rate
+        self.dropout = dropout
+        H = hidden_nodes
+
+        def glorot(fan_in, fan_out):
+            limit = np.sqrt(6 / (fan_in + fan_out))
+            return self.rng.uniform(-limit, limit, (fan_in, fan_out))
+
+        self.weights = [glorot(input_dim, H), np.zeros(H),
+                        glorot(H, 2*H),       np.zeros(2*H),
+                        glorot(2*H, 1),       np.zeros(1)]
+        self.m = [np.zeros_like(w) for w in self.weights]
+        self.v = [np.zeros_like(w) for w in self.weights]
+        self.iterations = 0
+
+    @staticmethod
+    def reset(seed):
+        random.seed(seed)
+        np.random.seed(seed)
+
+    def _forward(self, x, training = False):
+        W1, b1, W2, b2, W3, b3 = self.weights
+        z1 = x @ W1 + b1
+        h1 = np.maximum(z1, 0)
+        d1 = self._mask(h1.shape) if training else 1
+        z2 = (h1 * d1) @ W2 + b2
+        h2 = np.maximum(z2, 0)
+        d2 = self._mask(h2.shape) if training else 1
+        out = (h2 * d2) @ W3 + b3
+        return out, (x, z1, h1 * d1, d1, z2, h2 * d2, d2)
+
+    def _mask(self, shape):
+        return (self.rng.uniform(size = shape) >= self.dropout) / (1 - self.dropout)
+
+    def _penalty(self):
+        return self.l2 * np.sum(self.weights[0]**2)
+
+    def _step(self, x, y):
+        out, (x, z1, h1, d1, z2, h2, d2) = self._forward(x, training = True)
+        W1, b1, W2, b2, W3, b3 = self.weights
+        error = out - y
+        d_out = 2 * error / len(y)
+        d_z2 = (d_out @ W3.T) * d2 * (z2 > 0)
+        d_z1 = (d_z2 @ W2.T) * d1 * (z1 > 0)
+        grads = [x.T @ d_z1 + 2 * self.l2 * W1, d_z1.sum(axis=0),
+                 h1.T @ d_z2,                   d_z2.sum(axis=0),
+                 h2.T @ d_out,                  d_out.sum(axis=0)]
+
+        # Adam as in Keras
+        beta_1, beta_2, epsilon = 0.9, 0.999, 1e-7
+        self.iterations += 1
+        alpha = self.lr * np.sqrt(1 - beta_2**self.iterations) / (1 - beta_1**self.iterations)
+        for w, g, m, v in zip(self.weights, grads, self.m, self.v):
+            m += (g - m) * (1 - beta_1)
+            v += (g**2 - v) * (1 - beta_2)
+            w -= alpha * m / (np.sqrt(v) + epsilon)
+        sse = np.sum(error**2)
+        return sse / len(y) + self._penalty(), sse
+
+    def fit(self, x, y, epochs = 700, validation_data = None, batch_size = 32):
+        x = np.asarray(x, dtype = float)
+        y = np.asarray(y, dtype = float).reshape(-1, 1)
+        validate = validation_data is not None
+        if validate:
+            x_val = np.asarray(validation_data[0], dtype = float)
+            y_val = np.asarray(validation_data[1], dtype = float).reshape(-1, 1)
+            best, wait, best_weights = np.inf, 0, [w.copy() for w in self.weights]
+            best_lr, wait_lr = np.inf, 0
+        keys = ['loss', 'root_mean_squared_error'] + (['val_loss', 'val_root_mean_squared_error', 'lr'] if validate else [])
+        history = {key: [] for key in keys}
+
+        for epoch in range(epochs):
+            order = self.rng.permutation(len(x))
+            loss_sum, sse_sum = 0.0, 0.0
+            for start in range(0, len(x), batch_size):
+                batch = order[start:start+batch_size]
+                loss, sse = self._step(x[batch], y[batch])
+                loss_sum += loss * len(batch)
+                sse_sum += sse
+            history['loss'].append(loss_sum / len(x))
+            history['root_mean_squared_error'].append(np.sqrt(sse_sum / len(x)))
+            if not validate: continue
+
+            val_sse = np.sum((self._forward(x_val)[0] - y_val)**2)
+            val_loss = val_sse / len(y_val) + self._penalty()
+            history['val_loss'].append(val_loss)
+            history['val_root_mean_squared_error'].append(np.sqrt(val_sse / len(y_val)))
+            history['lr'].append(self.lr)
+
+            # EarlyStopping, the learning rate is still reduced on the epoch
+            # training stops as Keras runs every callback
+            stop = False
+            wait += 1
+            if val_loss < best:
+                best, wait, best_weights = val_loss, 0, [w.copy() for w in self.weights]
+            elif wait >= 5 and epoch > 0:
+                stop = True
+                self.weights = best_weights
+
+            # ReduceLROnPlateau
+            if val_loss < best_lr - 1e-4:
+                best_lr, wait_lr = val_loss, 0
+            else:
+                wait_lr += 1
+                if wait_lr >= 10:
+                    self.lr = max(self.lr * 0.1, 0)
+                    wait_lr = 0
+            if stop: break
+        return history
+
+    def predict(self, x):
+        return self._forward(np.asarray(x, dtype = float))[0]
+
+    def get_weights(self):
+        return [w.copy() for w in self.weights]
+
+    def set_weights(self, weights):
+        # Keras raises on weights of another layout, a reshape would scramble them
+        if len(weights) != len(self.weights):
+            raise ValueError(f'Expected {len(self.weights)} weight arrays, got {len(weights)}')
+        for w, v in zip(weights, self.weights):
+            if np.shape(w) != v.shape: raise ValueError(f'Weights of shape {np.shape(w)} for a layer of shape {v.shape}')
+        self.weights = [np.array(w, dtype = float) for w in weights]
+
+
+backends = {'keras': keras_mlp,
+            'numpy': numpy_mlp}
+
+
+def build_model(input_dim, hidden_nodes = 50, l2 = 0.1, learning_rate = 0.001, backend = 'keras'):
+    return backends[backend](input_dim, hidden_nodes = hidden_nodes, l2 = l2, learning_rate = learning_rate)
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:15:00 2026
+
+@author: saulg
+"""
+import os
+import copy
+import time
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import utils_04_machine_learning
+import utils_04_models
+from scipy.stats import pearsonr
+
+from sklearn.model_selection import train_test_split
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+
+
+
+# Support Script for Groundwater Imputation Tool
+# Wells are trained independently of each other, this script holds the per-well
+# k-fold training used by the imputation scripts and a pool that hands each
+# well to a separate process. Every well is seeded on its own so a well returns
+# the same model whether it is trained serially or by a worker.
+# Large read-only tables, such as the pretrained imputation matrix, are placed
+# in shared memory once and attached by every worker instead of being pickled
+# with every well.
+
+# Frames shared with the wells of the current pool, filled by _init_worker in
+# the workers or directly by well_pool when running serially.
+_shared_frames = dict()
+_shared_memory = []
+
+
+def shared_data(name):
+    return _shared_frames[name]
+
+
+class shared_frame():
+    # Copies the values of a float DataFrame into a shared memory block. The
+    # handle is small and picklable, it is all a worker needs to attach.
+    def __init__(self, df):
+        values = np.ascontiguousarray(df.values, dtype=float)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        array = np.ndarray(values.shape, dtype=values.dtype, buffer=self.shm.buf)
+        array[:] = values
+        self.handle = {'name':    self.shm.name,
+                       'shape':   values.shape,
+                       'dtype':   values.dtype.str,
+                       'index':   df.index,
+                       'columns': df.columns}
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_frame(handle):
+    # DataFrame view on a shared block, no copy is made. The block is kept open
+    # for the life of the worker and is read-only.
+    shm = shared_memory.SharedMemory(name=handle['name'])
+    _shared_memory.append(shm)
+    array = np.ndarray(handle['shape'], dtype=np.dtype(handle['dtype']), buffer=shm.buf)
+    array.flags.writeable = False
+    return pd.DataFrame(array, index=handle['index'], columns=handle['columns'], copy=False)
+
+
+def _init_worker(threads = 1, handles = None, tensorflow = True):
+    # Pin the number of threads each worker is allowed to use, otherwise every
+    # process will try to claim every core. TensorFlow is only imported by
+    # workers training Keras models.
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    if tensorflow:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    # Workers only save figures, never show them
+    import matplotlib
+    matplotlib.use('Agg')
+    # Attach the shared tables
+    if handles is not None:
+        for name, handle in handles.items():
+            _shared_frames[name] = attach_frame(handle)
+
+
+class well_pool():
+    # n_workers of 1 runs every task in the current process, larger values
+    # spawn a process pool. Results are always returned in the order the tasks
+    # were given so the merge into the aquifer tables is deterministic.
+    # shared is a dictionary of float DataFrames read by the tasks through
+    # shared_data(name). tensorflow = False keeps TensorFlow out of the workers
+    # when wells are trained with the numpy backend.
+    def __init__(self, n_workers = 1, threads = 1, shared = None, tensorflow = True):
+        self.n_workers = n_workers
+        self.threads = threads
+        self.executor = None
+        self.shared = []
+        if self.n_workers > 1:
+            handles = None
+            if shared is not None:
+                handles = dict()
+                for name, df in shared.items():
+                    frame = shared_frame(df)
+                    self.shared.append(frame)
+                    handles[name] = frame.handle
+            context = mp.get_context('spawn')
+            self.executor = ProcessPoolExecutor(max_workers = self.n_workers,
+                                                mp_context = context,
+                                                initializer = _init_worker,
+                                                initargs = (self.threads, handles, tensorflow))
+        elif shared is not None:
+            _shared_frames.update(shared)
+
+    def run(self, func, tasks):
+        # Generator of (task, result), a failed task returns its exception. A
+        # process pool is handed every task before run returns, the caller
+        # can work while they are trained.
+        if self.executor is None: return self._run_serial(func, tasks)
+        futures = [self.executor.submit(func, task) for task in tasks]
+        return self._collect(tasks, futures)
+
+    def _run_serial(self, func, tasks):
+        for task in tasks:
+            try: result = func(task)
+            except Exception as e: result = e
+            yield task, result
+
+    def _collect(self, tasks, futures):
+        for task, future in zip(tasks, futures):
+            try: result = future.result()
+            except Exception as e: result = e
+            yield task, result
+
+    def run_batched(self, func, tasks, batch_size):
+        # func takes a list of tasks and returns their results in order, such
+        # as utils_04_batched.kfold_train_batched. Tasks are handed over in
+        # groups of batch_size and yielded one by one as in run.
+        groups = [tasks[i:i+batch_size] for i in range(0, len(tasks), batch_size)]
+        for group, results in self.run(func, groups):
+            if isinstance(results, Exception): results = [results] * len(group)
+            for task, result in zip(group, results): yield task, result
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = True)
+            self.executor = None
+        for frame in self.shared: frame.close()
+        self.shared = []
+        _shared_frames.clear()
+
+
+def kfold_train(task, fold_pool = None):
+    # task is a dictionary holding everything a well needs to be trained:
+    #   well:        well name
+    #   X, Y:        cleaned feature and target tables
+    #   Feature_Data: complete feature table used for the prediction
+    #   y_well:      well readings, used for plotting
+    #   index:       Feature_Index, index of the model runs
+    #   no_scale:    feature columns that are not scaled (dummies)
+    #   columns:     metric names
+    #   refit:       refit the scalers on the complete set before retraining
+    #   me_sign:     1 for mean error as prediction - observation, -1 reversed
+    #   backend:     model backend of utils_04_models, 'keras' or 'numpy'
+    #   warm_start:  'Model' of the previous result of the well, its weights
+    #                start the folds when the features did not change
+    # fold_pool is a well_pool training every fold but the last while this
+    # process trains the last one, see kfold_fold. Every fold is seeded with
+    # seed + j on its own, the well returns the same model with or without it.
+    folds = task.get('folds', 5)
+    state = kfold_state(task)
+    fold_tasks = [(task, j, train_index, test_index) for j, (train_index, test_index) in enumerate(state['splits'], start = 1)]
+
+    # Train K-folds grab error metrics average results
+    if fold_pool is None: trained = [kfold_fold(fold_task) for fold_task in fold_tasks[:-1]]
+    else: trained = (fold for _, fold in fold_pool.run(kfold_fold, fold_tasks[:-1]))
+    last, model = fold_state(fold_tasks[-1])
+    for fold in trained:
+        if isinstance(fold, Exception): raise fold
+        merge_fold(state, fold)
+    merge_fold(state, fold_record(last, folds))
+
+    # The final model continues from the last fold, its weights, optimizer
+    # and learning rate, with the scalers of the last fold
+    state['fs'], state['ws'] = last['fs'], last['ws']
+    epochs = int(sum(state['n_epochs'])/folds)
+
+    # Retrain Model with number of epochs
+    X, Y, X_pred = final_sets(state)
+    history = model.fit(X, Y, epochs = epochs)
+    return final_result(state, X, Y, X_pred, model.predict, history, epochs, model.get_weights())
+
+
+def train_fold(state, j, train_index, test_index):
+    # Trains fold j of a well and records its metrics, runs and model
+    task = state['task']
+    sets = fold_sets(state, train_index, test_index)
+    x_train, x_val, x_test, X_pred_temp, y_train, y_val, y_test = sets
+
+    # Model Initialization
+    model = utils_04_models.build_model(x_train.shape[1], l2 = task.get('l2', 0.1), backend = task.get('backend', 'keras'))
+    if state['warm']: model.set_weights(warm_weights(state, j))
+    history = model.fit(x_train, y_train, epochs = 700, validation_data = (x_val, y_val))
+
+    fold_metrics(state, j, sets, model.predict)
+    keep_model(state, model.get_weights())
+    state['n_epochs'].append(len(history['loss']))
+    return model, history
+
+
+def fold_state(fold_task):
+    # Trains fold j of a well in a state of its own seeded with seed + j, so
+    # a fold does not depend on the folds before it or on the process that
+    # trains it. Returns the state and the model.
+    task, j, train_index, test_index = fold_task
+    utils_04_models.backends[task.get('backend', 'keras')].reset(task.get('seed', 42) + j)
+    state = kfold_state(task)
+    model, history = train_fold(state, j, train_index, test_index)
+    return state, model
+
+
+def fold_record(state, j):
+    # What merge_fold needs of the fold j of a fold_state
+    return {'j':       j,
+            'metrics': state['temp_metrics'].loc[str(j)],
+            'run':     state['Model_Runs'][j],
+            'epochs':  state['n_epochs'][0],
+            'model':   state['models'][0]}
+
+
+def kfold_fold(fold_task):
+    # A fold trained by kfold_train or a worker of its fold pool
+    state, model = fold_state(fold_task)
+    return fold_record(state, fold_task[1])
+
+
+def merge_fold(state, fold):
+    j = fold['j']
+    state['temp_metrics'].loc[str(j)] = fold['metrics']
+    state['Model_Runs'][j] = fold['run']
+    state['n_epochs'].append(fold['epochs'])
+    state['models'].append(fold['model'])
+
+
+# The steps of kfold_train that do not depend on the model, shared with the
+# batched trainer of utils_04_batched. state holds the scalers, folds and
+# metrics of one well between the steps, predict is the model's predict.
+def kfold_state(task):
+    X, Y = task['X'], task['Y']
+    folds = task.get('folds', 5)
+
+    # Create number of Folds
+    (Y_kfold, X_kfold) = (Y.to_numpy(), X.to_numpy())
+    kfold = KFold(n_splits = folds, shuffle = False)
+
+    # Create Dataframe to store all predictions from folds and final prediction
+    model_run_col = [*range(1, folds+2)]
+
+    # Warm start from the previous models when the well keeps its features
+    previous = task.get('warm_start')
+    features = X.columns.to_list()
+    warm = warm_start_fits(previous, features, folds)
+    state = {'task':         task,
+             'imp':          utils_04_machine_learning.imputation(task['data_root'], task['figures_root'],
+                                  task.get('figures', 'now'), task.get('figure_wells')),
+             # Initialize scalers, fs for feature scaler, ws for well scaler
+             'fs':           StandardScaler(),
+             'ws':           StandardScaler(),
+             'splits':       list(kfold.split(Y_kfold, X_kfold)),
+             'temp_metrics': pd.DataFrame(np.nan, index = [str(j) for j in range(1, folds+1)], columns = task['columns']),
+             'Model_Runs':   pd.DataFrame(index=task['index'], columns=model_run_col),
+             'n_epochs':     [],
+             'features':     features,
+             'warm':         warm,
+             'previous':     previous if warm else None,
+             'models':       [],
+             'start':        time.perf_counter()}
+    return state
+
+
+def warm_start_fits(previous, features, folds):
+    # The previous models of a well can start its folds when they were
+    # trained on the same features in the same order, so every row of their
+    # first kernel belongs to the same feature, and with as many folds
+    if previous is None or previous.get('features') != features: return False
+    if len(previous.get('folds', [])) != folds: return False
+    return all(np.shape(fold['weights'][0])[0] == len(features) for fold in previous['folds'])
+
+
+def warm_weights(state, j):
+    # Weights the well ended fold j with in the previous run
+    return state['previous']['folds'][j-1]['weights']
+
+
+def keep_model(state, weights):
+    # Weights and scalers of the fold just trained, the scalers are refit by
+    # the next fold so a copy is kept
+    state['models'].append({'weights': weights,
+                            'fs':      copy.deepcopy(state['fs']),
+                            'ws':      copy.deepcopy(state['ws'])})
+
+
+def fold_sets(state, train_index, test_index):
+    task, imp = state['task'], state['imp']
+    X, Y = task['X'], task['Y']
+    fs, ws = state['fs'], state['ws']
+    no_scale = task['no_scale']
+    x_train, x_test = X.iloc[train_index,:], X.iloc[test_index,:]
+    y_train, y_test = Y.iloc[train_index], Y.iloc[test_index,:]
+
+    # Create validation and training sets
+    x_train, x_val, y_train, y_val = train_test_split(x_train, y_train, test_size=task.get('val_split', 0.30), random_state=42)
+
+    x_train, fs = imp.scaler_pipline(x_train, fs, no_scale, train=True)
+
+    # Transform validation and test sets
+    x_val = imp.scaler_pipline(x_val, fs, no_scale, train=False)
+    x_test = imp.scaler_pipline(x_test, fs, no_scale, train=False)
+    X_pred_temp = imp.scaler_pipline(task['Feature_Data'], fs, no_scale, train=False)
+
+    # Transform Y values
+    y_train = pd.DataFrame(ws.fit_transform(y_train), index = y_train.index, columns = y_train.columns)
+    y_val = pd.DataFrame(ws.transform(y_val), index = y_val.index, columns = y_val.columns)
+    y_test = pd.DataFrame(ws.transform(y_test), index = y_test.index, columns = y_test.columns)
+    return x_train, x_val, x_test, X_pred_temp, y_train, y_val, y_test
+
+
+def fold_metrics(state, j, sets, predict):
+    task, imp, ws = state['task'], state['imp'], state['ws']
+    well = task['well']
+    y_well = task['y_well']
+    me_sign = task.get('me_sign', 1)
+    plot_kfolds = task.get('plot_kfolds', True)
+    x_train, x_val, x_test, X_pred_temp, y_train, y_val, y_test = sets
+    temp_metrics = state['temp_metrics']
+
+    # Score and Tracking Metrics
+    y_train     = pd.DataFrame(ws.inverse_transform(y_train), index=y_train.index,
+                              columns = ['Y Train']).sort_index(axis=0, ascending=True)
+    y_train_hat = pd.DataFrame(ws.inverse_transform(predict(x_train)), index=x_train.index,
+                              columns = ['Y Train Hat']).sort_index(axis=0, ascending=True)
+    y_val       = pd.DataFrame(ws.inverse_transform(y_val), index=y_val.index,
+                               columns = ['Y Val']).sort_index(axis=0, ascending=True)
+    y_val_hat   = pd.DataFrame(ws.inverse_transform(predict(x_val)), index=x_val.index,
+                               columns = ['Y Val Hat']).sort_index(axis=0, ascending=True)
+
+    train_points, val_points = [len(y_train)], [len(y_val)]
+
+    train_me    = (sum(me_sign * (y_train_hat.values - y_train.values)) / train_points).item()
+    train_rmse  = mean_squared_error(y_train.values, y_train_hat.values, squared=False)
+    train_mae   = mean_absolute_error(y_train.values, y_train_hat.values)
+
+    val_me      = (sum(me_sign * (y_val_hat.values - y_val.values)) / val_points).item()
+    val_rmse    = mean_squared_error(y_val.values, y_val_hat.values, squared=False)
+    val_mae     = mean_absolute_error(y_val.values, y_val_hat.values)
+
+    train_e      = [train_me, train_rmse, train_mae]
+    val_e        = [val_me, val_rmse, val_mae]
+
+    train_errors = np.array([train_e + val_e]).reshape((1,6))
+    errors_col   = ['Train ME','Train RMSE', 'Train MAE',
+                    'Validation ME','Validation RMSE', 'Validation MAE']
+    df_metrics   = pd.DataFrame(train_errors, index=([str(j)]), columns = errors_col)
+
+    df_metrics['Train Points']      = train_points
+    df_metrics['Validation Points'] = val_points
+    df_metrics['Train r2'], _       = pearsonr(y_train.values.flatten(), y_train_hat.values.flatten())
+    df_metrics['Validation r2'], _  = pearsonr(y_val.values.flatten(), y_val_hat.values.flatten())
+    temp_metrics.loc[str(j), df_metrics.columns] = df_metrics.loc[str(j)]
+
+    # Model Prediction
+    Prediction_temp = pd.DataFrame(
+                    ws.inverse_transform(predict(X_pred_temp)),
+                    index=X_pred_temp.index, columns = ['Prediction'])
+
+    # append prediction to model runs
+    state['Model_Runs'][j] = Prediction_temp.astype(float)
+
+    # Test Sets and Plots
+    try:
+        y_test       = pd.DataFrame(ws.inverse_transform(y_test), index=y_test.index,
+                           columns = ['Y Test']).sort_index(axis=0, ascending=True)
+        y_test_hat   = pd.DataFrame(ws.inverse_transform(predict(x_test)), index=y_test.index,
+                           columns = ['Y Test Hat']).sort_index(axis=0, ascending=True)
+        test_points  = len(y_test)
+        test_me      = (sum(me_sign * (y_test_hat.values - y_test.values)) / test_points).item()
+        test_rmse    = mean_squared_error(y_test.values, y_test_hat.values, squared=False)
+        test_mae     = mean_absolute_error(y_test.values, y_test_hat.values)
+
+        test_errors  = np.array([test_me, test_rmse, test_mae]).reshape((1,3))
+        test_cols    = ['Test ME', 'Test RMSE', 'Test MAE']
+        test_metrics = pd.DataFrame(test_errors,
+                                    index = [str(j)],
+                                    columns = test_cols)
+        test_metrics['Test Points'] = test_points
+        test_metrics['Test r2'], _  = pearsonr(y_test.values.flatten(), y_test_hat.values.flatten())
+        temp_metrics.loc[str(j), test_metrics.columns] = test_metrics.loc[str(j)]
+        imp.prediction_kfold(Prediction_temp['Prediction'],
+                                      y_well.drop(y_test.index, axis=0),
+                                      y_test,
+                                      str(well) +"_kfold_" + str(j),
+                                      temp_metrics.loc[str(j)],
+                                      error_on = True,
+                                      plot = plot_kfolds)
+
+    except:
+        temp_metrics.loc[str(j), ['Test ME','Test RMSE', 'Test MAE']] = np.NAN
+        temp_metrics.loc[str(j), 'Test Points'] = 0
+        temp_metrics.loc[str(j),'Test r2'] = np.NAN
+        imp.prediction_kfold(Prediction_temp['Prediction'],
+                                y_well.drop(y_test.index, axis=0),
+                                y_test,
+                                str(well) +"_kfold_" + str(j),
+                                plot = plot_kfolds)
+    state['temp_metrics'] = temp_metrics
+
+
+def final_sets(state):
+    task, imp = state['task'], state['imp']
+    X, Y = task['X'], task['Y']
+    fs, ws = state['fs'], state['ws']
+    no_scale = task['no_scale']
+
+    # Reset feature scalers, or keep the scalers of the last fold
+    if task.get('refit', True):
+        X, fs  = imp.scaler_pipline(X, fs, no_scale, train=True)
+        X_pred = imp.scaler_pipline(task['Feature_Data'], fs, no_scale, train=False)
+        Y = pd.DataFrame(ws.fit_transform(Y), index = Y.index, columns = Y.columns)
+    else:
+        X = imp.scaler_pipline(X, fs, no_scale, train=False)
+        X_pred = imp.scaler_pipline(task['Feature_Data'], fs, no_scale, train=False)
+        Y = pd.DataFrame(ws.transform(Y), index = Y.index, columns = Y.columns)
+    return X, Y, X_pred
+
+
+def final_result(state, X, Y, X_pred, predict, history, epochs, weights):
+    task, ws = state['task'], state['ws']
+    well = task['well']
+    folds = task.get('folds', 5)
+    Model_Runs = state['Model_Runs']
+    metrics_avg = pd.DataFrame(state['temp_metrics'].mean(), columns=[well]).transpose()
+
+    # Model Prediction
+    Prediction = pd.DataFrame(
+                    ws.inverse_transform(predict(X_pred)),
+                    index=X_pred.index, columns = [well])
+    Model_Runs[folds+1] = Prediction.astype(float)
+    Comp_R2    = r2_score(
+                    ws.inverse_transform(Y.values.reshape(-1,1)),
+                    ws.inverse_transform(predict(X)))
+    metrics_avg.loc[well,'Comp R2'] = Comp_R2
+
+    result = {'well':         well,
+              'Metrics':      metrics_avg,
+              'Model_Runs':   Model_Runs,
+              'Prediction':   Prediction,
+              'history':      history,
+              'epochs':       epochs,
+              'fold_epochs':  state['n_epochs'],
+              'warm_start':   state['warm'],
+              'seconds':      time.perf_counter() - state['start'],
+              'Model':        {'features': state['features'],
+                               'folds':    state['models'],
+                               'final':    {'weights': weights,
+                                            'fs':      copy.deepcopy(state['fs']),
+                                            'ws':      copy.deepcopy(state['ws'])}}}
+    return result
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:50:00 2026
+
+@author: saulg
+"""
+import numpy as np
+import pandas as pd
+
+
+# Support Script for Groundwater Imputation Tool
+# Result tables of an imputation run preallocated from the time index and the
+# well list, instead of growing a DataFrame with pd.concat for every well.
+#   series tables (time x wells): 'Imputed' filled readings, 'Output' model
+#                                 predictions
+#   metrics table (wells x metrics)
+# A write fills one column or row in place and marks it as written. frame and
+# metrics_frame return the DataFrames the scripts used to build: the written
+# wells in well order, the rows of index_rows plus every date a written series
+# has.
+
+series_tables = ['Imputed', 'Output']
+
+
+class results():
+    def __init__(self, index, wells, metrics, index_rows = None):
+        self.index = pd.DatetimeIndex(index)
+        self.wells = pd.Index(wells)
+        self.metrics = pd.Index(metrics)
+        T, W, M = len(self.index), len(self.wells), len(self.metrics)
+        shapes = {'Metrics':       ((W, M), float),
+                  'Metrics Wells': ((W,), bool)}
+        for table in series_tables:
+            shapes[table] = ((T, W), float)
+            shapes[table + ' Rows'] = ((T,), bool)
+            shapes[table + ' Wells'] = ((W,), bool)
+
+        self.arrays = dict()
+        for key, (shape, dtype) in shapes.items():
+            self.arrays[key] = np.full(shape, np.nan if dtype == float else False, dtype = dtype)
+        # Rows every series table keeps, written or not
+        if index_rows is not None:
+            rows = self.index.isin(index_rows)
+            for table in series_tables: self.arrays[table + ' Rows'][rows] = True
+
+    def add_series(self, table, well, series):
+        # series is a Series or a one column DataFrame indexed by dates of index
+        values = series.iloc[:, 0] if isinstance(series, pd.DataFrame) else series
+        rows = self.index.get_indexer(values.index)
+        if (rows < 0).any(): raise KeyError(f'{well}: dates outside of the result index')
+        column = self.wells.get_loc(well)
+        self.arrays[table][:, column] = np.nan
+        self.arrays[table][rows, column] = values.to_numpy(dtype = float, na_value = np.nan)
+        self.arrays[table + ' Rows'][rows] = True
+        self.arrays[table + ' Wells'][column] = True
+
+    def add_metrics(self, well, metrics):
+        # metrics is a Series or the one row DataFrame of a well result
+        if isinstance(metrics, pd.DataFrame): metrics = metrics.iloc[0]
+        row = self.wells.get_loc(well)
+        values = metrics.reindex(self.metrics)
+        self.arrays['Metrics'][row] = values.to_numpy(dtype = float, na_value = np.nan)
+        self.arrays['Metrics Wells'][row] = True
+
+    def frame(self, table):
+        rows = self.arrays[table + ' Rows']
+        wells = self.arrays[table + ' Wells']
+        index = self.index if rows.all() else self.index[rows]
+        return pd.DataFrame(self.arrays[table][np.ix_(rows, wells)], index = index, columns = self.wells[wells])
+
+    def metrics_frame(self):
+        wells = self.arrays['Metrics Wells']
+        return pd.DataFrame(self.arrays['Metrics'][wells], index = self.wells[wells], columns = self.metrics)
+
+    def written(self, table = 'Metrics'):
+        return self.wells[self.arrays[table + ' Wells']]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:55:00 2026
+
+@author: saulg
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Support Script for Groundwater Imputation Tool
+# Rolling median of a (months, wells) float array, as pandas
+# rolling(window, min_periods = 1).median() of every column: NaN are skipped
+# and a window with a single value returns it. The windows of a group of
+# wells are a strided view of the padded columns, sorted along the window so
+# NaN go last, and the median is read at the count of values of every
+# window. hampel and smooth are the filters of imputation.hampel_filter and
+# imputation.smooth on arrays, the observed readings are passed as an array
+# with NaN where a well was not measured and always kept.
+
+
+def rolling_median(values, window, center = False, chunk = 64):
+    values = np.asarray(values, dtype = float)
+    months, wells = values.shape
+    # Labels as pandas, a centered window of 36 spans 18 months before and 17 after
+    before = window // 2 if center else window - 1
+    after = window - 1 - before
+    median = np.empty((months, wells))
+    for start in range(0, wells, chunk):
+        block = np.pad(values[:, start:start+chunk].T, ((0, 0), (before, after)), constant_values = np.nan)
+        windows = np.sort(sliding_window_view(block, window, axis=1), axis=2)
+        valid = np.cumsum(~np.isnan(np.pad(block, ((0, 0), (1, 0)))), axis=1)
+        count = (valid[:, window:] - valid[:, :-window])[..., None]
+        low = np.take_along_axis(windows, np.maximum(count - 1, 0) // 2, axis=2)
+        high = np.take_along_axis(windows, count // 2, axis=2)
+        median[:, start:start+chunk] = np.where(count > 0, (low + high) / 2, np.nan)[..., 0].T
+    return median
+
+
+def hampel(values, observed, max_sd = 3, window = 36, center = True):
+    # Values further than max_sd scaled MADs from the rolling median are
+    # replaced by it, observed readings are kept
+    L = 1.4826
+    roll = rolling_median(values, window, center = center)
+    difference = np.abs(roll - values)
+    mad = rolling_median(difference, window)
+    with np.errstate(invalid = 'ignore'):
+        outliers = difference > max_sd * L * mad
+    filtered = np.where(outliers, roll, values)
+    return np.where(np.isnan(observed), filtered, observed)
+
+
+def smooth(values, observed, window = 36, center = True):
+    roll = rolling_median(values, window, center = center)
+    return np.where(np.isnan(observed), roll, observed)
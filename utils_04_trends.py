@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:20:00 2026
+
+@author: saulg
+"""
+import os
+import glob
+import pickle
+import numpy as np
+import pandas as pd
+import utils_04_incremental
+
+
+# Support Script for Groundwater Imputation Tool
+# The prior of a well, its PCHIP interpolation extended by linear_extrap, and
+# the rolling windows of the prior only depend on the raw readings and the
+# trend settings. trend_cache keeps them on disk keyed on a hash of both, so
+# later runs of 04_Imputation_Remote.py and every iteration of
+# 05_Imputation_Iteration.py read them instead of fitting them again. Entries
+# are written to a temporary file and renamed, workers can share a cache. A
+# read touches the entry, evict removes the least recently used entries once
+# the cache is over max_mb.
+# linear_extrap_batch is the extrapolation of imputation.linear_extrap for
+# many wells at once, imputation.linear_extrap is a wrapper around it and
+# well_trends_batch extrapolates the priors of every well a script trains
+# with one call.
+
+
+class trend_cache():
+    def __init__(self, path, max_mb = 1024):
+        if os.path.isdir(path) is False:
+            os.makedirs(path)
+        self.path = path
+        self.max_mb = max_mb
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.trend')
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as handle: value = pickle.load(handle)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+            return None
+        try: os.utime(self._file(key))
+        except OSError: pass
+        return value
+
+    def put(self, key, value):
+        # A full or read-only cache never fails the well
+        temp = self._file(key) + f'.{os.getpid()}.tmp'
+        try:
+            with open(temp, 'wb') as handle: pickle.dump(value, handle, protocol = 3)
+            os.replace(temp, self._file(key))
+        except OSError:
+            if os.path.isfile(temp): os.remove(temp)
+
+    def evict(self):
+        # Oldest entries first until the cache fits, returns the entries removed
+        entries = []
+        for file in glob.glob(os.path.join(self.path, '*.trend')):
+            try: entries.append((os.path.getmtime(file), os.path.getsize(file), file))
+            except OSError: pass
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, nbytes, file in entries:
+            if size <= self.max_mb * 2**20: break
+            try: os.remove(file)
+            except OSError: continue
+            size -= nbytes
+            removed += 1
+        return removed
+
+
+def _trend_key(feature_index, y_raw, windows, reg_perc, max_sd, force_left, force_right):
+    return utils_04_incremental.fingerprint(y_raw, feature_index.to_series(), windows, reg_perc,
+                                            max_sd, force_left, force_right)
+
+
+def well_trends(imp, feature_index, y_raw, well, windows, reg_perc = [1.0, 0.5, 0.25, 0.10], max_sd = 3,
+                force_left = False, force_right = False, cache = None):
+    # Prior of a well as (linear_extrap, extrap_df, extrap_md, rw), read from
+    # cache when the readings and settings were seen before
+    return well_trends_batch(imp, feature_index, {well: y_raw}, windows, reg_perc, max_sd,
+                             force_left, force_right, cache, errors = False)[well]
+
+
+def well_trends_batch(imp, feature_index, y_raws, windows, reg_perc = [1.0, 0.5, 0.25, 0.10], max_sd = 3,
+                      force_left = False, force_right = False, cache = None, errors = True):
+    # well_trends of every well of y_raws, a dictionary of raw readings by
+    # well. The priors missing from the cache are extrapolated by one
+    # linear_extrap_batch call per group of wells on the same dates. With
+    # errors a well that fails returns its exception instead of raising.
+    shift = int(max(windows)/2)
+    trends, keys, pending = dict(), dict(), dict()
+    for well, y_raw in y_raws.items():
+        if cache is not None:
+            keys[well] = _trend_key(feature_index, y_raw, windows, reg_perc, max_sd, force_left, force_right)
+            trends[well] = cache.get(keys[well])
+            if trends[well] is not None: continue
+        try:
+            pchip, x_int_index, pchip_int_index = imp.interpolate(feature_index, y_raw, well, shift = shift)
+            pending[well] = (x_int_index, pchip.dropna())
+        except Exception as e:
+            if not errors: raise
+            trends[well] = e
+    if not pending: return trends
+
+    # Wells on the same dates are extrapolated together, a well then gives the
+    # same prior as on its own
+    groups = dict()
+    for well, (x_int_index, pchip) in pending.items():
+        groups.setdefault((x_int_index.index[0], x_int_index.index[-1]), []).append(well)
+    for wells in groups.values():
+        dates = pending[wells[0]][0].index
+        Y = np.full((len(wells), len(dates)), np.nan)
+        for k, well in enumerate(wells):
+            Y[k, dates.get_indexer(pending[well][1].index)] = pending[well][1]['pchip'].values
+        try: batch = linear_extrap_batch(Y, reg_perc, max_sd, force_left = force_left, force_right = force_right)
+        except ValueError: batch = None
+
+        for k, well in enumerate(wells):
+            try:
+                # A batch with a well too short to fit is retried well by well
+                if batch is None: filled, sides = linear_extrap_batch(Y[k:k+1], reg_perc, max_sd, force_left = force_left,
+                                                                      force_right = force_right)
+                else: filled, sides = _batch_well(batch, k)
+                linear_extrap, extrap_df, extrap_md = extrap_frames(filled, sides, dates, reg_perc)
+                rw = imp.rolling_windows(linear_extrap, windows = windows)
+            except Exception as e:
+                if not errors: raise
+                trends[well] = e
+                continue
+            trends[well] = (linear_extrap, extrap_df, extrap_md, rw)
+            if cache is not None: cache.put(keys[well], trends[well])
+    return trends
+
+
+def _batch_well(batch, k):
+    # Well k of a linear_extrap_batch result
+    filled, sides = batch
+    well_sides = {side: {key: value[k:k+1] for key, value in fits.items()} for side, fits in sides.items()}
+    return filled[k:k+1], well_sides
+
+
+def extrap_frames(filled, sides, dates, reg_perc):
+    # Filled prior, lines and slope metadata of the single well of a
+    # linear_extrap_batch result as the Series and tables of linear_extrap
+    d_side, d_slope = dict(), dict()
+    for side in ['left', 'right']:
+        d_side[side] = pd.DataFrame(sides[side]['Lines'][0].T, index = dates, columns = reg_perc)
+        d_slope[side] = pd.DataFrame(np.stack([sides[side][key][0] for key in ['Slope', 'Int', 'Mean']], axis=1),
+                                     index = reg_perc, columns = ['Slope', 'Int', 'Mean'], dtype = object)
+    return pd.Series(filled[0], index = dates, name = 'pchip'), d_side, d_slope
+
+
+def _window_fit(Y, window, x, outlier):
+    # Least squares line of every well over its window after dropping the
+    # values above mean + outlier * sd, returns slope, intercept and the mean
+    k = window.sum(axis=1)
+    mean = np.where(window, Y, 0).sum(axis=1) / k
+    sd = np.sqrt(np.where(window, (Y - mean[:, None])**2, 0).sum(axis=1) / (k - 1))
+    with np.errstate(invalid='ignore'):
+        keep = window & (Y <= (mean + outlier * sd)[:, None])
+    k = keep.sum(axis=1)
+    if (k < 3).any(): raise ValueError('Less than 3 points to fit the trend of a well')
+    x_mean = np.where(keep, x, 0).sum(axis=1) / k
+    y_mean = np.where(keep, Y, 0).sum(axis=1) / k
+    dx = np.where(keep, x - x_mean[:, None], 0)
+    slope = (dx * np.where(keep, Y - y_mean[:, None], 0)).sum(axis=1) / (dx**2).sum(axis=1)
+    return slope, y_mean - slope * x_mean, y_mean
+
+
+def linear_extrap_batch(Y, reg_perc = [1.0, 0.5, 0.25, 0.10], max_sd = 3, outlier = 3, force_left = False,
+                        force_right = False, cSlope_left = False, cSlope_right = False, lines = True):
+    # Y is (wells, months) on one monthly grid, NaN where a well has no prior.
+    # For every side and percentage the line is fit over the first (left) or
+    # last (right) int(n * perc) values of a well, x counted in months from
+    # the start of the window (right) or so the window ends at points - 1
+    # (left). The mean slope of a side, anchored at the mean of its smallest
+    # window and clipped to max_sd population deviations, fills the months
+    # before and after the prior. Returns the filled (wells, months) array and
+    # per side the 'Slope', 'Int' and 'Mean' arrays (wells, percentages) and,
+    # with lines, the 'Lines' of every percentage (wells, percentages, months)
+    Y = np.asarray(Y, dtype = float)
+    valid = ~np.isnan(Y)
+    count = np.cumsum(valid, axis=1)
+    n = count[:, -1]
+    months = np.arange(Y.shape[1])[None, :]
+    s_min = int(np.argmin(reg_perc))
+    forced = {'left': (force_left, cSlope_left), 'right': (force_right, cSlope_right)}
+
+    pop_mean = np.where(valid, Y, 0).sum(axis=1) / n
+    pop_std = np.sqrt(np.where(valid, (Y - pop_mean[:, None])**2, 0).sum(axis=1) / (n - 1))
+    max_value = (pop_mean + max_sd * pop_std)[:, None]
+    min_value = (pop_mean - max_sd * pop_std)[:, None]
+
+    sides, extrap = dict(), dict()
+    for side in ['left', 'right']:
+        fits = {'Slope': [], 'Int': [], 'Mean': [], 'Lines': []}
+        for j, perc in enumerate(reg_perc):
+            points = (n * perc).astype(int)[:, None]
+            if side == 'left':
+                window = valid & (count <= points)
+                edge = np.argmax(count >= points, axis=1)[:, None]
+                x = months - edge + points - 1
+                reach = months <= edge
+            else:
+                window = valid & (count > n[:, None] - points)
+                edge = np.argmax(count > n[:, None] - points, axis=1)[:, None]
+                x = months - edge
+                reach = months >= edge
+            slope, intercept, mean = _window_fit(Y, window, x, outlier)
+            for key, value in zip(['Slope', 'Int', 'Mean'], [slope, intercept, mean]): fits[key].append(value)
+            if lines: fits['Lines'].append(np.where(reach, x * slope[:, None] + intercept[:, None], np.nan))
+            if j == s_min: x_min, reach_min = x, reach
+        sides[side] = {key: np.stack(value, axis=1) for key, value in fits.items() if value}
+
+        # Mean slope of the side, forced or replaced when asked
+        slope = sides[side]['Slope'].mean(axis=1)
+        force, cSlope = forced[side]
+        if force == 'positive': slope = np.abs(slope)
+        elif force == 'negative': slope = -1 * np.abs(slope)
+        elif cSlope != False: slope = np.full_like(slope, cSlope)
+        line = x_min * slope[:, None] + sides[side]['Mean'][:, s_min][:, None]
+        line = np.where(line <= max_value, line, max_value)
+        line = np.where(line >= min_value, line, min_value)
+        extrap[side] = np.where(reach_min, line, np.nan)
+
+    filled = np.where(valid, Y, extrap['left'])
+    filled = np.where(np.isnan(filled), extrap['right'], filled)
+    return filled, sides
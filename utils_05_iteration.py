@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:02:00 2026
+
+@author: saulg
+"""
+import math
+import numpy as np
+import pandas as pd
+import utils_04_machine_learning
+import utils_04_parallel
+import utils_04_trends
+
+
+# Support Script for the Iterative Refinement Imputation
+# Within an iteration every well only reads the imputed matrix of the previous
+# iteration, so wells are independent and can be handed to a well_pool. The
+# tables below are read through utils_04_parallel.shared_data:
+#   Pretrained: hampel filtered imputation of the previous iteration
+#   Data:       well readings with gaps
+
+
+def feature_selection(pretrained, data, location, well_index, weight_cor, weight_dist,
+                      min_features = 5, feature_thresh = 0.6):
+    # Scores every well against every other well of the pretrained matrix at
+    # once. Pearson's r of a well uses the months where the well is observed
+    # and every other pretrained well has a value, the same rows the per well
+    # dropna() kept. Returns the selected features of every well as a frame of
+    # r, dist and w_score ordered by w_score, wells without a score are left
+    # out.
+    features = pretrained.columns
+    wells = [well for well in data.columns if well in features]
+    P = pretrained.values.astype(float)
+    Y = data.reindex(index = pretrained.index, columns = wells).values.astype(float)
+    cols = features.get_indexer(wells)
+
+    # Rows kept by dropna(), complete apart from the well itself
+    nan_count = np.isnan(P).sum(axis=1)[:,np.newaxis]
+    own_nan = np.isnan(P[:,cols])
+    M = (~np.isnan(Y) & ((nan_count == 0) | ((nan_count == 1) & own_nan))).astype(float)
+    # r does not change with an offset, centering first keeps the moments of
+    # water levels far from zero exact
+    P = np.nan_to_num(P - np.nanmean(P, axis=0))
+    Y = np.nan_to_num(Y)
+
+    # Pearson's r from the moments of the kept rows, as r_regression
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = M.sum(axis=0)[:,np.newaxis]
+        Y_c = M * (Y - (M * Y).sum(axis=0)/n.T)
+        X_means = (M.T @ P) / n
+        X_norms = np.sqrt(M.T @ (P**2) - n * X_means**2)
+        r = (Y_c.T @ P) / X_norms / np.sqrt((Y_c**2).sum(axis=0))[:,np.newaxis]
+    r[np.arange(len(wells)), cols] = np.nan
+
+    # Normalized distance to every other located well
+    location = location.reindex(wells).astype(float)
+    located = location.notna().all(axis=1).values
+    dist = np.full((len(wells), len(well_index.keys)), np.nan)
+    if located.any(): dist[located] = well_index.distances(location[located]).values
+    own = well_index.keys.get_indexer(wells)
+    rows = np.flatnonzero(own >= 0)
+    dist[rows, own[rows]] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = 1 - (dist/np.nanmax(dist, axis=1, keepdims=True))
+    loc_cols = well_index.keys.get_indexer(features)
+    dist = np.where(loc_cols >= 0, dist[:,loc_cols], np.nan)
+    w_score = r * weight_cor + dist * weight_dist
+
+    selection = dict()
+    for i, well in enumerate(wells):
+        valid = np.flatnonzero(~np.isnan(w_score[i]))
+        if len(valid) == 0: continue
+        # Descending order of DataFrame.sort_values
+        order = valid[::-1][w_score[i, valid[::-1]].argsort(kind='quicksort')][::-1]
+
+        # Calculate number of Features
+        fs_data_score = w_score[i, order[0:min_features]].sum()/len(order[0:min_features])
+        fs_data_score = math.floor(fs_data_score*10)/10
+        if feature_thresh - fs_data_score <= 0: add_features = 0
+        else: add_features = int((feature_thresh - fs_data_score) * 10)
+        order = order[0:min_features + add_features]
+        selection[well] = pd.DataFrame({'r':       r[i, order],
+                                        'dist':    dist[i, order],
+                                        'w_score': w_score[i, order]},
+                                       index = features[order])
+    return selection
+
+
+def iteration_well(task, fold_pool = None):
+    # task holds the well name, its selection from feature_selection, the
+    # trend windows and the kfold_train settings. fold_pool trains the folds
+    # of the well at the same time as in kfold_train.
+    train_task = iteration_task(task)
+    result = utils_04_parallel.kfold_train(train_task, fold_pool = fold_pool)
+    result['Feature_Correlation'] = train_task['Feature_Correlation']
+    return result
+
+
+def iteration_batch(tasks):
+    # iteration_well for a group of wells trained together by
+    # utils_04_batched, a well that fails returns its exception. Imported here
+    # as it needs TensorFlow.
+    import utils_04_batched
+    train_tasks = []
+    for task in tasks:
+        try: train_tasks.append(iteration_task(task))
+        except Exception as e: train_tasks.append(e)
+    ready = [train_task for train_task in train_tasks if not isinstance(train_task, Exception)]
+    trained = iter(utils_04_batched.kfold_train_batched(ready) if ready else [])
+    results = []
+    for train_task in train_tasks:
+        if isinstance(train_task, Exception):
+            results.append(train_task)
+            continue
+        result = next(trained)
+        if not isinstance(result, Exception): result['Feature_Correlation'] = train_task['Feature_Correlation']
+        results.append(result)
+    return results
+
+
+# Prior settings of every well, see utils_04_trends.well_trends
+trend_settings = {'reg_perc':    [1.0, 0.5, 0.25, 0.10],
+                  'max_sd':      6,
+                  'force_left':  False,
+                  'force_right': False}
+
+
+def iteration_trends(imp, Feature_Index, Well_Data, tasks, cache = None):
+    # Priors of the wells of tasks extrapolated together by the main process,
+    # each task carries its own as 'trends'
+    y_raws = {task['well']: Well_Data[task['well']].fillna(limit=2, method='ffill') for task in tasks}
+    windows = tasks[0]['windows'] if tasks else [24]
+    Trends = utils_04_trends.well_trends_batch(imp, Feature_Index, y_raws, windows, cache = cache, **trend_settings)
+    for task in tasks: task['trends'] = Trends[task['well']]
+
+
+def iteration_task(task):
+    # Builds the features of a well and returns its kfold_train task
+    well = task['well']
+    imp = utils_04_machine_learning.imputation(task['data_root'], task['figures_root'],
+                                               task.get('figures', 'now'), task.get('figure_wells'))
+    Well_Data_Pretrained = utils_04_parallel.shared_data('Pretrained')
+    Well_Data = utils_04_parallel.shared_data('Data')
+    Feature_Index = Well_Data_Pretrained.index
+
+    # Get Well raw readings for single well
+    y_raw = Well_Data[well].fillna(limit=2, method='ffill')
+
+    # Get Well readings for single well
+    y_well = pd.DataFrame(Well_Data[well], index = Feature_Index[:])
+
+    # Add Dumbies
+    table_dumbies = pd.get_dummies(Feature_Index.month_name())
+    table_dumbies.index = Feature_Index
+    table_dumbies['Months'] = (Feature_Index - Feature_Index[0]).astype(int)
+    table_dumbies['Months'] = table_dumbies['Months']/table_dumbies['Months'][-1]
+
+    # Create Well Trend, usually extrapolated with the other wells by
+    # iteration_trends
+    temp = task.get('trends')
+    if temp is None: temp = utils_04_trends.well_trends(imp, Feature_Index, y_raw, well, task['windows'],
+                                                        cache = task.get('trend_cache'), **trend_settings)
+    if isinstance(temp, Exception): raise temp
+    linear_extrap, extrap_df, extrap_md, rw = temp
+    imp.trend_plot(linear_extrap, extrap_df, extrap_md, y_raw, well)
+    rw = rw[rw[rw.columns[-1]].notna()]
+    table_rw = pd.DataFrame(rw, index=rw.index, columns = rw.columns)
+    imp.rw_plot(y_raw, rw, well, save = True, extension = '.png', show=False)
+
+    # Features chosen by feature_selection in the main process
+    if task['selection'] is None: raise ValueError(f'No features could be scored for well {well}')
+    fs_data = task['selection']
+    fs_name = fs_data.index.to_list()
+    Feature_Data = Well_Data_Pretrained.drop(well, axis=1)[fs_name]
+
+    # Calculate correlation metrics, returned as a single row and merged into
+    # the aquifer table by the main process
+    feature_temp = pd.concat([y_well, Feature_Data], axis=1, join='outer')
+    imp.feature_plot(feature_temp, Well_Data[fs_name], well)
+    Feature_Correlation = pd.DataFrame(index=[well], columns = ['FI', 'WI'])
+    Feature_Correlation = imp.feature_correlation(Feature_Correlation, feature_temp, Well_Data, fs_data)
+
+    # Join Best features with Rolling Windows, dummies are joined last and
+    # are not scaled
+    Feature_Data = imp.Data_Join(Feature_Data, table_rw).dropna()
+    Feature_Data = imp.Data_Join(Feature_Data, table_dumbies).dropna()
+
+    # Joining Features to Well Data
+    Well_set = y_well.join(Feature_Data, how='outer')
+    Well_set = Well_set[Well_set[Well_set.columns[1]].notnull()]
+    Well_set_clean = Well_set.dropna()
+
+    # Feature Split
+    Y, X = imp.Data_Split(Well_set_clean, well)
+
+    # The iteration keeps the scalers of the last fold for the final model
+    # and reports mean error as observation - prediction.
+    train_task = dict(task)
+    train_task.update({'X':            X,
+                       'Y':            Y,
+                       'Feature_Data': Feature_Data,
+                       'y_well':       y_well,
+                       'index':        Feature_Index,
+                       'no_scale':     table_dumbies.columns.to_list(),
+                       'me_sign':      -1,
+                       'refit':        False,
+                       'Feature_Correlation': Feature_Correlation})
+    return train_task